@@ -39,6 +39,7 @@ class Plugin(object):
         self.server = server
         self.filename = filename
         self.name = name
+        self.warmedUp = False
 
         self.logger = olof.logger.Logger(self.server, self.filename)
         self.storage = olof.storagemanager.StorageManager(self.server, self.filename)
@@ -49,6 +50,41 @@ class Plugin(object):
             self.config.addOptions(options)
             self.config.readConfig()
 
+    def warmup(self):
+        """
+        Called in a separate thread after the plugin is initialised. Slow initialisation, f.ex. reading saved data from
+        disk, should be done here instead of in __init__, so it does not hold up the server start. The warm-ups of all
+        plugins run concurrently.
+
+        No data is passed to the plugin until its warm-up has finished; data received in the meantime is buffered. Do not
+        interact with the reactor from this method, use activate() instead.
+        """
+        pass
+
+    def activate(self):
+        """
+        Called in the main thread when warmup() has returned, right before buffered data is passed to the plugin. Start
+        looping calls, connections or listening ports here.
+        """
+        pass
+
+    def exportState(self):
+        """
+        Called when the plugin is reloaded, right before this instance is unloaded. Return any state that should be
+        passed on to the new instance, to avoid losing it or having to save and read it from disk.
+
+        @return   The state to pass to importState() of the new instance. None by default.
+        """
+        return None
+
+    def importState(self, state):
+        """
+        Called when the plugin is reloaded, on the new instance right after initialisation and before warmup().
+
+        @param   state   The state returned by exportState() of the previous instance. None when not available.
+        """
+        pass
+
     def defineConfiguration(self):
         """
         Define the configuration options for this plugin. Should return a list or set with olof.configuration.Option's
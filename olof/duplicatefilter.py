@@ -0,0 +1,184 @@
+#-*- coding: utf-8 -*-
+#
+# This file belongs to Gyrid Server.
+#
+# Copyright (C) 2012  Roel Huybrechts
+# All rights reserved.
+
+"""
+Module that detects duplicate messages from the scanners, f.ex. cached data that is sent again after reconnecting.
+
+Messages are remembered for a configurable time window in a series of Bloom filters, each covering part of the window.
+The oldest filter is dropped when the window moves on, so memory use is bounded by the expected number of messages in
+the window. A Bloom filter has no false negatives, but can report a message as a duplicate when it is not; the chance
+of this is kept below the configured error rate as long as the expected number of messages is not exceeded.
+"""
+
+import collections
+import hashlib
+import math
+import struct
+import time
+import zlib
+
+class BloomFilter(object):
+    """
+    Class that implements a Bloom filter, storing the bits in a bytearray.
+    """
+    def __init__(self, bits, hashes):
+        """
+        Initialisation.
+
+        @param   bits (int)     The number of bits.
+        @param   hashes (int)   The number of bits set for each key.
+        """
+        self.bits = bits
+        self.hashes = hashes
+        self.array = bytearray((bits + 7) // 8)
+        self.set = 0
+        self.count = 0
+
+    def getPositions(self, digest):
+        """
+        Get the bit positions for the given digest, using double hashing.
+
+        @param   digest (str)   The 16-byte digest of the key.
+        @return  (list)         The bit positions.
+        """
+        h1, h2 = struct.unpack('<QQ', digest)
+        return [(h1 + i * h2) % self.bits for i in xrange(self.hashes)]
+
+    def contains(self, positions):
+        """
+        Check whether the bits at the given positions are all set.
+
+        @param   positions (list)   The bit positions.
+        @return  (bool)             True when all bits are set.
+        """
+        a = self.array
+        for p in positions:
+            if not a[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def add(self, positions):
+        """
+        Set the bits at the given positions.
+
+        @param   positions (list)   The bit positions.
+        """
+        self.count += 1
+        a = self.array
+        for p in positions:
+            bit = 1 << (p & 7)
+            if not a[p >> 3] & bit:
+                a[p >> 3] |= bit
+                self.set += 1
+
+    def getErrorRate(self):
+        """
+        Estimate the current false positive rate, based on the fraction of bits set.
+
+        @return  (float)   The probability a new key is reported as present.
+        """
+        return (float(self.set) / self.bits) ** self.hashes
+
+class DuplicateFilter(object):
+    """
+    Class that detects duplicate messages within a time window.
+
+    The window is divided in a number of buckets, each with a Bloom filter. Messages are checked against all buckets and
+    added to the newest one. When a bucket holds its share of the expected number of messages before its time is up, a
+    new bucket is started early. This keeps the error rate, at the cost of a shorter window.
+
+    Messages are identified by the hostname of the scanner, the type of the message and the CRC32 checksum of the
+    message, ignoring whether it has been cached.
+    """
+    buckets = 4
+
+    def __init__(self, window, capacity, errorRate):
+        """
+        Initialisation.
+
+        @param   window (int)        The time window in seconds.
+        @param   capacity (int)      The expected number of messages within the window.
+        @param   errorRate (float)   The maximum false positive rate at the expected number of messages.
+        """
+        self.window = window
+        self.interval = float(window) / DuplicateFilter.buckets
+
+        # Each bucket holds its share of the messages, at the error rate divided over the buckets.
+        self.capacity = max(1, capacity // DuplicateFilter.buckets)
+        p = errorRate / DuplicateFilter.buckets
+        self.bits = int(math.ceil(-self.capacity * math.log(p) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(float(self.bits) / self.capacity * math.log(2))))
+
+        self.filters = collections.deque()
+        self.start = None
+        self.checked = 0
+        self.suppressed = 0
+
+    def rotate(self, now):
+        """
+        Start a new bucket when the current one has expired or is full, dropping buckets that have left the window.
+
+        @param   now (float)   The current time.
+        """
+        if self.start == None or now - self.start >= self.window:
+            self.filters.clear()
+            self.start = now
+            steps = 1
+        else:
+            steps = int((now - self.start) / self.interval)
+            if steps > 0:
+                self.start += steps * self.interval
+            elif self.filters[-1].count >= self.capacity:
+                self.start = now
+                steps = 1
+            else:
+                return
+
+        for i in range(min(steps, DuplicateFilter.buckets)):
+            self.filters.append(BloomFilter(self.bits, self.hashes))
+        while len(self.filters) > DuplicateFilter.buckets:
+            self.filters.popleft()
+
+    def isDuplicate(self, hostname, msg):
+        """
+        Check whether the given message has been seen before within the window, and remember it.
+
+        @param   hostname (str)      The hostname of the scanner that sent the message.
+        @param   msg (proto.Msg)     The message to check.
+        @return  (bool)              True when the message is a duplicate.
+        """
+        self.rotate(time.time())
+        self.checked += 1
+
+        cached = msg.cached
+        if cached:
+            msg.ClearField('cached')
+        checksum = zlib.crc32(msg.SerializeToString())
+        if cached:
+            msg.cached = True
+
+        key = '%s\x00%i\x00%i' % (hostname, msg.type, checksum)
+        positions = self.filters[-1].getPositions(hashlib.md5(key).digest())
+        for f in self.filters:
+            if f.contains(positions):
+                self.suppressed += 1
+                return True
+
+        self.filters[-1].add(positions)
+        return False
+
+    def getErrorRate(self):
+        """
+        Estimate the current false positive rate over all buckets.
+
+        @return  (float)   The probability a new message is reported as a duplicate.
+        """
+        r = 1.0
+        for f in self.filters:
+            r *= 1 - f.getErrorRate()
+        return 1 - r
+
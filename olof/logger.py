@@ -15,6 +15,8 @@ import sys
 import time
 import traceback
 
+from olof.tools.datetimetools import formatTimestamp
+
 class Logger(object):
     """
     Main Logger class that handles logging of information.
@@ -63,7 +65,7 @@ class Logger(object):
             self.logger = self.__getLogger()
 
         message = message.strip() if message != None else ""
-        return time.strftime('%Y%m%d-%H%M%S-%Z'), message
+        return formatTimestamp(time.time()), message
 
     def debug(self, message):
         """
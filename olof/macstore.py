@@ -0,0 +1,544 @@
+#-*- coding: utf-8 -*-
+#
+# This file belongs to Gyrid Server.
+#
+# Copyright (C) 2012  Roel Huybrechts
+# All rights reserved.
+
+"""
+Module that handles persistent storage of the MAC-address:deviceclass mapping.
+
+New and changed entries are kept in a compact in-memory table and appended to a journal file. The journal is
+periodically compacted into an index file of sorted fixed-width records, which is memory mapped and searched on lookup.
+This way the mapping never has to be read from or written to disk, nor held in memory, as a whole.
+"""
+
+from twisted.internet import task, threads
+
+import array
+import mmap
+import os
+import struct
+import time
+
+class MacTable(object):
+    """
+    Class that implements an open addressing hash table mapping 48-bit MAC-addresses, as integers, to a deviceclass
+    and last-seen timestamp. Keys, deviceclasses and timestamps are stored in flat arrays, which takes about a quarter of
+    the memory of a dictionary with string keys and tuple values.
+
+    Entries cannot be removed; clear the table by creating a new one.
+    """
+    # Keys are stored incremented by one, zero marks an empty slot. Use doubles when longs cannot hold 48 bits, these
+    # represent integers up to 53 bits exactly.
+    keyType = 'L' if array.array('L').itemsize >= 8 else 'd'
+
+    def __init__(self, capacity=1024):
+        """
+        Initialisation.
+
+        @param   capacity (int)   The initial number of slots, should be a power of two. Defaults to 1024.
+        """
+        self.__allocate(capacity)
+
+    def __allocate(self, capacity):
+        """
+        Allocate empty arrays with the given number of slots.
+        """
+        self.capacity = capacity
+        self.mask = capacity - 1
+        self.size = 0
+        self.keys = array.array(MacTable.keyType, [0]) * capacity
+        self.deviceclasses = array.array('i', [0]) * capacity
+        self.timestamps = array.array('I', [0]) * capacity
+
+    def __slot(self, key):
+        """
+        Find the slot for the given key using linear probing.
+
+        @param    key (int)   The key to look for.
+        @return   (int)       The slot holding the key, or the empty slot where it should be inserted.
+        """
+        k = key + 1
+        keys = self.keys
+        mask = self.mask
+        i = (k ^ (k >> 23)) & mask
+        while keys[i] != 0 and keys[i] != k:
+            i = (i + 1) & mask
+        return i
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        """
+        Iterate over the keys, in no particular order.
+        """
+        for k in self.keys:
+            if k != 0:
+                yield int(k) - 1
+
+    def get(self, key, default=None):
+        """
+        Get the entry for the given key.
+
+        @param    key (int)   The key to look up.
+        @param    default     The value to return when the key is not present. Defaults to None.
+        @return   (tuple)     Tuple of the deviceclass and last-seen timestamp, or the default value.
+        """
+        i = self.__slot(key)
+        if self.keys[i] == 0:
+            return default
+        return (self.deviceclasses[i], self.timestamps[i])
+
+    def set(self, key, deviceclass, timestamp):
+        """
+        Add or update the entry for the given key. Grows the table when it is three quarters full.
+
+        @param   key (int)           The key.
+        @param   deviceclass (int)   The deviceclass.
+        @param   timestamp (int)     The last-seen UNIX timestamp.
+        """
+        i = self.__slot(key)
+        self.deviceclasses[i] = deviceclass
+        self.timestamps[i] = timestamp
+        if self.keys[i] == 0:
+            self.keys[i] = key + 1
+            self.size += 1
+            if self.size * 4 > self.capacity * 3:
+                self.__grow()
+
+    def __grow(self):
+        """
+        Double the number of slots, reinserting all entries.
+        """
+        keys, deviceclasses, timestamps = self.keys, self.deviceclasses, self.timestamps
+        self.__allocate(self.capacity * 2)
+        for i in xrange(len(keys)):
+            if keys[i] != 0:
+                self.set(int(keys[i]) - 1, deviceclasses[i], timestamps[i])
+
+class MacStore(object):
+    """
+    Class that stores the deviceclass and last-seen time of each MAC-address.
+
+    Can be used like a dictionary mapping MAC-addresses (without colons, f.ex. 001122334455) to deviceclasses.
+    """
+    # A record: MAC-address (upper 16 and lower 32 bits), deviceclass, last-seen UNIX timestamp.
+    record = struct.Struct('!HIiI')
+    key = struct.Struct('!HI')
+
+    # The index file header: magic, format version, number of records.
+    header = struct.Struct('!4sBI')
+    magic = 'GMDC'
+    version = 1
+
+    def __init__(self, server, storagemgr, maxAge=None, maxEntries=None, maxRecent=262144, touchInterval=86400,
+                 flushInterval=10, compactInterval=86400, maxJournalSize=16777216):
+        """
+        Initialisation. Open the index file and replay the journal. Start the looping calls that flush the journal
+        and compact the store.
+
+        Imports the MAC-address:deviceclass dictionary pickled by older versions, if any.
+
+        @param   server (Olof)                 Reference to main Olof server instance.
+        @param   storagemgr (StorageManager)   The StorageManager of the server, used to locate the files.
+        @param   maxAge (int)                  Entries that have not been seen for this amount of seconds are removed
+                                                 on compaction. None to keep entries forever. Defaults to None.
+        @param   maxEntries (int)              Keep at most this number of entries on compaction, removing the least
+                                                 recently seen ones. None for no limit. Defaults to None.
+        @param   maxRecent (int)               Compact as soon as this number of new or changed entries is held in
+                                                 memory. Defaults to 262144.
+        @param   touchInterval (int)           The last-seen time of an unchanged entry is only updated when it is
+                                                 older than this amount of seconds. Defaults to 86400 (1 day).
+        @param   flushInterval (int)           Interval in seconds for writing the journal to disk. Defaults to 10.
+        @param   compactInterval (int)         Interval in seconds for compacting the journal into the index.
+                                                 Defaults to 86400 (1 day).
+        @param   maxJournalSize (int)          Compact as soon as the journal exceeds this size in bytes. Defaults to
+                                                 16777216 (16 MiB).
+        """
+        self.server = server
+        self.maxAge = maxAge
+        self.maxEntries = maxEntries
+        self.maxRecent = maxRecent
+        self.touchInterval = touchInterval
+        self.maxJournalSize = maxJournalSize
+
+        self.index_path = storagemgr.getPath('mac_dc.index')
+        self.journal_path = storagemgr.getPath('mac_dc.journal')
+        self.journal_old_path = self.journal_path + '.old'
+
+        self.recent = MacTable()
+        self.compacting = None
+        self.journal_buffer = []
+
+        self.index = None
+        self.index_file = None
+        self.index_count = 0
+
+        self.__openIndex()
+        for path in [self.journal_old_path, self.journal_path]:
+            self.__replayJournal(path)
+        self.journal = open(self.journal_path, 'ab')
+
+        legacy_path = storagemgr.getPath('mac_dc')
+        if os.path.isfile(legacy_path):
+            self.__importLegacy(storagemgr.loadObject('mac_dc', {}), legacy_path)
+
+        self.flush_loop = task.LoopingCall(self.flush)
+        self.flush_loop.start(flushInterval, now=False)
+
+        self.compact_loop = task.LoopingCall(self.compact)
+        self.compact_loop.start(compactInterval, now=False)
+
+    def unload(self):
+        """
+        Unload the store, stopping looping calls and writing the journal to disk.
+        """
+        for loop in [self.flush_loop, self.compact_loop]:
+            try:
+                loop.stop()
+            except AssertionError:
+                pass
+
+        self.__writeJournal()
+        os.fsync(self.journal.fileno())
+        self.journal.close()
+
+        if self.compacting == None and self.index != None:
+            # Leave the index open when it is still being read by the compaction thread.
+            self.index.close()
+            self.index_file.close()
+
+    def __importLegacy(self, mac_dc, path):
+        """
+        Import a MAC-address:deviceclass dictionary and remove the file it was read from.
+
+        @param   mac_dc (dict)   The dictionary to import.
+        @param   path (str)      Path of the file the dictionary was read from.
+        """
+        now = int(time.time())
+        for mac in mac_dc:
+            self.set(mac, mac_dc[mac], now)
+        self.__writeJournal()
+        os.fsync(self.journal.fileno())
+        os.remove(path)
+        self.server.logger.logInfo("Imported %i MAC-addresses into the MAC-address store" % len(mac_dc))
+
+    def __key(self, mac):
+        """
+        Get the key for the given MAC-address.
+
+        @param    mac (str)   The MAC-address, without colons.
+        @return   (int)       The MAC-address as a 48-bit integer, None when the MAC-address is invalid.
+        """
+        if len(mac) != 12:
+            return None
+        try:
+            return int(mac, 16)
+        except ValueError:
+            return None
+
+    def __searchIndex(self, key):
+        """
+        Binary search the index for the given key. Records are sorted by their big-endian key bytes, which is the same
+        order as the integer keys.
+
+        @param    key (int)   The key to look for.
+        @return   (tuple)     Tuple of the deviceclass and last-seen timestamp, None when not found.
+        """
+        if self.index == None:
+            return None
+
+        key = MacStore.key.pack(key >> 32, key & 0xffffffff)
+        size = MacStore.record.size
+        offset = MacStore.header.size
+        low, high = 0, self.index_count
+        while low < high:
+            mid = (low + high) // 2
+            position = offset + mid * size
+            k = self.index[position:position+6]
+            if k < key:
+                low = mid + 1
+            elif k > key:
+                high = mid
+            else:
+                return MacStore.record.unpack_from(self.index, position)[2:]
+        return None
+
+    def __lookup(self, key):
+        """
+        Look up the given key, in order of recency: in the recent entries, in the entries being compacted and in the
+        index.
+
+        @param    key (int)   The key to look for.
+        @return   (tuple)     Tuple of the deviceclass and last-seen timestamp, None when not found.
+        """
+        entry = self.recent.get(key, None)
+        if entry == None and self.compacting != None:
+            entry = self.compacting.get(key, None)
+        if entry == None:
+            entry = self.__searchIndex(key)
+        return entry
+
+    def get(self, mac, default=None):
+        """
+        Get the deviceclass of the given MAC-address.
+
+        @param    mac (str)   The MAC-address to look up.
+        @param    default     The value to return when the MAC-address is unknown. Defaults to None.
+        @return   (int)       The deviceclass, or the default value when unknown.
+        """
+        key = self.__key(mac)
+        if key == None:
+            return default
+        entry = self.__lookup(key)
+        return entry[0] if entry != None else default
+
+    def __getitem__(self, mac):
+        dc = self.get(mac)
+        if dc == None:
+            raise KeyError(mac)
+        return dc
+
+    def __setitem__(self, mac, deviceclass):
+        self.set(mac, deviceclass)
+
+    def __contains__(self, mac):
+        return self.get(mac) != None
+
+    def __len__(self):
+        """
+        Approximate number of entries, entries in the journal that are in the index too are counted twice.
+        """
+        return self.index_count + len(self.recent) + (len(self.compacting) if self.compacting != None else 0)
+
+    def set(self, mac, deviceclass, timestamp=None):
+        """
+        Set the deviceclass of the given MAC-address. Unchanged entries are only journaled again when their last-seen
+        time is older than the touch interval. Start compaction when too many entries are held in memory.
+
+        @param   mac (str)           The MAC-address.
+        @param   deviceclass (int)   The deviceclass.
+        @param   timestamp (int)     The last-seen UNIX timestamp. Use the current time when None.
+        """
+        key = self.__key(mac)
+        if key == None:
+            return
+
+        now = int(time.time()) if timestamp == None else int(timestamp)
+        entry = self.__lookup(key)
+        if entry != None and entry[0] == deviceclass and (now - entry[1]) < self.touchInterval:
+            return
+
+        try:
+            self.journal_buffer.append(MacStore.record.pack(key >> 32, key & 0xffffffff, deviceclass, now))
+        except struct.error:
+            return
+        self.recent.set(key, deviceclass, now)
+
+        if len(self.recent) >= self.maxRecent:
+            self.compact()
+
+    def __openIndex(self):
+        """
+        (Re)open and memory map the index file.
+        """
+        if self.index != None:
+            self.index.close()
+            self.index_file.close()
+            self.index = None
+            self.index_file = None
+        self.index_count = 0
+
+        if not os.path.isfile(self.index_path) or os.path.getsize(self.index_path) < MacStore.header.size:
+            return
+
+        f = open(self.index_path, 'rb')
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count = MacStore.header.unpack_from(m, 0)
+        if magic != MacStore.magic or version != MacStore.version or \
+            (MacStore.header.size + count * MacStore.record.size) > len(m):
+            self.server.logger.logError("Invalid MAC-address store index, ignoring '%s'" % self.index_path)
+            m.close()
+            f.close()
+        else:
+            self.index_file = f
+            self.index = m
+            self.index_count = count
+
+    def __iterIndex(self):
+        """
+        Iterate over the records in the index, in order.
+
+        @return   (generator)   Yields tuples of key, deviceclass and last-seen timestamp.
+        """
+        if self.index == None:
+            return
+
+        size = MacStore.record.size
+        offset = MacStore.header.size
+        for i in xrange(self.index_count):
+            high, low, dc, seen = MacStore.record.unpack_from(self.index, offset + i * size)
+            yield ((high << 32) | low, dc, seen)
+
+    def __replayJournal(self, path):
+        """
+        Read the journal at the given path into the recent entries. Trailing partial records, f.ex. after a crash,
+        are truncated.
+
+        @param   path (str)   Path of the journal file.
+        """
+        if not os.path.isfile(path):
+            return
+
+        size = MacStore.record.size
+        valid = os.path.getsize(path) - (os.path.getsize(path) % size)
+        f = open(path, 'r+b')
+        try:
+            while True:
+                data = f.read(size * 4096)
+                if len(data) < size:
+                    break
+                for position in xrange(0, len(data) - (len(data) % size), size):
+                    high, low, dc, seen = MacStore.record.unpack_from(data, position)
+                    self.recent.set((high << 32) | low, dc, seen)
+            f.truncate(valid)
+        finally:
+            f.close()
+
+    def __writeJournal(self):
+        """
+        Write the buffered journal records to the journal file.
+        """
+        if len(self.journal_buffer) > 0:
+            self.journal.write(''.join(self.journal_buffer))
+            self.journal_buffer = []
+            self.journal.flush()
+
+    def __rotateJournal(self):
+        """
+        Move the current journal aside, to be removed when compaction finishes, and start a new one.
+        """
+        self.__writeJournal()
+        self.journal.close()
+
+        if os.path.isfile(self.journal_old_path):
+            # Left over from an interrupted compaction: its entries are still in memory and are compacted now too.
+            f = open(self.journal_path, 'rb')
+            old = open(self.journal_old_path, 'ab')
+            old.write(f.read())
+            old.close()
+            f.close()
+            os.remove(self.journal_path)
+        else:
+            os.rename(self.journal_path, self.journal_old_path)
+
+        self.journal = open(self.journal_path, 'ab')
+
+    def flush(self):
+        """
+        Write the journal to disk. Called automatically by the flush loop. Start compaction when the journal grows too
+        large.
+        """
+        self.__writeJournal()
+        if self.journal.tell() > self.maxJournalSize:
+            self.compact()
+
+    def compact(self):
+        """
+        Compact the journal into the index, in a separate thread. Called automatically by the compaction loop.
+        Entries that have not been seen for longer than the maximum age are removed.
+        """
+        if self.compacting != None:
+            return
+
+        self.__rotateJournal()
+        self.compacting = self.recent
+        self.recent = MacTable()
+
+        cutoff = (int(time.time()) - self.maxAge) if self.maxAge else None
+        d = threads.deferToThread(self.__merge, self.compacting, cutoff, self.maxEntries)
+        d.addCallbacks(self.__compacted, self.__compactFailed)
+
+    def __merge(self, entries, cutoff, maxEntries):
+        """
+        Merge the given entries with the index into a new index file. Runs in a separate thread.
+
+        @param    entries (MacTable)   The entries to merge.
+        @param    cutoff (int)         Entries last seen before this UNIX timestamp are removed. None to keep all.
+        @param    maxEntries (int)     Maximum number of entries to keep, removing the least recently seen ones at a
+                                         resolution of one day. None for no limit.
+        @return   (int)                The number of records in the new index.
+        """
+        def merged():
+            old = self.__iterIndex()
+            new = iter(sorted(entries))
+            o = next(old, None)
+            n = next(new, None)
+            while o != None or n != None:
+                if n == None or (o != None and o[0] < n):
+                    yield o
+                    o = next(old, None)
+                else:
+                    if o != None and o[0] == n:
+                        o = next(old, None)
+                    yield (n,) + entries.get(n)
+                    n = next(new, None)
+
+        if maxEntries != None:
+            days = {}
+            for key, dc, seen in merged():
+                if cutoff == None or seen >= cutoff:
+                    days[seen // 86400] = days.get(seen // 86400, 0) + 1
+            count = 0
+            for day in sorted(days, reverse=True):
+                if count + days[day] > maxEntries:
+                    # Always keep the most recent day.
+                    cutoff = max(cutoff, ((day + 1) if count > 0 else day) * 86400)
+                    break
+                count += days[day]
+
+        path = self.index_path + '.new'
+        f = open(path, 'wb')
+        f.write(MacStore.header.pack(MacStore.magic, MacStore.version, 0))
+
+        count = 0
+        buffer = []
+        for key, dc, seen in merged():
+            if cutoff != None and seen < cutoff:
+                continue
+            buffer.append(MacStore.record.pack(key >> 32, key & 0xffffffff, dc, seen))
+            count += 1
+            if len(buffer) >= 4096:
+                f.write(''.join(buffer))
+                buffer = []
+        f.write(''.join(buffer))
+
+        f.seek(0)
+        f.write(MacStore.header.pack(MacStore.magic, MacStore.version, count))
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(path, self.index_path)
+        return count
+
+    def __compacted(self, count):
+        """
+        Called when compaction finished. Switch to the new index and remove the compacted journal.
+        """
+        self.__openIndex()
+        self.compacting = None
+        if os.path.isfile(self.journal_old_path):
+            os.remove(self.journal_old_path)
+        self.server.logger.logInfo("Compacted MAC-address store: %i entries" % count)
+
+    def __compactFailed(self, failure):
+        """
+        Called when compaction failed. Keep the entries in memory, they remain in the old journal on disk.
+        """
+        self.server.logger.logError("Failed to compact MAC-address store: %s" % failure.getErrorMessage())
+        for key in self.compacting:
+            if self.recent.get(key) == None:
+                self.recent.set(key, *self.compacting.get(key))
+        self.compacting = None
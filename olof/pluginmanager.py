@@ -7,17 +7,75 @@
 
 """
 Module that handles the loading, unloading and dynamically reloading of plugins.
+
+Plugins are loaded in two phases. First the plugin is registered: its module is imported and the plugin initialised.
+Afterwards the plugin is warmed up in a separate thread; the warm-ups of all plugins run concurrently. Until the warm-up
+has finished, data for the plugin is buffered by a PluginGate.
+
+Reloading a plugin swaps the running instance for a new one. Data is buffered from the moment the swap starts until the
+new instance is warmed up, so no data is lost.
 """
 
+from twisted.internet import reactor, threads
+
 import imp
 import os
 import pyinotify
-import random
 import sys
+import time
 import traceback
 
 from olof.tools.inotifier import INotifier
 
+class PluginGate(object):
+    """
+    Class that stands in for a plugin that is not ready to receive data. Calls of the data feed methods are buffered to
+    be passed on in order when the gate is opened, all other attributes are those of the plugin itself.
+    """
+    feeds = frozenset(['uptime', 'connectionMade', 'connectionLost', 'locationUpdate', 'stateFeed', 'sysStateFeed',
+        'infoFeed', 'dataFeedCell', 'dataFeedBluetoothRaw', 'dataFeedWifiRaw', 'dataFeedWifiDevRaw', 'dataFeedWifiIO',
+        'rawProtoFeed'])
+
+    def __init__(self, plugin):
+        """
+        Initialisation.
+
+        @param   plugin (olof.core.Plugin)   The plugin to stand in for.
+        """
+        self.plugin = plugin
+        self.buffer = []
+
+    def __getattr__(self, name):
+        if name in PluginGate.feeds:
+            def buffer(*args, **kwargs):
+                self.buffer.append((name, args, kwargs))
+            return buffer
+        return getattr(self.plugin, name)
+
+    def getStatus(self):
+        """
+        Report the plugin is not ready yet. For use in the status plugin.
+        """
+        return [{'status': 'disabled'}, {'id': 'warming up'}, {'id': 'buffered', 'int': len(self.buffer)}]
+
+    def open(self, plugin=None):
+        """
+        Open the gate, passing the buffered calls on to the plugin.
+
+        @param    plugin (olof.core.Plugin)   The plugin to pass the buffered calls to. Defaults to the plugin this gate
+                                                stands in for.
+        @return   (int)                       The number of buffered calls.
+        """
+        plugin = plugin if plugin != None else self.plugin
+        buffer = self.buffer
+        self.buffer = []
+        for name, args, kwargs in buffer:
+            try:
+                getattr(plugin, name)(*args, **kwargs)
+            except Exception as e:
+                plugin.logger.logException(e)
+        return len(buffer)
+
 class PluginManager(object):
     """
     Class that represents the plugin manager.
@@ -31,6 +89,10 @@ class PluginManager(object):
         self.server = server
 
         self.plugins = {}
+        self.gates = {}
+        self.generations = {}
+        self.startup_times = {}
+        self.swaps = {}
         self.loadAllPlugins()
 
         self.inotifier = INotifier(self.server.paths['plugins'])
@@ -42,39 +104,187 @@ class PluginManager(object):
         Process an INotify Write event, reloading plugins when applicable.
         """
         if not event.name.startswith('.') and event.name.endswith('.py') and not event.name == '__init__.py':
-            self.unloadPlugin(event.name.rstrip('.py'), dynamic=True)
-            self.loadPlugin(event.pathname, dynamic=True)
+            reactor.callFromThread(self.reloadPlugin, event.pathname)
 
     def __processINotifyDelete(self, event):
         """
         Process an INotify Delete event, unloading plugins when applicable.
         """
         if not event.name.startswith('.') and event.name.endswith('.py') and not event.name == '__init__.py':
-            self.unloadPlugin(event.name.rstrip('.py'), dynamic=True)
+            reactor.callFromThread(self.unloadPlugin, event.name[:-3], dynamic=True)
+
+    def importPlugin(self, name, path):
+        """
+        Import the module of a plugin. Each import gets a new module name, so reloaded modules do not replace the
+        previous ones.
+
+        @param    name (str)   Name of the plugin.
+        @param    path (str)   Path of the Python file of the plugin.
+        @return   (module)     The imported module.
+        """
+        self.generations[name] = self.generations.get(name, 0) + 1
+        return imp.load_source('dynamic-plugin-module-%s-%i' % (name, self.generations[name]), path)
+
+    def isLoadable(self, pluginModule, dynamic=False):
+        """
+        Check whether the plugin in the given module should be loaded.
+
+        @param    pluginModule (module)   The module of the plugin.
+        @param    dynamic (bool)          Whether the plugin is loaded dynamically, i.e. not at server start.
+        @return   (bool)                  True when the plugin is enabled and can be loaded.
+        """
+        if 'ENABLED' in pluginModule.__dict__ and pluginModule.ENABLED == False:
+            return False
+        elif dynamic and 'DYNAMIC_LOADING' in pluginModule.__dict__ and pluginModule.DYNAMIC_LOADING == False:
+            return False
+        return True
+
+    def initPlugin(self, name, pluginModule):
+        """
+        Initialise the plugin in the given module.
+
+        @param    name (str)               Name of the plugin.
+        @param    pluginModule (module)    The module of the plugin.
+        @return   (olof.core.Plugin)       The new plugin instance.
+        """
+        plugin = pluginModule.Plugin(self.server, name)
+        plugin.dynamicLoading = not ('DYNAMIC_LOADING' in pluginModule.__dict__ and \
+            pluginModule.DYNAMIC_LOADING == False)
+        return plugin
 
     def loadPlugin(self, path, dynamic=False):
         """
-        Load a plugin.
+        Load a plugin. Registers the plugin and starts its warm-up.
 
         @param   path (str)   Path of the Python file of the plugin.
         """
         name = os.path.basename(path)[:-3]
+        start = time.time()
         try:
-            r = str(random.random())
-            pluginModule = imp.load_source('dynamic-plugin-module-' + r[r.find('.')+1:], path)
-            if 'ENABLED' in pluginModule.__dict__ and pluginModule.ENABLED == False:
-                return
-            elif dynamic and 'DYNAMIC_LOADING' in pluginModule.__dict__ and pluginModule.DYNAMIC_LOADING == False:
+            pluginModule = self.importPlugin(name, path)
+            if not self.isLoadable(pluginModule, dynamic):
                 return
-            else:
-                plugin = pluginModule.Plugin(self.server, name)
-                plugin.dynamicLoading = not ('DYNAMIC_LOADING' in pluginModule.__dict__ and \
-                    pluginModule.DYNAMIC_LOADING == False)
+            plugin = self.initPlugin(name, pluginModule)
         except Exception as e:
             self.server.logger.logException(e, "Failed to load plugin %s" % name)
         else:
             self.server.logger.logInfo("Loaded plugin: %s" % name)
             self.plugins[name] = plugin
+            self.gates[name] = PluginGate(plugin)
+            self.startup_times[name] = [time.time() - start, None]
+            self.warmupPlugin(name, plugin)
+
+    def reloadPlugin(self, path):
+        """
+        Reload a plugin, swapping the running instance for a new one.
+
+        Data for the plugin is buffered from now on. When the new module imports correctly, the state of the running
+        instance is exported and the instance unloaded. The new instance is initialised, imports the state and is
+        warmed up. Then the buffered data is passed to the new instance.
+
+        When the plugin is not loaded yet, it is loaded. Plugins that disable dynamic loading are left alone.
+
+        @param   path (str)   Path of the Python file of the plugin.
+        """
+        name = os.path.basename(path)[:-3]
+        old = self.getPlugin(name)
+        if old == None:
+            self.loadPlugin(path, dynamic=True)
+            return
+        elif not old.dynamicLoading:
+            return
+
+        start = time.time()
+        if not name in self.gates:
+            self.gates[name] = PluginGate(old)
+        gate = self.gates[name]
+
+        try:
+            pluginModule = self.importPlugin(name, path)
+        except Exception as e:
+            self.server.logger.logException(e, "Failed to reload plugin %s, keeping the running instance" % name)
+            if old.warmedUp:
+                self.gates.pop(name).open()
+            return
+
+        state = None
+        try:
+            state = old.exportState()
+        except Exception as e:
+            self.server.logger.logException(e, "Failed to export state of plugin %s" % name)
+
+        self.server.logger.logInfo('Unloaded plugin: %s' % name)
+        old.unload()
+        del(self.plugins[name])
+        del(sys.modules[old.__module__])
+
+        if not self.isLoadable(pluginModule, dynamic=True):
+            del(self.gates[name])
+            return
+
+        try:
+            plugin = self.initPlugin(name, pluginModule)
+            plugin.importState(state)
+        except Exception as e:
+            self.server.logger.logException(e, "Failed to load plugin %s" % name)
+            self.server.logger.logError("Dropped %i buffered calls for plugin %s" % (len(gate.buffer), name))
+            del(self.gates[name])
+            return
+
+        self.server.logger.logInfo("Loaded plugin: %s" % name)
+        gate.plugin = plugin
+        self.plugins[name] = plugin
+        self.startup_times[name] = [time.time() - start, None]
+        self.swaps[name] = start
+        self.warmupPlugin(name, plugin)
+
+    def warmupPlugin(self, name, plugin):
+        """
+        Warm up the given plugin in a separate thread. Activate the plugin and pass on the buffered data when done.
+
+        @param   name (str)                  Name of the plugin.
+        @param   plugin (olof.core.Plugin)   The plugin to warm up.
+        """
+        def run():
+            start = time.time()
+            plugin.warmup()
+            return time.time() - start
+
+        def finished(duration):
+            if self.plugins.get(name, None) is not plugin:
+                # Unloaded in the meantime.
+                return
+            plugin.warmedUp = True
+            try:
+                plugin.activate()
+            except Exception as e:
+                self.server.logger.logException(e, "Failed to activate plugin %s" % name)
+            buffered = self.gates.pop(name).open()
+            self.startup_times[name][1] = duration
+            if name in self.swaps:
+                self.server.logger.logInfo("Plugin %s reloaded: swapped in %0.3f s, %i buffered" % (
+                    name, time.time() - self.swaps.pop(name), buffered))
+            else:
+                self.server.logger.logInfo("Plugin %s ready: registered in %0.3f s, warmed up in %0.3f s, %i buffered" % (
+                    name, self.startup_times[name][0], duration, buffered))
+                if len(self.gates) == 0:
+                    self.logStartupTimes()
+
+        def failed(failure):
+            self.server.logger.logError("Failed to warm up plugin %s: %s" % (name, failure.getErrorMessage()))
+            self.swaps.pop(name, None)
+            if self.plugins.get(name, None) is plugin:
+                self.unloadPlugin(name)
+
+        d = threads.deferToThread(run)
+        d.addCallbacks(finished, failed)
+
+    def logStartupTimes(self):
+        """
+        Log the startup time of all plugins, slowest first.
+        """
+        times = sorted([(sum(t), n) for n, t in self.startup_times.items() if t[1] != None], reverse=True)
+        self.server.logger.logInfo("Plugin startup times: %s" % ', '.join(["%s %0.3f s" % (n, t) for t, n in times]))
 
     def loadAllPlugins(self, dynamic=False):
         """
@@ -106,6 +316,7 @@ class PluginManager(object):
             if not (dynamic and not p.dynamicLoading):
                 self.server.logger.logInfo('Unloaded plugin: %s' % p.filename)
                 p.unload(shutdown)
+                self.gates.pop(p.filename, None)
                 del(p)
 
     def unloadPlugin(self, name, dynamic=False):
@@ -120,11 +331,12 @@ class PluginManager(object):
             self.server.logger.logInfo('Unloaded plugin: %s' % p.filename)
             p.unload()
             del(self.plugins[name])
+            self.gates.pop(name, None)
             del(sys.modules[p.__module__])
 
     def getPlugin(self, name):
         """
-        Get the plugin with the given name.
+        Get the plugin with the given name. This is the plugin itself, even when it is not warmed up yet.
 
         @param    name (str)           Name of the plugin. This is the filename, without the trailing '.py'.
         @return   (olof.core.Plugin)   The Plugin with given name, None if none exists with such a name.
@@ -133,8 +345,9 @@ class PluginManager(object):
 
     def getPlugins(self):
         """
-        Get a list of all loaded plugins.
+        Get a list of all loaded plugins. Plugins that are not warmed up yet are represented by their PluginGate, to be
+        used when passing data.
 
         @return   (list(olof.core.Plugin))   A List of all loaded plugins
         """
-        return self.plugins.values()
+        return [self.gates.get(name, plugin) for name, plugin in self.plugins.items()]
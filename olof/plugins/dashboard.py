@@ -30,6 +30,7 @@ import time
 
 import olof.configuration
 import olof.core
+import olof.plugins.dashboard.macvendor as macvendor
 import olof.storagemanager
 import olof.tools.validation
 
@@ -117,6 +118,17 @@ class ContentResource(resource.Resource):
                 self.plugin.diskfree_mb) + ' MB')
             html += '</div>'
 
+        # Duplicates
+        dedup = self.plugin.server.dedup
+        if dedup != None and dedup.suppressed > 0:
+            html += '<div class="block_data">'
+            html += '<img alt="" src="/dashboard/static/icons/union.png">Duplicates'
+            html += '<span class="block_data_attr"><b>suppressed</b> %s</span>' % formatNumber(dedup.suppressed)
+            html += '<span class="block_data_attr"><b>false positive rate</b> ' + \
+                '<span title="Estimated chance a new message is wrongly considered a duplicate">%0.4f%%</span>' % (
+                dedup.getErrorRate() * 100) + '</span>'
+            html += '</div>'
+
         # Plugins
         for p in plugins:
             html += '<div class="block_data">'
@@ -355,8 +367,7 @@ class Plugin(olof.core.Plugin):
     """
     def __init__(self, server, filename):
         """
-        Initialisation. Read saved data from disk, start looping calls that check system resources and read SIM card
-        data and serve the dashboard webpage.
+        Initialisation. Set up the dashboard webpage resources.
 
         @param   server (Olof)   Reference to the main Olof server instance.
         """
@@ -378,11 +389,7 @@ class Plugin(olof.core.Plugin):
 
         status_resource.putChild("static", StaticResource(self.base_path + "/static/"))
 
-        self.scanners = self.storage.loadObject('scanners', {})
-        for s in self.scanners.values():
-            s.init(self)
-            for sens in s.sensors.values():
-                sens.init()
+        self.scanners = {}
 
         try:
             import multiprocessing
@@ -391,11 +398,27 @@ class Plugin(olof.core.Plugin):
             self.cpuCount = 1
 
         self.connectionLagProcessing = True
+        self.checkResourcesCall = task.LoopingCall(self.checkResources)
+
+    def warmup(self):
+        """
+        Read saved scanner data and the MAC-address vendor list from disk.
+        """
+        self.scanners = self.storage.loadObject('scanners', {})
+        macvendor.load()
+
+    def activate(self):
+        """
+        Start looping calls that check system resources and read SIM card data and serve the dashboard webpage.
+        """
+        for s in self.scanners.values():
+            s.init(self)
+            for sens in s.sensors.values():
+                sens.init()
 
         self.parseMVNumbers()
         self.updateConnectionLagConfig()
 
-        self.checkResourcesCall = task.LoopingCall(self.checkResources)
         self.checkResourcesCall.start(10)
 
         reactor.callLater(2, self.startListening)
@@ -595,10 +618,11 @@ class Plugin(olof.core.Plugin):
         if 'listeningPort' in self.__dict__:
             self.listeningPort.stopListening()
 
-        for s in self.scanners.values():
-            s.unload(shutdown)
+        if self.warmedUp:
+            for s in self.scanners.values():
+                s.unload(shutdown)
 
-        self.storage.storeObject(self.scanners, 'scanners')
+            self.storage.storeObject(self.scanners, 'scanners')
 
     def getScanner(self, hostname, create=True):
         """
@@ -14,15 +14,19 @@ Source of information (oui.txt):
 
 import gzip
 import os
+import threading
 
 VENDOR_MAC = {}
 
+_lock = threading.Lock()
+
 def _parseOui(url):
     """
     Parse the file populating the VENDOR_MAC dictionary.
 
     @param  url   URL of the file to parse.
     """
+    vendors = {}
     if url.endswith('.gz'):
         file = gzip.GzipFile(url, 'r')
     else:
@@ -30,8 +34,23 @@ def _parseOui(url):
     for line in file:
         if not line.startswith('#'):
             ls = line.split('\t')
-            VENDOR_MAC [ls[0]] = ls[1].strip('\n')
+            vendors[ls[0]] = ls[1].strip('\n')
     file.close()
+    VENDOR_MAC.update(vendors)
+
+def load():
+    """
+    Parse the oui file, when not done already. Called automatically on the first lookup.
+    """
+    with _lock:
+        if len(VENDOR_MAC) > 0:
+            return
+        try:
+            __dir__ = os.path.dirname(os.path.abspath(__file__))
+            filepath = os.path.join(__dir__, 'oui_data.txt')
+            _parseOui(filepath)
+        except IOError:
+            _parseOui('/usr/share/gyrid/oui_data.txt.gz')
 
 def getVendor(macAddress):
     """
@@ -39,12 +58,6 @@ def getVendor(macAddress):
 
     @param  macAddress  The mac address of the device.
     """
+    if len(VENDOR_MAC) == 0:
+        load()
     return VENDOR_MAC.get(macAddress[:6].upper(), None)
-
-#Parse the oui file on importing
-try:
-    __dir__ = os.path.dirname(os.path.abspath(__file__))
-    filepath = os.path.join(__dir__, 'oui_data.txt')
-    _parseOui(filepath)
-except IOError:
-    _parseOui('/usr/share/gyrid/oui_data.txt.gz')
@@ -15,6 +15,10 @@ from twisted.internet import reactor, ssl, task
 from twisted.internet.protocol import ReconnectingClientFactory
 from twisted.protocols.basic import Int16StringReceiver
 
+import collections
+import glob
+import heapq
+import itertools
 import os
 import binascii
 import struct
@@ -24,6 +28,9 @@ import zlib
 
 import olof.configuration
 import olof.core
+import olof.plugins.gismosi.compression as compression
+import olof.plugins.gismosi.diskcache as diskcache
+import olof.plugins.gismosi.hashring as hashring
 import olof.protocol.network as proto
 import olof.storagemanager
 
@@ -31,57 +38,50 @@ class AckItem(object):
     """
     Class that defines an item in the AckMap.
     """
-
-    # The maximum value of the timer after which the item is resent.
-    max_misses = 5
-
-    def __init__(self, msg, timer=0):
+    def __init__(self, msg, data=None):
         """
         Initialisation.
 
         @param   msg      The msg to store.
-        @param   timer    The initial value of the timer. An item is resent
-                             when this value is negative or exceeds
-                             AckItem.max_misses.
+        @param   data     The data as sent, when different from the serialised message. Optional.
         """
         self.ackmap = None
+        self.seq = None
         self.msg = msg
-        self.timer = timer
-        self.checksum = AckMap.checksum(msg.SerializeToString())
-
-    def __eq__(self, item):
-        return (item.msg == self.msg and
-                item.checksum == self.checksum)
-
-    def __hash__(self):
-        return int(self.checksum, 16)
-
-    def incrementTimer(self):
+        self.count = len(msg.batch) if msg.type == msg.Type_BATCH else 1
+        self.segments = []
+        self.attempts = 0
+        self.sent = None
+        self.deadline = None
+        self.checksum = AckMap.checksum(data if data != None else msg.SerializeToString())
+
+    def resend(self):
         """
-        Increment the timer by a value of 1.
-        """
-        if self.timer >= 0:
-            self.timer += 1
-
-    def checkResend(self):
-        """
-        Check if the data should be resent, and do so when required.
+        Resend the data, marked as cached.
         """
         if self.ackmap != None:
-            if self.timer > 10 * AckItem.max_misses:
-                # Protection against cache overflow when a line repeatedly fails to be ack'ed.
-                self.ackmap.clearItem(self.checksum)
-
-            elif self.timer < 0 or (self.timer % AckItem.max_misses == 0):
-                self.msg.cached = True
-                self.checksum = AckMap.checksum(self.msg.SerializeToString())
-                client = self.ackmap.factory.client
-                if client != None:
-                    client.sendMsg(self.msg, await_ack=False)
+            self.attempts += 1
+            self.msg.cached = True
+            for m in self.msg.batch:
+                m.cached = True
+            client = self.ackmap.factory.client
+            data = client.encode(self.msg) if client != None else self.msg.SerializeToString()
+            self.ackmap.updateChecksum(self, AckMap.checksum(data))
+            if client != None:
+                client.sendFrame(data)
 
 class AckMap(object):
     """
     Class that stores the temporary cache, waiting for ack'ing by the server.
+
+    Items are stored by checksum, each checksum mapping to the items with that checksum in the order they were added,
+    as the same data can be sent more than once. Each ACK clears the oldest of them. Next to that, all items are kept in
+    the order they were added.
+
+    Each item has a deadline for being ack'ed, kept in a heap. When the deadline passes the item is resent, with a new
+    deadline that doubles with each attempt up to a maximum. Items that are not ack'ed after the maximum number of
+    attempts are dropped, as protection against cache overflow. The checker only touches items that are due, and
+    resends at most the configured number of items per second.
     """
     @staticmethod
     def checksum(data):
@@ -101,16 +101,49 @@ class AckMap(object):
         @param   factory   Refence to InetClientFactory instance.
         """
         self.factory = factory
-        self.ackmap = set()
-        self.toAdd = set()
-        self.toClear = set()
-        self.lock = threading.Lock()
-
+        self.ackmap = {}
+        self.order = collections.OrderedDict()
+        self.seq = itertools.count()
+        self.lock = threading.RLock()
+        self.heap = []
+        self.resent = 0
+        self.expired = 0
+
+        self.interval = 1
         self.check_loop = task.LoopingCall(self.__check)
 
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        """
+        Iterate over all items, in the order they were added.
+        """
+        return iter(self.order.values())
+
+    def getTimeout(self, attempts):
+        """
+        Get the time to wait for an ACK after the given number of attempts.
+
+        @param   attempts (int)   The number of times the item has been resent.
+        @return  (float)          The timeout in seconds.
+        """
+        config = self.factory.plugin.config
+        return min(config.getValue('ack_timeout') * 2 ** attempts, config.getValue('ack_max_timeout'))
+
+    def schedule(self, ackItem, now):
+        """
+        Set the deadline of the given item based on its number of attempts.
+
+        @param   ackItem (AckItem)   The item to schedule.
+        @param   now (float)         The current time.
+        """
+        ackItem.deadline = now + self.getTimeout(ackItem.attempts)
+        heapq.heappush(self.heap, (ackItem.deadline, ackItem.seq))
+
     def restartChecker(self):
         """
-        Start or restart the checker loop based on the current keepalive interval.
+        Start or restart the checker loop.
         """
         self.stopChecker()
         self.startChecker()
@@ -119,9 +152,6 @@ class AckMap(object):
         """
         Start the checker loop.
         """
-        interval = self.factory.config['enable_keepalive']
-        self.interval = interval if interval > 0 else 60
-
         try:
             self.check_loop.start(self.interval, now=False)
         except AssertionError:
@@ -140,87 +170,251 @@ class AckMap(object):
         """
         Add an item to the map.
         """
-        self.factory.plugin.cached_msgs += 1
-        ackItem.ackmap = self
-        if not self.lock.acquire(False):
-            self.toAdd.add(ackItem)
-        else:
-            try:
-                if len(self.toAdd) > 0:
-                    #print "adding extra items to ackmap"
-                    self.ackmap.update(self.toAdd)
-                    self.toAdd.clear()
-                #print "added item %s" % ackItem.checksum
-                self.ackmap.add(ackItem)
-            finally:
-                self.lock.release()
-
-        #print "ackmap size is now %i" % len(self.ackmap)
+        self.lock.acquire()
+        try:
+            self.factory.cached_msgs += ackItem.count
+            ackItem.ackmap = self
+            ackItem.seq = self.seq.next()
+            ackItem.sent = time.time()
+            self.order[ackItem.seq] = ackItem
+            self.ackmap.setdefault(ackItem.checksum, collections.deque()).append(ackItem)
+            self.schedule(ackItem, ackItem.sent)
+        finally:
+            self.lock.release()
 
     def clearItem(self, checksum):
         """
-        Clear the item with the given checksum from the cache, i.e. when it
+        Clear the oldest item with the given checksum from the cache, i.e. when it
         has been ack'ed by the server.
 
         @param   checksum   The checksum to check.
+        @return  (AckItem)  The cleared item, None if there was none.
         """
-        #print "trying to clear item %s" % checksum
-        if not self.lock.acquire(False):
-            self.toClear.add(checksum)
-        else:
-            try:
-                item = None
-                if len(self.toClear) > 0:
-                    toClear = set()
-                    for i in self.ackmap:
-                        if i.checksum == checksum or \
-                           i.checksum in self.toClear:
-                           toClear.add(i)
-                    self.factory.plugin.cached_msgs -= len(toClear)
-                    #print "clearing extra items"
-                    self.ackmap.difference_update(toClear)
-                    self.toClear.clear()
-                else:
-                    for i in self.ackmap:
-                        if i.checksum == checksum:
-                            item = i
-                            break
+        self.lock.acquire()
+        try:
+            items = self.ackmap.get(checksum)
+            if items:
+                item = items.popleft()
+                self.__remove(item)
+                return item
+        finally:
+            self.lock.release()
+
+    def removeItem(self, ackItem):
+        """
+        Remove the given item from the cache, without it being ack'ed.
+
+        @param   ackItem (AckItem)   The item to remove.
+        """
+        self.lock.acquire()
+        try:
+            items = self.ackmap.get(ackItem.checksum)
+            if items and ackItem in items:
+                items.remove(ackItem)
+                self.__remove(ackItem)
+        finally:
+            self.lock.release()
+
+    def updateChecksum(self, ackItem, checksum):
+        """
+        Change the checksum of the given item, f.ex. because the message has been changed before resending.
 
-                    if item != None:
-                        self.factory.plugin.cached_msgs -= 1
-                        self.ackmap.difference_update([item])
-                        #print "cleared item %s" % item.checksum
-            finally:
-                self.lock.release()
+        @param   ackItem (AckItem)   The item to update.
+        @param   checksum (str)      The new checksum.
+        """
+        self.lock.acquire()
+        try:
+            items = self.ackmap.get(ackItem.checksum)
+            if items and ackItem in items:
+                items.remove(ackItem)
+                if len(items) == 0:
+                    del(self.ackmap[ackItem.checksum])
+                self.ackmap.setdefault(checksum, collections.deque()).append(ackItem)
+            ackItem.checksum = checksum
+        finally:
+            self.lock.release()
+
+    def __remove(self, ackItem):
+        """
+        Remove the given item, that has already been taken from its checksum list, from the map.
 
-        #print "ackmap size is now %i" % len(self.ackmap)
+        @param   ackItem (AckItem)   The item to remove.
+        """
+        if len(self.ackmap.get(ackItem.checksum, ())) == 0:
+            self.ackmap.pop(ackItem.checksum, None)
+        if self.order.pop(ackItem.seq, None) != None:
+            self.factory.cached_msgs -= ackItem.count
+            for segment in ackItem.segments:
+                self.factory.cache.release(segment)
 
     def clear(self):
         """
         Clear the entire map.
         """
         # No locking here, caller should use locking.
-        #print "clearing ackmap"
         self.ackmap.clear()
-        #print "ackmap size is now %i" % len(self.ackmap)
+        self.order.clear()
+        self.heap = []
 
     def __check(self):
         """
         Called automatically by the checker loop; should not be called
-        directly. Checks each item in the map and resends when necessary.
+        directly. Resends the items that are due, up to the resend rate.
         """
+        now = time.time()
+        budget = max(1, int(self.factory.plugin.config.getValue('resend_rate') * self.interval))
+        maxAttempts = self.factory.plugin.config.getValue('ack_max_attempts')
+        resent = self.resent
+
         self.lock.acquire()
         try:
-            for v in self.ackmap:
-                v.incrementTimer()
-                v.checkResend()
+            while len(self.heap) > 0 and self.heap[0][0] <= now:
+                deadline, seq = self.heap[0]
+                item = self.order.get(seq)
+                if item == None or item.deadline != deadline:
+                    # Ack'ed or rescheduled in the meantime.
+                    heapq.heappop(self.heap)
+                    continue
+
+                if budget == 0:
+                    break
+
+                heapq.heappop(self.heap)
+                if item.attempts >= maxAttempts:
+                    self.removeItem(item)
+                    self.expired += 1
+                else:
+                    item.resend()
+                    self.resent += 1
+                    budget -= 1
+                    self.schedule(item, now)
         finally:
             self.lock.release()
 
+        if self.resent > resent:
+            self.factory.flow.timeout()
+
+class FlowControl(object):
+    """
+    Class that limits the number of messages awaiting an ACK from the server, i.e. the window. Messages that do not fit
+    in the window are queued, when the queue is full they are written to the disk cache.
+
+    When enabled, the window adapts to the round trip time of the ACKs: it grows by about one message per round trip
+    as long as the round trip time stays close to the lowest one measured, and shrinks when it rises, indicating the
+    server or the link can't keep up. It is halved when messages have to be resent.
+
+    A batch counts as a single message in the window.
+    """
+    min_window = 10
+
+    def __init__(self, plugin):
+        """
+        Initialisation.
+
+        @param   plugin (olof.core.Plugin)   Reference to the main Db4O Plugin instance.
+        """
+        self.plugin = plugin
+        self.pending = collections.deque()
+        self.window = float(max(FlowControl.min_window, min(100, self.plugin.config.getValue('send_window'))))
+        self.srtt = None
+        self.min_rtt = None
+        self.last_decrease = 0
+        self.throughput = 0
+        self.second = int(time.time())
+        self.acked = 0
+
+    def getWindow(self):
+        """
+        Get the current window.
+
+        @return  (int)   The maximum number of messages awaiting an ACK.
+        """
+        if self.plugin.config.getValue('adaptive_window'):
+            return int(self.window)
+        return self.plugin.config.getValue('send_window')
+
+    def updateThroughput(self, now):
+        """
+        Update the throughput, an exponential moving average of the number of ACKs per second.
+
+        @param   now (float)   The current time.
+        """
+        second = int(now)
+        if second > self.second:
+            self.throughput = 0.8 * self.throughput + 0.2 * self.acked
+            self.throughput *= 0.8 ** min(second - self.second - 1, 100)
+            self.second = second
+            self.acked = 0
+
+    def ack(self, rtt=None, count=1):
+        """
+        Register an ACK.
+
+        @param   rtt (float)   The round trip time of the message, None when it has been resent.
+        @param   count (int)   The number of messages ack'ed, more than one for a batch. Defaults to 1.
+        """
+        now = time.time()
+        self.updateThroughput(now)
+        self.acked += count
+        if rtt == None:
+            return
+
+        self.srtt = rtt if self.srtt == None else 0.875 * self.srtt + 0.125 * rtt
+        self.min_rtt = rtt if self.min_rtt == None else min(self.min_rtt, rtt)
+
+        maxWindow = self.plugin.config.getValue('send_window')
+        if rtt > 2 * self.min_rtt:
+            if now - self.last_decrease > self.srtt:
+                self.window = max(FlowControl.min_window, self.window * 0.75)
+                self.last_decrease = now
+        else:
+            self.window = min(maxWindow, self.window + 1.0 / self.window)
+
+    def timeout(self):
+        """
+        Register that messages had to be resent.
+        """
+        self.window = max(FlowControl.min_window, self.window / 2)
+
 class Db4OClient(Int16StringReceiver):
     """
     The class handling the connection with the Db4O server.
+
+    When enabled, the client asks the server to accept batches after connecting. When the server agrees, messages are
+    collected and sent in batches, each ack'ed as a whole, optionally compressed and optionally using frames with a
+    32-bit length prefix. Otherwise messages are sent one by one.
     """
+    negotiation_timeout = 10
+    max_frame_size = 16777216
+
+    @staticmethod
+    def pack(msgs):
+        """
+        Pack the given messages in a batch.
+
+        @param   msgs (list)    List of messages (proto.Msg).
+        @return  (proto.Msg)    The batch, or the message itself when there is only one.
+        """
+        if len(msgs) == 1:
+            return msgs[0]
+        m = proto.Msg()
+        m.type = m.Type_BATCH
+        for msg in msgs:
+            m.batch.add().CopyFrom(msg)
+        return m
+
+    @staticmethod
+    def unpack(msg):
+        """
+        Get the messages in the given batch.
+
+        @param   msg (proto.Msg)   A batch or a single message.
+        @return  (list)            List of messages (proto.Msg).
+        """
+        if msg.type == msg.Type_BATCH:
+            return list(msg.batch)
+        return [msg]
+
     def __init__(self, factory, plugin):
         """
         Initialisation.
@@ -231,16 +425,25 @@ class Db4OClient(Int16StringReceiver):
         self.factory = factory
         self.plugin = plugin
         self.hostport = None
-        self.cachedItemsAck = None
+        self.readingCache = False
+
+        self.negotiating = False
+        self.negotiation_call = None
+        self.batch_size = 1
+        self.compress = False
+        self.batch = []
+        self.batch_bytes = 0
+        self.linger_call = None
 
     def connectionMade(self):
         """
-        Push through the cache.
+        Ask for batches, or push through the cache right away.
         """
-        self.plugin.connected = True
-        self.plugin.conn_time = int(time.time())
+        self.factory.connected = True
+        self.factory.conn_time = int(time.time())
         self.hostport = (self.transport.getPeer().host, self.transport.getPeer().port)
         self.plugin.logger.logInfo("Connected to %s:%i." % (self.hostport[0], self.hostport[1]))
+        self.factory.ackmap.startChecker()
         #for i in range(10):
         #    m = proto.Msg()
         #    m.type = m.Type_BLUETOOTH_DATARAW
@@ -252,43 +455,244 @@ class Db4OClient(Int16StringReceiver):
         #    d.rssi = -80
         #    m.hostname = "helloworld"
         #    self.sendMsg(m)
-        self.pushCache()
+        if self.plugin.config.getValue('batch_size') > 1:
+            self.requestBatch()
+        else:
+            self.pushCache()
 
     def connectionLost(self, reason):
         """
-        Open the cache.
+        Write messages awaiting an ACK and queued messages to the cache, unless the factory has been closed already.
         """
-        self.plugin.connected = False
-        self.plugin.conn_time = int(time.time())
+        self.factory.connected = False
+        self.factory.conn_time = int(time.time())
         self.plugin.logger.logInfo("Disconnected from %s:%i." % (self.hostport[0], self.hostport[1]))
-        if not self.plugin.cache.closed:
-            self.plugin.cache.flush()
-            self.plugin.cache.close()
-        self.plugin.cache = open(self.plugin.cache_file, 'ab')
+        self.factory.ackmap.stopChecker()
+        self.readingCache = False
+        self.negotiating = False
+        if not self.factory.closed:
+            self.cacheUnsent()
+
+    def cacheUnsent(self):
+        """
+        Write messages awaiting an ACK, queued messages and the current batch to the cache.
+        """
+        for call in [self.negotiation_call, self.linger_call]:
+            if call != None and call.active():
+                call.cancel()
         self.factory.ackmap.lock.acquire()
         try:
-            for i in self.factory.ackmap.ackmap:
-                self.plugin.cache.write(
-                    i.msg.SerializeToString() + \
-                    struct.pack('!H', i.msg.ByteSize()))
+            for i in self.factory.ackmap:
+                for m in Db4OClient.unpack(i.msg):
+                    self.factory.cache.append(m.SerializeToString())
+                for segment in i.segments:
+                    self.factory.cache.release(segment)
                 #print "written item %s to disk cache" % AckMap.checksum(i.msg.SerializeToString())
             self.factory.ackmap.clear()
         finally:
             self.factory.ackmap.lock.release()
-        self.plugin.cache.flush()
+        while len(self.factory.flow.pending) > 0:
+            self.factory.cacheMsg(self.factory.flow.pending.popleft())
+        for m in self.batch:
+            self.factory.cacheMsg(m)
+        self.batch = []
+        self.batch_bytes = 0
+        self.factory.cache.flush()
+
+    def requestBatch(self):
+        """
+        Ask the server to accept batches. Nothing else is sent until the server answers. When there is no answer in
+        time, messages are sent one by one.
+        """
+        m = proto.Msg()
+        m.type = m.Type_REQUEST_BATCH
+        m.requestBatch.maxSize = self.plugin.config.getValue('batch_size')
+        m.requestBatch.framing32 = self.plugin.config.getValue('framing') == 32
+        m.requestBatch.compression = self.plugin.config.getValue('link_compression')
+        self.negotiating = True
+        self.negotiation_call = reactor.callLater(Db4OClient.negotiation_timeout, self.negotiated)
+        Int16StringReceiver.sendString(self, m.SerializeToString())
+
+    def negotiated(self, msg=None):
+        """
+        Process the answer to the batch request and start sending.
 
-    def sendMsg(self, msg):
+        @param   msg (proto.Msg)   The answer of the server, None when the request timed out.
+        """
+        if not self.negotiating:
+            return
+        self.negotiating = False
+        if self.negotiation_call != None and self.negotiation_call.active():
+            self.negotiation_call.cancel()
+
+        if msg != None and msg.success:
+            self.batch_size = max(1, min(self.plugin.config.getValue('batch_size'), msg.requestBatch.maxSize))
+            if msg.requestBatch.framing32:
+                self.setFraming(32)
+            self.compress = msg.requestBatch.compression and self.plugin.config.getValue('link_compression')
+            self.plugin.logger.logInfo("Sending %sbatches of up to %i messages, using %i-bit framing." % (
+                'compressed ' if self.compress else '', self.batch_size, self.prefixLength * 8))
+
+            # Messages queued while waiting for the answer are sent in batches too.
+            pending = list(self.factory.flow.pending)
+            self.factory.flow.pending.clear()
+            for m in pending:
+                self.addToBatch(m)
+        else:
+            self.plugin.logger.logInfo("The server does not accept batches, sending messages one by one.")
+        self.pushCache()
+
+    def setFraming(self, bits):
+        """
+        Set the size of the length prefix of the frames.
+
+        @param   bits (int)   The size of the prefix in bits, 16 or 32.
+        """
+        if bits == 32:
+            self.structFormat = '!I'
+            self.prefixLength = 4
+            self.MAX_LENGTH = Db4OClient.max_frame_size
+        else:
+            self.structFormat = Int16StringReceiver.structFormat
+            self.prefixLength = Int16StringReceiver.prefixLength
+            self.MAX_LENGTH = Int16StringReceiver.MAX_LENGTH
+
+        # The rest of the data that has been received is parsed with the previous prefix, pause and parse it again.
+        self.pauseProducing()
+        reactor.callLater(0, self.resumeProducing)
+
+    def getMaxFrameSize(self):
+        """
+        Get the maximum size of a frame with the current framing.
+
+        @return  (int)   The maximum size in bytes.
+        """
+        return min(2 ** (8 * self.prefixLength) - 1, self.MAX_LENGTH)
+
+    def sendMsg(self, msg, await_ack=True):
+        """
+        Try to send the line to the Db4O server. When batching, add it to the current batch. When the window is full,
+        queue the line. When not connected, cache the line.
+
+        @param   msg (proto.Msg)    The message to send.
+        @param   await_ack (bool)   Add the message to the AckMap. Use False when resending, this bypasses the window.
+                                      Defaults to True.
         """
-        Try to send the line to the Db4O server. When not connected, cache the line.
+        if self.transport != None and self.factory.connected:
+            if not await_ack:
+                self.sendFrame(self.encode(msg))
+            elif self.batch_size > 1:
+                self.addToBatch(msg)
+            else:
+                self.queueMsg(msg)
+        elif not self.factory.connected:
+            self.factory.cacheMsg(msg)
+
+    def encode(self, msg):
+        """
+        Get the data to send for the given message. Batches are compressed when enabled.
+
+        @param   msg (proto.Msg)   The message to encode.
+        @return  (str)             The data to send.
+        """
+        data = msg.SerializeToString()
+        if self.compress and msg.type == msg.Type_BATCH:
+            compressed = self.plugin.link_compressor.compress(data)
+            if len(compressed) < len(data):
+                m = proto.Msg()
+                m.type = m.Type_BATCH
+                m.compressedBatch = compressed
+                data = m.SerializeToString()
+        return data
+
+    def sendFrame(self, data):
+        """
+        Send the given data to the server in a single frame. Nothing is sent while negotiating.
+
+        @param   data (str)   The data to send.
+        """
+        if not self.negotiating:
+            Int16StringReceiver.sendString(self, data)
+
+    def addToBatch(self, msg):
         """
-        if self.transport != None and self.plugin.connected:
-            self.factory.ackmap.addItem(AckItem(msg))
-            Int16StringReceiver.sendString(self, msg.SerializeToString())
-        elif not self.plugin.connected and not self.plugin.cache.closed:
-            #print "written item %s to disk cache" % AckMap.checksum(msg.SerializeToString())
-            self.plugin.cache.write(msg.SerializeToString() + struct.pack('!H', msg.ByteSize()))
-            self.plugin.cache.flush()
-            self.plugin.cached_msgs += 1
+        Add the given message to the current batch. The batch is sent when it's full, or when the linger time has
+        passed.
+
+        @param   msg (proto.Msg)   The message to add.
+        """
+        size = msg.ByteSize() + 8
+        if len(self.batch) > 0 and self.batch_bytes + size > self.getMaxFrameSize():
+            self.flushBatch()
+
+        self.batch.append(msg)
+        self.batch_bytes += size
+        if len(self.batch) >= self.batch_size:
+            self.flushBatch()
+        elif self.linger_call == None:
+            self.linger_call = reactor.callLater(self.plugin.config.getValue('batch_linger') / 1000.0,
+                self.flushBatch)
+
+    def flushBatch(self):
+        """
+        Send the current batch.
+        """
+        if self.linger_call != None:
+            if self.linger_call.active():
+                self.linger_call.cancel()
+            self.linger_call = None
+
+        if len(self.batch) > 0:
+            msg = Db4OClient.pack(self.batch)
+            self.batch = []
+            self.batch_bytes = 0
+            self.queueMsg(msg)
+
+    def queueMsg(self, msg):
+        """
+        Send the given message or batch when the window allows. Queue it otherwise, or cache it when the queue is full.
+
+        @param   msg (proto.Msg)   The message to send.
+        """
+        flow = self.factory.flow
+        if not self.negotiating and len(flow.pending) == 0 and len(self.factory.ackmap) < flow.getWindow():
+            self.transmit(msg)
+        elif len(flow.pending) < self.plugin.config.getValue('send_queue_size'):
+            flow.pending.append(msg)
+        else:
+            self.factory.cacheMsg(msg)
+
+    def transmit(self, msg, segments=None):
+        """
+        Send the given message to the server and add it to the AckMap.
+
+        @param   msg (proto.Msg)    The message to send.
+        @param   segments (list)    The segments of the disk cache the message was read from, one for each message in
+                                      a batch. Optional.
+        """
+        data = self.encode(msg)
+        item = AckItem(msg, data)
+        item.segments = segments or []
+        self.factory.ackmap.addItem(item)
+        Int16StringReceiver.sendString(self, data)
+
+    def sendPending(self):
+        """
+        Send queued messages as far as the window allows, followed by messages from the disk cache.
+        """
+        if self.negotiating or self.factory.closed:
+            return
+
+        flow = self.factory.flow
+        window = flow.getWindow()
+        while len(flow.pending) > 0 and len(self.factory.ackmap) < window:
+            self.transmit(flow.pending.popleft())
+
+        if len(flow.pending) == 0 and len(self.factory.ackmap) < window:
+            if self.readingCache:
+                self.readNextCachedItems(window - len(self.factory.ackmap))
+            elif self.factory.cache_dirty:
+                self.pushCache()
 
     def stringReceived(self, data):
         """
@@ -301,101 +705,146 @@ class Db4OClient(Int16StringReceiver):
             return
 
         if msg.type == msg.Type_ACK:
-            ack = binascii.b2a_hex(msg.ack)
-            self.factory.ackmap.clearItem(ack)
-
-            if self.cachedItemsAck:
-                self.cachedItemsAck.discard(ack)
-                if len(self.cachedItemsAck) <= 2:
-                    self.readNextCachedItems(500)
+            item = self.factory.ackmap.clearItem(binascii.b2a_hex(msg.ack))
+            if item != None:
+                self.factory.flow.ack(time.time() - item.sent if item.attempts == 0 else None, item.count)
+            self.sendPending()
+        elif msg.type == msg.Type_REQUEST_BATCH:
+            self.negotiated(msg)
 
     def readNextCachedItems(self, amount=1):
-        if self.plugin.cache.closed:
-            self.cachedItemsAck = None
-            #print "failed to read disk cache as file is closed"
-            return
-
-        for i in range(amount):
-            #print "reading cached disk item"
-            try:
-                self.plugin.cache.seek(-2, 1)
-                read = self.plugin.cache.read(2)
-                bts = struct.unpack('!H', read)[0]
-                self.plugin.cache.seek(-2-bts, 1)
-                self.plugin.cached_msgs -= 1
-            except:
-                self.cachedItemsAck = None
-                self.plugin.cache.truncate()
-                self.plugin.cache.close()
-                break
+        """
+        Read messages from the disk cache and send them, in batches when batching.
 
-            rawmsg = self.plugin.cache.read(bts)
-            self.plugin.cache.seek(-bts, 1)
+        @param   amount (int)   The maximum number of messages or batches to send.
+        """
+        items = self.factory.cache.read(amount * self.batch_size)
+        if len(items) < amount * self.batch_size:
+            self.readingCache = False
+
+        batch = []
+        segments = []
+        size = 0
+        for rawmsg, segment in items:
+            self.factory.cached_msgs -= 1
             try:
                 msg = proto.Msg.FromString(rawmsg)
                 #print "read item %s from disk" % (AckMap.checksum(msg.SerializeToString()))
             except:
-                pass
-            else:
-                msg.cached = True
-                self.cachedItemsAck.add(AckMap.checksum(msg.SerializeToString()))
-                self.sendMsg(msg)
-
-        if not self.plugin.cache.closed:
-            self.plugin.cache.truncate()
+                self.factory.cache.release(segment)
+                continue
+
+            msg.cached = True
+            if len(batch) >= self.batch_size or (len(batch) > 0 and \
+                size + len(rawmsg) + 8 > self.getMaxFrameSize()):
+                self.transmit(Db4OClient.pack(batch), segments)
+                batch = []
+                segments = []
+                size = 0
+            batch.append(msg)
+            segments.append(segment)
+            size += len(rawmsg) + 8
+
+        if len(batch) > 0:
+            self.transmit(Db4OClient.pack(batch), segments)
 
     def pushCache(self):
         """
-        Push trough the cached data. Clears the cache afterwards.
+        Push trough the cached data, as far as the window allows.
         """
-        #print "try pushing cache"
-        if not self.plugin.cache.closed:
-            self.plugin.cache.flush()
-            self.plugin.cache.close()
-
-        if os.path.isfile(self.plugin.cache_file):
-            self.plugin.cache = open(self.plugin.cache_file, 'r+b')
-            self.plugin.cache.seek(0, 2)
-
-            self.cachedItemsAck = set()
-            self.readNextCachedItems(500)
-
+        self.factory.cache_dirty = False
+        self.readingCache = True
+        self.sendPending()
 
     def clearCache(self):
         """
-        Clears the cache file.
+        Clears the cache.
         """
-        if not self.plugin.cache.closed:
-            self.plugin.cache.flush()
-            self.plugin.cache.close()
-
-        self.plugin.cache = open(self.plugin.cache_file, 'wb')
-        self.plugin.cache.truncate()
-        self.plugin.cache.close()
+        self.factory.cached_msgs -= len(self.factory.cache)
+        self.factory.cache.clear()
 
 class Db4OClientFactory(ReconnectingClientFactory):
     """
-    The factory class of the Db4O client.
+    The factory class of the Db4O client. Each factory handles a single connection, with its own AckMap and its own
+    partition of the disk cache.
     """
-    def __init__(self, plugin):
+    def __init__(self, plugin, id, host, port, cachePath):
         """
-        Initialisation.
+        Initialisation. Open the cache partition.
 
         @param   plugin (olof.core.Plugin)   Reference to the main Db4O Plugin instance.
+        @param   id (int)                    The number of the connection.
+        @param   host (str)                  Hostname or IP-address of the Db4O server.
+        @param   port (int)                  TCP port of the Db4O server.
+        @param   cachePath (str)             The base path of the cache partition.
         """
         self.plugin = plugin
+        self.id = id
+        self.host = host
+        self.port = port
         self.maxDelay = 120
         self.client = None
+
+        self.cache = diskcache.DiskCache(cachePath, plugin.config.getValue('cache_segment_size'),
+            compressor=plugin.cache_compressor)
+        self.cached_msgs = len(self.cache)
+        self.cache_dirty = False
+
+        self.connected = False
+        self.closed = False
+        self.conn_time = None
+
         self.ackmap = AckMap(self)
+        self.flow = FlowControl(plugin)
         self.buildProtocol(None)
 
+    def connect(self):
+        """
+        Connect to the Db4O server.
+        """
+        if self.plugin.ssl_enabled:
+            self.plugin.logger.logInfo('Connecting to Db4o server at %s:%i, with SSL enabled' % (self.host,
+                self.port))
+            reactor.connectSSL(self.host, self.port, self, InetCtxFactory(self.plugin))
+        else:
+            self.plugin.logger.logInfo('Connecting to Db4o server at %s:%i' % (self.host, self.port))
+            reactor.connectTCP(self.host, self.port, self)
+
+    def cacheMsg(self, msg):
+        """
+        Write the given message to the cache.
+
+        @param   msg (proto.Msg)   The message to cache. Batches are cached as separate messages.
+        """
+        msgs = Db4OClient.unpack(msg)
+        for m in msgs:
+            self.cache.append(m.SerializeToString())
+        self.cached_msgs += len(msgs)
+        self.cache_dirty = True
+
+    def close(self):
+        """
+        Stop reconnecting and drop the connection. Write the unsent messages to the cache and close it.
+
+        This is done right away, as the cache may be opened again by a new plugin instance before the connection is
+        actually lost.
+        """
+        self.stopTrying()
+        self.ackmap.stopChecker()
+        if self.client != None:
+            self.client.cacheUnsent()
+        self.closed = True
+        if self.client != None and self.client.transport != None:
+            self.client.transport.loseConnection()
+        self.cache.close()
+
     def sendMsg(self, msg):
         """
         Send a line via the Db4O client.
 
         @param   line (str)   The line to send.
         """
-        if 'client' in self.__dict__ and self.client != None:
+        if 'client' in self.__dict__ and self.client != None and not self.closed:
             self.client.sendMsg(msg)
 
     def buildProtocol(self, addr):
@@ -440,32 +889,36 @@ class Plugin(olof.core.Plugin):
         Connect to the Db4O server.
         """
         olof.core.Plugin.__init__(self, server, filename, "Gismosi")
-        self.host = self.config.getValue('host')
+        self.hosts = [h.strip() for h in str(self.config.getValue('host')).split(',') if len(h.strip()) > 0]
         self.port = self.config.getValue('port')
         self.cache_file = self.config.getValue('cache_file')
         self.cache_lock = threading.Lock()
 
         self.server.checkDiskAccess([self.cache_file])
-        self.cache = open(self.cache_file, 'ab')
-        self.cached_msgs = 0
+        self.link_compressor = compression.Compressor(self.config.getValue('compression_level'))
+        self.cache_compressor = compression.Compressor(self.config.getValue('compression_level')) \
+            if self.config.getValue('cache_compression') else None
+        self.ssl_enabled = None not in [self.config.getValue('ssl_client_%s' % i) for i in ['crt', 'key']]
 
-        self.connected = False
-        self.conn_time = None
+        self.factories = []
+        for i in range(max(len(self.hosts), self.config.getValue('connections'))):
+            self.factories.append(Db4OClientFactory(self, i, self.hosts[i % len(self.hosts)], self.port,
+                self.getCachePath(i)))
+        self.ring = hashring.HashRing([(i, f) for i, f in enumerate(self.factories)])
 
-        self.db4o_factory = Db4OClientFactory(self)
-        self.ssl_enabled = None not in [self.config.getValue('ssl_client_%s' % i) for i in ['crt', 'key']]
-        if self.ssl_enabled:
-            self.logger.logInfo('Connecting to Db4o server at %s:%i, with SSL enabled' % (self.host, self.port))
-            reactor.connectSSL(self.host, self.port, self.db4o_factory, InetCtxFactory(self))
-        else:
-            self.logger.logInfo('Connecting to Db4o server at %s:%i' % (self.host, self.port))
-            reactor.connectTCP(self.host, self.port, self.db4o_factory)
+        self.importLegacyCache()
+        self.importPartitions()
+        self.cache_flush_loop = task.LoopingCall(self.flushCache)
+        self.cache_flush_loop.start(1, now=False)
+
+        for f in self.factories:
+            f.connect()
 
     def defineConfiguration(self):
         options = []
 
         o = olof.configuration.Option('host')
-        o.setDescription('Hostname or IP-address of the Db4O database server.')
+        o.setDescription('Hostname or IP-address of the Db4O database server. Separate multiple servers by commas.')
         o.addValue(olof.configuration.OptionValue('localhost', default=True))
         options.append(o)
 
@@ -475,6 +928,14 @@ class Plugin(olof.core.Plugin):
         o.addValue(olof.configuration.OptionValue(5001, default=True))
         options.append(o)
 
+        o = olof.configuration.Option('connections')
+        o.setDescription('Number of parallel connections to the database server(s), divided over the servers. ' + \
+            'The data of each scanner always uses the same connection. Each connection uses its own partition ' + \
+            'of the cache.')
+        o.setValidation(olof.tools.validation.parseInt)
+        o.addValue(olof.configuration.OptionValue(1, default=True))
+        options.append(o)
+
         o = olof.configuration.Option('ssl_client_crt')
         o.setDescription('Path to the SSL client certificate. None to disable SSL.')
         o.addValue(olof.configuration.OptionValue(None, default=True))
@@ -491,38 +952,240 @@ class Plugin(olof.core.Plugin):
         o.addValue(olof.configuration.OptionValue('/var/cache/gyrid-server/db4o.cache', default=True))
         options.append(o)
 
+        o = olof.configuration.Option('cache_segment_size')
+        o.setDescription('Size in bytes of the segment files of the cache. Segments are deleted when all data in ' + \
+            "them has been ack'ed.")
+        o.setValidation(olof.tools.validation.parseInt)
+        o.addValue(olof.configuration.OptionValue(4194304, default=True))
+        options.append(o)
+
+        o = olof.configuration.Option('cache_compression')
+        o.setDescription('Compress the data in the cache, using zlib.')
+        o.addValue(olof.configuration.OptionValue(True, default=True))
+        o.addValue(olof.configuration.OptionValue(False))
+        options.append(o)
+
+        o = olof.configuration.Option('link_compression')
+        o.setDescription('Compress batches sent to the database server using zlib, when the server accepts it.')
+        o.addValue(olof.configuration.OptionValue(True, default=True))
+        o.addValue(olof.configuration.OptionValue(False))
+        options.append(o)
+
+        o = olof.configuration.Option('compression_level')
+        o.setDescription('The zlib compression level, from 1 (fastest) to 9 (smallest).')
+        o.setValidation(olof.tools.validation.parseInt)
+        o.addValue(olof.configuration.OptionValue(6, default=True))
+        options.append(o)
+
+        o = olof.configuration.Option('send_window')
+        o.setDescription("Maximum number of messages or batches sent to the database server that have not been " + \
+            "ack'ed yet. Further messages are queued.")
+        o.setValidation(olof.tools.validation.parseInt)
+        o.addValue(olof.configuration.OptionValue(1000, default=True))
+        options.append(o)
+
+        o = olof.configuration.Option('adaptive_window')
+        o.setDescription('Adapt the window to the round trip time of the ACKs, up to the maximum set above.')
+        o.addValue(olof.configuration.OptionValue(True, default=True))
+        o.addValue(olof.configuration.OptionValue(False))
+        options.append(o)
+
+        o = olof.configuration.Option('batch_size')
+        o.setDescription('Maximum number of messages to send in a single batch, when the database server accepts ' + \
+            'batches. 1 to send messages one by one, without asking the server. Only use batches when the ' + \
+            'server supports them, otherwise sending waits for the batch request to time out on each connect.')
+        o.setValidation(olof.tools.validation.parseInt)
+        o.addValue(olof.configuration.OptionValue(1, default=True))
+        options.append(o)
+
+        o = olof.configuration.Option('batch_linger')
+        o.setDescription('Maximum time in milliseconds to wait for more messages before sending a batch that ' + \
+            'is not full.')
+        o.setValidation(olof.tools.validation.parseInt)
+        o.addValue(olof.configuration.OptionValue(50, default=True))
+        options.append(o)
+
+        o = olof.configuration.Option('framing')
+        o.setDescription('Size in bits of the length prefix of each frame when sending batches. 32-bit framing ' + \
+            'allows batches larger than 64 KiB, if the database server accepts it.')
+        o.setValidation(olof.tools.validation.parseInt)
+        o.addValue(olof.configuration.OptionValue(32, default=True))
+        o.addValue(olof.configuration.OptionValue(16))
+        options.append(o)
+
+        o = olof.configuration.Option('send_queue_size')
+        o.setDescription('Maximum number of messages to queue when the window is full. Further messages are ' + \
+            'written to the cache file.')
+        o.setValidation(olof.tools.validation.parseInt)
+        o.addValue(olof.configuration.OptionValue(10000, default=True))
+        options.append(o)
+
+        o = olof.configuration.Option('ack_timeout')
+        o.setDescription('Time in seconds to wait for an ACK from the database server before resending data. ' + \
+            'This doubles with each attempt.')
+        o.setValidation(olof.tools.validation.parseFloat)
+        o.addValue(olof.configuration.OptionValue(60, default=True))
+        options.append(o)
+
+        o = olof.configuration.Option('ack_max_timeout')
+        o.setDescription('Maximum time in seconds to wait for an ACK before resending data.')
+        o.setValidation(olof.tools.validation.parseFloat)
+        o.addValue(olof.configuration.OptionValue(900, default=True))
+        options.append(o)
+
+        o = olof.configuration.Option('ack_max_attempts')
+        o.setDescription("Number of times to resend data before dropping it when it's not ack'ed.")
+        o.setValidation(olof.tools.validation.parseInt)
+        o.addValue(olof.configuration.OptionValue(6, default=True))
+        options.append(o)
+
+        o = olof.configuration.Option('resend_rate')
+        o.setDescription('Maximum number of messages to resend per second.')
+        o.setValidation(olof.tools.validation.parseInt)
+        o.addValue(olof.configuration.OptionValue(100, default=True))
+        options.append(o)
+
         return options
 
+    def getCachePath(self, id):
+        """
+        Get the base path of the cache partition of the given connection.
+
+        @param   id (int)   The number of the connection.
+        @return  (str)      The base path of the partition.
+        """
+        return self.cache_file if id == 0 else '%s.p%i' % (self.cache_file, id)
+
+    def importPartitions(self):
+        """
+        Move the messages in the cache partitions of connections that no longer exist, f.ex. because the number of
+        connections has been lowered, to the partitions of the current connections.
+        """
+        for path in glob.glob(self.cache_file + '.p*.index'):
+            try:
+                id = int(path[len(self.cache_file) + 2:-len('.index')])
+            except ValueError:
+                continue
+            if id < len(self.factories):
+                continue
+
+            cache = diskcache.DiskCache(path[:-len('.index')])
+            items = cache.read(1000)
+            while len(items) > 0:
+                for data, segment in items:
+                    try:
+                        msg = proto.Msg.FromString(data)
+                    except:
+                        continue
+                    self.ring.get(msg.hostname).cacheMsg(msg)
+                items = cache.read(1000)
+            cache.clear()
+            os.remove(path)
+
+        for f in self.factories:
+            f.cache.flush()
+
+    def flushCache(self):
+        """
+        Write the buffers of all cache partitions to disk.
+        """
+        for f in self.factories:
+            f.cache.flush()
+
+    def importLegacyCache(self):
+        """
+        Move messages from a cache file in the previous format to the cache of the first connection. The previous
+        format is a single file with each message followed by its length, read backwards.
+        """
+        if not os.path.isfile(self.cache_file):
+            return
+
+        cache = self.factories[0].cache
+        f = open(self.cache_file, 'rb')
+        data = f.read()
+        f.close()
+
+        end = len(data)
+        while end >= 2:
+            length = struct.unpack('!H', data[end-2:end])[0]
+            if length > end - 2:
+                break
+            cache.append(data[end-2-length:end-2])
+            end -= 2 + length
+
+        cache.flush()
+        self.factories[0].cached_msgs = len(cache)
+        os.remove(self.cache_file)
+
     def unload(self, shutdown=False):
         """
-        Unload. Save locations and scansetups to disk.
+        Unload. Stop the checkers and close the cache.
         """
         olof.core.Plugin.unload(self, shutdown)
+        try:
+            self.cache_flush_loop.stop()
+        except AssertionError:
+            pass
+        for f in self.factories:
+            f.close()
 
     def getStatus(self):
         """
-        Return the current status of the Db4O connection and cache. For use in the status plugin.
+        Return the current status of the Db4O connections and cache. For use in the status plugin.
         """
-        cl = {}
-        if self.cached_msgs > 0:
-            cl = {'id': 'cached', 'int': self.cached_msgs}
+        connected = [f for f in self.factories if f.connected]
+        cached = sum([f.cached_msgs for f in self.factories])
 
         r = []
-        if self.connected == False and self.conn_time == None:
+        if len(self.factories) > 1:
+            r = [{'status': 'ok' if len(connected) == len(self.factories) else 'error'},
+                {'id': 'connected', 'str': '%i of %i' % (len(connected), len(self.factories))}]
+        elif len(connected) == 0 and self.factories[0].conn_time == None:
             r = [{'status': 'error'}, {'id': 'no connection'}]
-        elif self.connected == False:
+        elif len(connected) == 0:
             r = [{'status': 'error'},
-                {'id': 'disconnected', 'time': self.conn_time}]
-        elif self.connected == True:
+                {'id': 'disconnected', 'time': self.factories[0].conn_time}]
+        else:
             r = [{'status': 'ok'},
-                {'id': 'connected', 'time': self.conn_time}]
+                {'id': 'connected', 'time': self.factories[0].conn_time}]
 
-        r.append({'id': 'host', 'str': self.host})
+        r.append({'id': 'host', 'str': ', '.join(self.hosts)})
         r.append({'id': 'ssl', 'str': 'enabled' if self.ssl_enabled else 'disabled'})
 
-        if len(cl) > 0:
-            r.append(cl)
+        if cached > 0:
+            r.append({'id': 'cached', 'int': cached})
+
+        if len(connected) > 0:
+            flows = [f.flow for f in connected]
+            for flow in flows:
+                flow.updateThroughput(time.time())
+            r.append({'id': 'in flight', 'str': '%i of %i' % (sum([len(f.ackmap) for f in connected]),
+                sum([flow.getWindow() for flow in flows]))})
+            queued = sum([len(flow.pending) for flow in flows])
+            if queued > 0:
+                r.append({'id': 'queued', 'int': queued})
+            rtts = [flow.srtt for flow in flows if flow.srtt != None]
+            if len(rtts) > 0:
+                r.append({'id': 'round trip time', 'str': '%0.1f ms' % (sum(rtts) / len(rtts) * 1000)})
+            r.append({'id': 'throughput', 'str': '%0.1f msg/s' % sum([flow.throughput for flow in flows])})
+            client = connected[0].client
+            if client.negotiating:
+                r.append({'id': 'batching', 'str': 'negotiating'})
+            elif client.batch_size > 1:
+                r.append({'id': 'batching', 'str': 'up to %i messages, %i-bit framing' % (client.batch_size,
+                    client.prefixLength * 8)})
+        for id, compressor in [('link compression', self.link_compressor),
+                               ('cache compression', self.cache_compressor)]:
+            if compressor != None and compressor.getRatio() != None:
+                r.append({'id': id, 'str': 'ratio %0.1f, %0.1f s' % (compressor.getRatio(), compressor.time)})
+
+        resent = sum([f.ackmap.resent for f in self.factories])
+        if resent > 0:
+            r.append({'id': 'resent', 'int': resent})
+        expired = sum([f.ackmap.expired for f in self.factories])
+        if expired > 0:
+            r.append({'id': 'dropped', 'int': expired})
         return r
 
     def rawProtoFeed(self, m):
-        self.db4o_factory.sendMsg(m)
+        self.ring.get(m.hostname).sendMsg(m)
@@ -0,0 +1,64 @@
+#-*- coding: utf-8 -*-
+#
+# This file belongs to Gyrid Server.
+#
+# Copyright (C) 2012  Roel Huybrechts
+# All rights reserved.
+
+"""
+Module providing zlib compression with statistics.
+"""
+
+import time
+import zlib
+
+class Compressor(object):
+    """
+    Compresses and decompresses data using zlib, keeping track of the amount of data and the time spent.
+    """
+    def __init__(self, level=6):
+        """
+        Initialisation.
+
+        @param   level (int)   The zlib compression level, 1 to 9. Defaults to 6.
+        """
+        self.level = max(1, min(9, level))
+        self.raw = 0
+        self.compressed = 0
+        self.time = 0
+
+    def compress(self, data):
+        """
+        Compress the given data.
+
+        @param   data (str)   The data to compress.
+        @return  (str)        The compressed data.
+        """
+        start = time.time()
+        compressed = zlib.compress(data, self.level)
+        self.time += time.time() - start
+        self.raw += len(data)
+        self.compressed += len(compressed)
+        return compressed
+
+    def decompress(self, data):
+        """
+        Decompress the given data.
+
+        @param   data (str)   The compressed data.
+        @return  (str)        The decompressed data.
+        """
+        start = time.time()
+        data = zlib.decompress(data)
+        self.time += time.time() - start
+        return data
+
+    def getRatio(self):
+        """
+        Get the compression ratio of all data compressed so far.
+
+        @return  (float)   The size of the data divided by its compressed size, None when nothing was compressed.
+        """
+        if self.compressed == 0:
+            return None
+        return float(self.raw) / self.compressed
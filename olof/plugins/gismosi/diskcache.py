@@ -0,0 +1,377 @@
+#-*- coding: utf-8 -*-
+#
+# This file belongs to Gyrid Server.
+#
+# Copyright (C) 2012  Roel Huybrechts
+# All rights reserved.
+
+"""
+Module providing the disk cache for messages that could not be sent to the Db4O server.
+"""
+
+import collections
+import glob
+import mmap
+import os
+import struct
+import zlib
+
+class DiskCache(object):
+    """
+    Append-only disk cache, split into segments of a fixed size.
+
+    Segments are stored as '<path>.<number>'. Each record is the length of the data (unsigned short) followed by the
+    data. Appended records are buffered in memory and written in blocks, one for each time the buffer is written. A
+    segment starts with a magic string, followed by the blocks. Each block has a header with the size of the block, the
+    number of records and flags, followed by the records, optionally compressed using zlib. Records are read in the
+    order they were written, memory mapping the segments.
+
+    Records that are read are outstanding until they are released, f.ex. when they are ack'ed or cached again. A segment
+    is deleted when all of its records are read and released.
+
+    The index, '<path>.index', lists the segments with their number of records, and the position of the reader: the
+    segment, the offset of the block, the number of records read from the segment and from the block.
+    """
+    record = struct.Struct('!H')
+    block = struct.Struct('!IIB')
+    indexHeader = struct.Struct('!4sBIQIII')
+    indexEntry = struct.Struct('!II')
+    indexVersion = 1
+    magic = 'GDCI'
+    segmentMagic = 'GDCB'
+    compressed = 1
+
+    def __init__(self, path, segmentSize=4194304, bufferSize=65536, compressor=None):
+        """
+        Initialisation. Read the index.
+
+        @param   path (str)                  The base path of the cache files.
+        @param   segmentSize (int)           The maximum size of a segment in bytes. Defaults to 4 MiB.
+        @param   bufferSize (int)            Write the buffer to disk when it exceeds this number of bytes. Defaults to
+                                               64 KiB.
+        @param   compressor (Compressor)     Compress the blocks using this compressor. Optional, blocks are not
+                                               compressed by default.
+        """
+        self.path = path
+        self.segmentSize = segmentSize
+        self.bufferSize = bufferSize
+        self.compressor = compressor
+
+        self.segments = collections.OrderedDict()
+        self.blockCache = None
+        self.outstanding = collections.defaultdict(int)
+        self.buffer = []
+        self.buffer_size = 0
+        self.file = None
+        self.map = None
+        self.mapSeq = None
+
+        self.readSeq = 0
+        self.readOffset = 0
+        self.readRecords = 0
+        self.readSkip = 0
+
+        self.__readIndex()
+        self.writeSeq = self.segments.keys()[-1] if len(self.segments) > 0 else 0
+
+    def getSegmentPath(self, seq):
+        """
+        Get the path of the given segment.
+
+        @param   seq (int)   The number of the segment.
+        @return  (str)       The path of the segment.
+        """
+        return '%s.%08i' % (self.path, seq)
+
+    def __readIndex(self):
+        """
+        Read the index from disk. Segments that are missing from the index are counted.
+        """
+        records = {}
+        try:
+            f = open(self.path + '.index', 'rb')
+            data = f.read()
+            f.close()
+            magic, version, self.readSeq, self.readOffset, self.readRecords, self.readSkip, count = \
+                DiskCache.indexHeader.unpack_from(data)
+            if magic == DiskCache.magic and version == DiskCache.indexVersion:
+                for i in range(count):
+                    seq, r = DiskCache.indexEntry.unpack_from(data,
+                        DiskCache.indexHeader.size + i * DiskCache.indexEntry.size)
+                    records[seq] = r
+            else:
+                self.readSeq = self.readOffset = self.readRecords = self.readSkip = 0
+        except (IOError, struct.error):
+            self.readSeq = self.readOffset = self.readRecords = self.readSkip = 0
+
+        seqs = []
+        for p in glob.glob(self.path + '.[0-9]*'):
+            try:
+                seqs.append(int(p[len(self.path) + 1:]))
+            except ValueError:
+                continue
+
+        for seq in sorted(seqs):
+            if seq in records:
+                self.segments[seq] = records[seq]
+            else:
+                self.segments[seq] = self.__countRecords(seq)
+
+        if self.readSeq not in self.segments:
+            self.readSeq = self.segments.keys()[0] if len(self.segments) > 0 else 0
+            self.readOffset = self.readRecords = self.readSkip = 0
+
+    def __countRecords(self, seq):
+        """
+        Count the records in the given segment.
+
+        @param   seq (int)   The number of the segment.
+        @return  (int)       The number of complete records.
+        """
+        f = open(self.getSegmentPath(seq), 'rb')
+        data = f.read()
+        f.close()
+
+        count = 0
+        offset = len(DiskCache.segmentMagic)
+        while offset + DiskCache.block.size <= len(data):
+            length, records, flags = DiskCache.block.unpack_from(data, offset)
+            offset += DiskCache.block.size + length
+            if offset <= len(data):
+                count += records
+        return count
+
+    def writeIndex(self):
+        """
+        Write the index to disk.
+        """
+        data = [DiskCache.indexHeader.pack(DiskCache.magic, DiskCache.indexVersion, self.readSeq, self.readOffset,
+            self.readRecords, self.readSkip, len(self.segments))]
+        for seq, records in self.segments.items():
+            data.append(DiskCache.indexEntry.pack(seq, records))
+
+        f = open(self.path + '.index.tmp', 'wb')
+        f.write(''.join(data))
+        f.close()
+        os.rename(self.path + '.index.tmp', self.path + '.index')
+
+    def __len__(self):
+        """
+        The number of records that have not been read.
+        """
+        unread = sum([r for s, r in self.segments.items() if s >= self.readSeq]) - self.readRecords
+        return unread + len(self.buffer)
+
+    def append(self, data):
+        """
+        Append the given data to the cache. It is written to disk when the buffer is full or when flushing.
+
+        @param   data (str)   The data to append, at most 65535 bytes.
+        """
+        self.buffer.append(DiskCache.record.pack(len(data)) + data)
+        self.buffer_size += DiskCache.record.size + len(data)
+        if self.buffer_size >= self.bufferSize:
+            self.flush()
+
+    def __openSegment(self, seq):
+        """
+        Open the given segment for writing. New segments start with the magic string.
+
+        @param   seq (int)   The number of the segment.
+        """
+        self.segments.setdefault(seq, 0)
+        self.file = open(self.getSegmentPath(seq), 'ab')
+        self.file.seek(0, 2)
+        if self.file.tell() == 0:
+            self.file.write(DiskCache.segmentMagic)
+
+    def flush(self):
+        """
+        Write the buffer to disk as a block, starting a new segment when full.
+        """
+        if len(self.buffer) == 0:
+            return
+
+        if self.file == None:
+            self.__openSegment(self.writeSeq)
+
+        data = ''.join(self.buffer)
+        flags = 0
+        if self.compressor != None:
+            compressed = self.compressor.compress(data)
+            if len(compressed) < len(data):
+                data = compressed
+                flags |= DiskCache.compressed
+        block = DiskCache.block.pack(len(data), len(self.buffer), flags) + data
+
+        size = self.file.tell()
+        if size > len(DiskCache.segmentMagic) and size + len(block) > self.segmentSize:
+            self.file.close()
+            self.writeSeq += 1
+            self.__openSegment(self.writeSeq)
+
+        self.file.write(block)
+        self.file.flush()
+        self.segments[self.writeSeq] += len(self.buffer)
+        self.buffer = []
+        self.buffer_size = 0
+        self.writeIndex()
+
+    def __map(self, seq):
+        """
+        Memory map the given segment, remapping when the file has grown.
+
+        @param   seq (int)   The number of the segment.
+        @return  (mmap)      The mapped segment, None when empty or missing.
+        """
+        try:
+            size = os.path.getsize(self.getSegmentPath(seq))
+        except OSError:
+            return None
+
+        if self.map != None and (self.mapSeq != seq or len(self.map) < size):
+            self.map.close()
+            self.map = None
+
+        if self.map == None and size > 0:
+            f = open(self.getSegmentPath(seq), 'rb')
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mapSeq = seq
+            f.close()
+        return self.map
+
+    def __readBlock(self, m, seq, offset):
+        """
+        Read the records of the block at the given offset.
+
+        @param   m (mmap)       The mapped segment.
+        @param   seq (int)      The number of the segment.
+        @param   offset (int)   The offset of the block.
+        @return  (tuple)        The list of records and the offset of the next block, None when the block is incomplete.
+        """
+        if self.blockCache != None and self.blockCache[0] == (seq, offset):
+            return self.blockCache[1]
+
+        end = len(m) if m != None else 0
+        if offset + DiskCache.block.size > end:
+            return None
+        size, count, flags = DiskCache.block.unpack_from(m, offset)
+        start = offset + DiskCache.block.size
+        if start + size > end:
+            return None
+
+        data = m[start:start + size]
+        if flags & DiskCache.compressed:
+            data = self.compressor.decompress(data) if self.compressor != None else zlib.decompress(data)
+
+        records = []
+        o = 0
+        while o + DiskCache.record.size <= len(data):
+            length = DiskCache.record.unpack_from(data, o)[0]
+            records.append(data[o + DiskCache.record.size:o + DiskCache.record.size + length])
+            o += DiskCache.record.size + length
+
+        self.blockCache = ((seq, offset), (records, start + size))
+        return self.blockCache[1]
+
+    def read(self, amount):
+        """
+        Read the next records. The records are outstanding until released.
+
+        @param   amount (int)   The maximum number of records to read.
+        @return  (list)         List of (data, segment) tuples. Use the segment to release the record.
+        """
+        items = []
+        while len(items) < amount and self.readSeq in self.segments:
+            if self.readSeq == self.writeSeq:
+                self.flush()
+
+            m = self.__map(self.readSeq)
+            self.readOffset = max(self.readOffset, len(DiskCache.segmentMagic))
+            block = self.__readBlock(m, self.readSeq, self.readOffset) if m != None else None
+            if block != None:
+                records, next = block
+                for data in records[self.readSkip:self.readSkip + amount - len(items)]:
+                    items.append((data, self.readSeq))
+                    self.outstanding[self.readSeq] += 1
+                    self.readRecords += 1
+                    self.readSkip += 1
+                if self.readSkip >= len(records):
+                    self.readOffset = next
+                    self.readSkip = 0
+                continue
+
+            if self.readSeq == self.writeSeq:
+                break
+
+            # Segment fully read, continue with the next one.
+            later = [s for s in self.segments if s > self.readSeq]
+            self.readSeq = later[0] if len(later) > 0 else self.writeSeq
+            self.readOffset = self.readRecords = self.readSkip = 0
+
+        if len(items) > 0:
+            self.writeIndex()
+        self.cleanup()
+        return items
+
+    def release(self, seq):
+        """
+        Release a record that has been read, f.ex. because it has been ack'ed.
+
+        @param   seq (int)   The segment of the record.
+        """
+        if self.outstanding.get(seq, 0) > 0:
+            self.outstanding[seq] -= 1
+            if self.outstanding[seq] == 0:
+                del(self.outstanding[seq])
+                self.cleanup()
+
+    def cleanup(self):
+        """
+        Delete the segments that have been read completely and have no outstanding records.
+        """
+        removed = False
+        for seq in self.segments.keys():
+            if seq >= self.readSeq or seq == self.writeSeq:
+                break
+            if seq not in self.outstanding:
+                if self.mapSeq == seq and self.map != None:
+                    self.map.close()
+                    self.map = None
+                try:
+                    os.remove(self.getSegmentPath(seq))
+                except OSError:
+                    pass
+                del(self.segments[seq])
+                removed = True
+
+        if removed:
+            self.writeIndex()
+
+    def clear(self):
+        """
+        Delete all data in the cache.
+        """
+        self.close()
+        for seq in self.segments.keys():
+            try:
+                os.remove(self.getSegmentPath(seq))
+            except OSError:
+                pass
+        self.segments.clear()
+        self.outstanding.clear()
+        self.blockCache = None
+        self.writeSeq = self.readSeq = self.readOffset = self.readRecords = self.readSkip = 0
+        self.writeIndex()
+
+    def close(self):
+        """
+        Write the buffer to disk and close all files.
+        """
+        self.flush()
+        if self.file != None:
+            self.file.close()
+            self.file = None
+        if self.map != None:
+            self.map.close()
+            self.map = None
@@ -0,0 +1,57 @@
+#-*- coding: utf-8 -*-
+#
+# This file belongs to Gyrid Server.
+#
+# Copyright (C) 2012  Roel Huybrechts
+# All rights reserved.
+
+"""
+Module providing consistent hashing.
+"""
+
+import bisect
+import hashlib
+
+class HashRing(object):
+    """
+    Maps keys to nodes using consistent hashing. Each node is placed on the ring a number of times, a key maps to the
+    first node following its hash. Adding or removing a node only moves the keys of that node.
+    """
+    def __init__(self, nodes, replicas=160):
+        """
+        Initialisation.
+
+        @param   nodes (list)      List of (name, node) tuples. The name determines the place of the node on the ring.
+        @param   replicas (int)    The number of times each node is placed on the ring. Defaults to 160.
+        """
+        self.ring = []
+        for name, node in nodes:
+            for i in range(replicas):
+                self.ring.append((HashRing.hash('%s-%i' % (name, i)), node))
+        self.ring.sort(key=lambda x: x[0])
+        self.hashes = [h for h, node in self.ring]
+        self.lookup = {}
+
+    @staticmethod
+    def hash(key):
+        """
+        Hash the given key.
+
+        @param   key (str)   The key to hash.
+        @return  (int)       The hash, an unsigned 32-bit integer.
+        """
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+    def get(self, key):
+        """
+        Get the node for the given key.
+
+        @param   key (str)   The key.
+        @return              The node.
+        """
+        if key not in self.lookup:
+            if len(self.lookup) >= 65536:
+                self.lookup.clear()
+            i = bisect.bisect(self.hashes, HashRing.hash(key))
+            self.lookup[key] = self.ring[i % len(self.ring)][1]
+        return self.lookup[key]
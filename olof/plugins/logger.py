@@ -9,13 +9,536 @@
 Plugin that handles on-disk logging of received scanner data.
 """
 
+from twisted.internet import reactor, task, threads
+
+import collections
+import glob
+import gzip
+import marshal
 import os
+import shutil
+import struct
+import threading
 import time
 
 import olof.configuration
 import olof.core
+import olof.tools.datetimetools
+import olof.tools.detectionarchive
 import olof.tools.validation
 
+def compressFile(source, target):
+    """
+    Append the gzip-compressed contents of the source file to the target file and remove the source file.
+
+    Appending adds a new gzip member to the target, which is read transparently as one stream. Data written to a
+    partition after it has been compressed is thus added to the same compressed file.
+
+    @param   source (str)   Path of the file to compress.
+    @param   target (str)   Path of the compressed file.
+    """
+    f = open(source, 'rb')
+    try:
+        g = gzip.open(target, 'ab')
+        try:
+            shutil.copyfileobj(f, g, 1048576)
+        finally:
+            g.close()
+    finally:
+        f.close()
+    os.remove(source)
+
+class LogIndex(object):
+    """
+    Class that represents the sidecar index of a log directory. It lists the time range and number of records of each
+    logfile in the directory, so offline analysis can read only the files covering a certain time window.
+
+    The index is saved as 'index.csv' in the directory, each line containing the filename, the first and last UNIX
+    timestamp and the number of records. Logfiles are added when they are closed.
+    """
+    def __init__(self, directory):
+        """
+        Initialisation. Read the index from disk if it exists.
+
+        @param   directory (str)   The log directory.
+        """
+        self.path = '/'.join([directory, 'index.csv'])
+        self.files = {}
+
+        if os.path.isfile(self.path):
+            f = open(self.path, 'r')
+            for line in f:
+                try:
+                    name, first, last, records = line.strip().split(',')
+                    self.files[name] = (float(first), float(last), int(records))
+                except ValueError:
+                    continue
+            f.close()
+
+    def update(self, name, first, last, records):
+        """
+        Add the given time range to the index and save it.
+
+        @param   name (str)       The filename of the logfile.
+        @param   first (float)    The first timestamp written.
+        @param   last (float)     The last timestamp written.
+        @param   records (int)    The number of records written.
+        """
+        if name in self.files:
+            f, l, r = self.files[name]
+            first, last, records = min(f, first), max(l, last), r + records
+        self.files[name] = (first, last, records)
+        self.write()
+
+    def rename(self, old, new):
+        """
+        Rename the given logfile in the index, f.ex. after it has been compressed.
+
+        @param   old (str)   The old filename.
+        @param   new (str)   The new filename.
+        """
+        if old in self.files:
+            self.update(new, *self.files.pop(old))
+
+    def write(self):
+        """
+        Save the index to disk.
+        """
+        f = open(self.path + '.tmp', 'w')
+        for name in sorted(self.files):
+            first, last, records = self.files[name]
+            f.write('%s,%0.3f,%0.3f,%i\n' % (name, first, last, records))
+        f.close()
+        os.rename(self.path + '.tmp', self.path)
+
+class HandlePool(object):
+    """
+    Class that limits the number of open file handles. Handles are opened on demand, when the limit is reached the least
+    recently used handle is closed.
+    """
+    def __init__(self, size):
+        """
+        Initialisation.
+
+        @param   size (int)   The maximum number of open handles.
+        """
+        self.size = size
+        self.handles = collections.OrderedDict()
+        self.used = set()
+        self.opens = 0
+        self.reopens = 0
+
+    def get(self, path):
+        """
+        Get a handle for appending to the given file, opening it when necessary.
+
+        @param   path (str)   The path of the file.
+        @return  (file)       The file handle.
+        """
+        handle = self.handles.pop(path, None)
+        if handle == None:
+            while len(self.handles) >= max(self.size, 1):
+                self.handles.popitem(last=False)[1].close()
+
+            handle = open(path, 'ab')
+            self.opens += 1
+            if path in self.used:
+                self.reopens += 1
+            else:
+                self.used.add(path)
+
+        self.handles[path] = handle
+        return handle
+
+    def close(self, path):
+        """
+        Close the handle for the given file, if open.
+
+        @param   path (str)   The path of the file.
+        """
+        handle = self.handles.pop(path, None)
+        if handle != None:
+            handle.close()
+        self.used.discard(path)
+
+class WriteStats(object):
+    """
+    Class that keeps statistics about the data written to disk.
+    """
+    def __init__(self):
+        """
+        Initialisation.
+        """
+        self.bytes = 0
+        self.flushes = 0
+        self.flush_time = 0
+        self.max_flush_time = 0
+        self.syncs = 0
+
+    def addFlush(self, size, duration):
+        """
+        Register a flush.
+
+        @param   size (int)          The number of bytes written.
+        @param   duration (float)    The time between flushing the buffer and the data being written, in seconds.
+        """
+        self.bytes += size
+        self.flushes += 1
+        self.flush_time += duration
+        self.max_flush_time = max(self.max_flush_time, duration)
+
+class Writer(object):
+    """
+    Class that writes logfiles to disk in a separate thread, keeping disk I/O out of the main thread.
+
+    Tasks are queued in a bounded queue. Logfiles are divided over the writers based on their path, so all data of a
+    logfile is written in order by the same thread. When the queue is full, the configured policy applies:
+        'block': wait for the writer to catch up.
+        'drop-oldest': drop the oldest queued data.
+        'spill': append tasks to a spill file on disk until the writer has caught up with the queue, the writer then
+                   replays the spill file.
+    """
+    write, sync, close = range(3)
+    spillRecord = struct.Struct('!I')
+
+    def __init__(self, plugin, id, queueSize, maxOpenFiles, replay=[]):
+        """
+        Initialisation. Start the thread.
+
+        @param   plugin (Plugin)       Reference to main Logger plugin instance.
+        @param   id (int)              The number of this writer.
+        @param   queueSize (int)       The maximum number of queued writes.
+        @param   maxOpenFiles (int)    The maximum number of open files for this writer.
+        @param   replay (list)         Spill files left behind earlier, to write first.
+        """
+        self.plugin = plugin
+        self.id = id
+        self.size = queueSize
+        self.tasks = collections.deque()
+        self.condition = threading.Condition()
+        self.handles = HandlePool(maxOpenFiles)
+        self.stats = WriteStats()
+        self.dropped = 0
+        self.spilled = 0
+        self.spill = None
+        self.spillPath = None
+        self.replay = list(replay)
+        self.stopping = False
+
+        self.thread = threading.Thread(target=self.run, name='logger-writer-%i' % id)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, op, path, payload=None):
+        """
+        Queue the given task. Applies the queue policy when the queue is full.
+
+        @param   op (int)       The task: Writer.write, Writer.sync or Writer.close.
+        @param   path (str)     The path of the logfile.
+        @param   payload        The data to write for Writer.write, whether to compress for Writer.close.
+        """
+        task = (op, path, payload, time.time())
+        self.condition.acquire()
+        try:
+            if op == Writer.write and self.spill == None and len(self.tasks) >= self.size:
+                policy = self.plugin.config.getValue('writer_queue_policy')
+                if policy == 'block':
+                    while len(self.tasks) >= self.size:
+                        self.condition.wait()
+                elif policy == 'drop-oldest':
+                    for i in range(len(self.tasks)):
+                        if self.tasks[i][0] == Writer.write:
+                            self.dropped += len(self.tasks[i][2])
+                            del(self.tasks[i])
+                            break
+                elif policy == 'spill':
+                    self.spillPath = '%s/.spill-%i-%i' % (self.plugin.config.getValue('log_directory'),
+                        self.id, int(time.time() * 1000))
+                    self.spill = open(self.spillPath, 'ab')
+
+            if self.spill != None:
+                record = marshal.dumps(task)
+                self.spill.write(Writer.spillRecord.pack(len(record)) + record)
+                self.spilled += 1
+            else:
+                self.tasks.append(task)
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def stop(self):
+        """
+        Stop the thread when all tasks are done and wait for it to finish.
+        """
+        self.condition.acquire()
+        self.stopping = True
+        self.condition.notifyAll()
+        self.condition.release()
+        self.thread.join()
+
+    def run(self):
+        """
+        Run the thread: process the queue. Spill files are replayed first if left behind earlier, else when the queue is
+        empty.
+        """
+        while True:
+            task = None
+            spill = None
+
+            self.condition.acquire()
+            try:
+                while len(self.tasks) == 0 and self.spill == None and len(self.replay) == 0:
+                    if self.stopping:
+                        return
+                    self.condition.wait()
+
+                if len(self.replay) > 0:
+                    spill = self.replay.pop(0)
+                elif len(self.tasks) > 0:
+                    task = self.tasks.popleft()
+                    self.condition.notifyAll()
+                else:
+                    self.spill.close()
+                    spill = self.spillPath
+                    self.spill = None
+            finally:
+                self.condition.release()
+
+            if task != None:
+                self.process(task)
+            else:
+                self.replaySpill(spill)
+
+    def replaySpill(self, path):
+        """
+        Process all tasks in the given spill file and remove it.
+
+        @param   path (str)   The path of the spill file.
+        """
+        try:
+            f = open(path, 'rb')
+            header = f.read(Writer.spillRecord.size)
+            while len(header) == Writer.spillRecord.size:
+                record = f.read(Writer.spillRecord.unpack(header)[0])
+                try:
+                    self.process(marshal.loads(record))
+                except (EOFError, ValueError, TypeError):
+                    break
+                header = f.read(Writer.spillRecord.size)
+            f.close()
+            os.remove(path)
+        except (IOError, OSError), e:
+            reactor.callFromThread(self.plugin.logger.logError, "Failed to replay %s: %s" % (path, e))
+
+    def process(self, task):
+        """
+        Process the given task.
+
+        @param   task (tuple)   The task, (op, path, payload, time queued).
+        """
+        op, path, payload, queued = task
+        try:
+            if op == Writer.write:
+                handle = self.handles.get(path)
+                handle.write(payload)
+                handle.flush()
+                self.stats.addFlush(len(payload), time.time() - queued)
+            elif op == Writer.sync:
+                os.fsync(self.handles.get(path).fileno())
+                self.stats.syncs += 1
+            elif op == Writer.close:
+                self.handles.close(path)
+                reactor.callFromThread(self.plugin.logClosed, path, payload)
+        except (IOError, OSError), e:
+            reactor.callFromThread(self.plugin.logger.logError, "Failed to write to %s: %s" % (path, e))
+
+class LogFile(object):
+    """
+    Class that represents a logfile. Written data is buffered, it is only written to disk when the buffer exceeds the
+    flush size or when the plugin flushes all logfiles.
+    """
+    extension = '.log'
+
+    def __init__(self, plugin, path):
+        """
+        Initialisation.
+
+        @param   plugin (Plugin)   Reference to main Logger plugin instance.
+        @param   path (str)        Path of the logfile.
+        """
+        self.plugin = plugin
+        self.path = path
+        self.buffer = []
+        self.buffer_size = 0
+        self.synced = True
+        self.first = None
+        self.last = None
+        self.records = 0
+        self.lastWrite = time.time()
+        self.closed = False
+        self.plugin.openFiles[path] = self
+
+    def write(self, data, timestamp=None):
+        """
+        Write the given data to the buffer. Flush when the buffer is full.
+
+        @param   data (str)           The data to write.
+        @param   timestamp (float)    The UNIX timestamp of the data, for use in the index. Optional.
+        """
+        self.buffer.append(data)
+        self.buffer_size += self.sizeOf(data)
+        self.records += 1
+        if timestamp != None:
+            if self.first == None or timestamp < self.first:
+                self.first = timestamp
+            if self.last == None or timestamp > self.last:
+                self.last = timestamp
+        if self.buffer_size >= self.plugin.flushSize:
+            self.flush()
+
+    def sizeOf(self, data):
+        """
+        Get the size of the given data when written to disk.
+
+        @param   data (str)   The data.
+        @return  (int)        The size in bytes.
+        """
+        return len(data)
+
+    def encode(self, buffer):
+        """
+        Convert the given buffered data to the string to write to disk.
+
+        @param   buffer (list)   The buffered data.
+        @return  (str)           The data to write.
+        """
+        return ''.join(buffer)
+
+    def flush(self):
+        """
+        Pass the buffer to the writer.
+        """
+        if self.buffer_size == 0:
+            return
+
+        data = self.encode(self.buffer)
+        self.buffer = []
+        self.buffer_size = 0
+        self.plugin.getWriter(self.path).put(Writer.write, self.path, data)
+        self.synced = False
+        self.lastWrite = time.time()
+
+    def sync(self):
+        """
+        Make sure all flushed data is stored on disk.
+        """
+        if not self.synced:
+            self.plugin.getWriter(self.path).put(Writer.sync, self.path)
+            self.synced = True
+
+    def close(self, compress=False):
+        """
+        Flush and close the logfile. Add its time range to the index of the directory.
+
+        @param   compress (bool)   Compress the logfile when closed, if compression is enabled. Defaults to False.
+        """
+        if not self.closed:
+            self.flush()
+            self.plugin.getWriter(self.path).put(Writer.close, self.path, compress)
+            self.closed = True
+            if self.first != None:
+                self.plugin.getIndex(os.path.dirname(self.path)).update(
+                    os.path.basename(self.path), self.first, self.last, self.records)
+
+class BinaryLogFile(LogFile):
+    """
+    Class that represents a logfile of detections in a binary, columnar format. Each flush writes a block of records.
+    See olof.tools.detectionarchive for the format and a reader.
+    """
+    extension = '.bin'
+
+    def sizeOf(self, data):
+        """
+        Get the size of the given detection when written to disk.
+
+        @param   data (tuple)   The detection: (timestamp, mac, rssi, angle).
+        @return  (int)          The size in bytes.
+        """
+        return olof.tools.detectionarchive.RECORD_SIZE
+
+    def encode(self, buffer):
+        """
+        Encode the given detections as a block.
+
+        @param   buffer (list)   The buffered detections.
+        @return  (str)           The encoded block.
+        """
+        return olof.tools.detectionarchive.encodeBlock(buffer)
+
+class PartitionedLogFile(object):
+    """
+    Class that represents a logfile that is split into a file per day, based on the timestamp of the written data.
+    Partitions of previous days are closed when they have not been written to for an hour, and compressed when enabled.
+    """
+    idleTime = 3600
+
+    def __init__(self, plugin, path, logClass=LogFile):
+        """
+        Initialisation.
+
+        @param   plugin (Plugin)     Reference to main Logger plugin instance.
+        @param   path (str)          Path of the logfile, without date and extension.
+        @param   logClass (class)    The class to use for the partitions. Defaults to LogFile.
+        """
+        self.plugin = plugin
+        self.path = path
+        self.logClass = logClass
+        self.partitions = {}
+        self.closed = False
+        self.formatter = olof.tools.datetimetools.getTimestampFormatter('%Y%m%d')
+
+    def write(self, data, timestamp=None):
+        """
+        Write the given data to the partition corresponding to the timestamp.
+
+        @param   data                 The data to write.
+        @param   timestamp (float)    The UNIX timestamp of the data. Uses the current time when omitted.
+        """
+        day = self.formatter.formatTimestamp(timestamp if timestamp != None else time.time())
+        partition = self.partitions.get(day)
+        if partition == None:
+            partition = self.logClass(self.plugin, '%s-%s%s' % (self.path, day, self.logClass.extension))
+            self.partitions[day] = partition
+        partition.write(data, timestamp)
+
+    def flush(self):
+        """
+        Write the buffers of all partitions to disk. Close partitions of previous days that have been idle long enough.
+        """
+        now = time.time()
+        today = self.formatter.formatTimestamp(now)
+        for day, partition in self.partitions.items():
+            partition.flush()
+            if day != today and now - partition.lastWrite > self.idleTime:
+                del(self.partitions[day])
+                partition.close(compress=True)
+
+    def sync(self):
+        """
+        Make sure the data of all partitions is stored on disk.
+        """
+        for partition in self.partitions.values():
+            partition.sync()
+
+    def close(self):
+        """
+        Flush and close all partitions.
+        """
+        for partition in self.partitions.values():
+            partition.close()
+        self.partitions = {}
+        self.closed = True
+
 class Logger(object):
     """
     Base logger superclass. Serves as common superclass for both Scanner and ScanSetup classes.
@@ -34,6 +557,7 @@ class Logger(object):
         self.project = projectname if projectname != None else 'No-project'
         self.logDir = '/'.join([self.logBase, self.project, self.hostname])
         self.logs = {}
+        self.formatter = olof.tools.datetimetools.getTimestampFormatter('%Y%m%d-%H%M%S-%Z')
 
         if not os.path.exists(self.logDir):
             os.makedirs(self.logDir, mode=0755)
@@ -45,6 +569,18 @@ class Logger(object):
         for f in self.logs.values():
             f.close()
 
+    def flush(self, sync=False):
+        """
+        Write all buffered data to disk.
+
+        @param   sync (bool)   Make sure the data is stored on disk too. Defaults to False.
+        """
+        for f in self.logs.values():
+            if not f.closed:
+                f.flush()
+                if sync:
+                    f.sync()
+
     def formatTimestamp(self, timestamp):
         """
         Format the given UNIX timestamp in the '%Y%m%d-%H%M%S-%Z' format.
@@ -52,7 +588,7 @@ class Logger(object):
         @param   timestamp (int)   The timestamp to convert.
         @return  (str)             The converted timestamp.
         """
-        return time.strftime('%Y%m%d-%H%M%S-%Z', time.localtime(timestamp))
+        return self.formatter.formatTimestamp(timestamp)
 
 class Scanner(Logger):
     """
@@ -66,9 +602,8 @@ class Scanner(Logger):
         Logger.__init__(self, plugin, hostname, projectname)
 
         self.logFiles = ['messages', 'connections']
-        self.logs = dict(zip(self.logFiles, [open('/'.join([
-            self.logDir, '%s-%s.log' % (self.hostname, i)]),
-            'a') for i in self.logFiles]))
+        self.logs = dict(zip(self.logFiles, [self.plugin.openLog(self.logDir, '%s-%s' % (
+            self.hostname, i)) for i in self.logFiles]))
 
         self.host = None
         self.port = None
@@ -88,8 +623,7 @@ class Scanner(Logger):
         @param   info (str)        The actual information to log.
         """
         self.logs['messages'].write(','.join([str(i) for i in [
-            self.formatTimestamp(timestamp), info]]) + '\n')
-        self.logs['messages'].flush()
+            self.formatTimestamp(timestamp), info]]) + '\n', timestamp)
 
     def logConnection(self, timestamp, host, port, action):
         """
@@ -105,8 +639,7 @@ class Scanner(Logger):
             self.port = port
 
         self.logs['connections'].write(','.join([str(i) for i in [
-            self.formatTimestamp(timestamp), host, port, action]]) + '\n')
-        self.logs['connections'].flush()
+            self.formatTimestamp(timestamp), host, port, action]]) + '\n', timestamp)
 
 class ScanSetup(Logger):
     """
@@ -123,9 +656,9 @@ class ScanSetup(Logger):
         self.sensor = sensorMac
 
         self.logFiles = ['scan', 'rssi']
-        self.logs = dict(zip(self.logFiles, [open('/'.join([
-            self.logDir, '%s-%s-%s.log' % (self.hostname, self.sensor, i)]),
-            'a') for i in self.logFiles]))
+        self.binary = plugin.config.getValue('log_format') == 'binary'
+        self.logs = dict(zip(self.logFiles, [self.plugin.openLog(self.logDir, '%s-%s-%s' % (
+            self.hostname, self.sensor, i), binary=(self.binary and i == 'rssi')) for i in self.logFiles]))
 
         self.enableLagLog(plugin.config.getValue('enable_lag_logging'))
 
@@ -138,8 +671,8 @@ class ScanSetup(Logger):
         self.enableLagLogging = value
         if value == True:
             if 'lag' not in self.logs or self.logs['lag'].closed:
-                self.logs['lag'] = open('/'.join([self.logDir, '%s-%s-%s.log' % (
-                    self.hostname, self.sensor, 'lag')]), 'a')
+                self.logs['lag'] = self.plugin.openLog(self.logDir, '%s-%s-%s' % (
+                    self.hostname, self.sensor, 'lag'))
         elif value == False:
             if 'lag' in self.logs and not self.logs['lag'].closed:
                 self.logs['lag'].close()
@@ -153,17 +686,18 @@ class ScanSetup(Logger):
         @param   mac (str)      The Bluetooth MAC-address of the detected device.
         @param   rssi (int)     The value of the Received Signal Strength Indication of the detection.
         """
-        self.logs['rssi'].write(','.join([str(i) for i in [
-            self.formatTimestamp(txtime), mac, rssi, angle]]) + '\n')
-        self.logs['rssi'].flush()
+        if self.binary:
+            self.logs['rssi'].write((txtime, mac, rssi, angle), txtime)
+        else:
+            self.logs['rssi'].write(','.join([str(i) for i in [
+                self.formatTimestamp(txtime), mac, rssi, angle]]) + '\n', txtime)
 
         if self.enableLagLogging:
             self.logs['lag'].write(','.join([str(i) for i in [
                 self.formatTimestamp(txtime), mac, rssi,
                 '%0.4f' % rxtime,
                 '%0.4f' % txtime,
-                '%0.4f' % (rxtime-txtime)]]) + '\n')
-            self.logs['lag'].flush()
+                '%0.4f' % (rxtime-txtime)]]) + '\n', txtime)
 
     def logCell(self, timestamp, mac, deviceclass, move):
         """
@@ -175,8 +709,7 @@ class ScanSetup(Logger):
         @param   move (str)          Whether the device moved 'in' or 'out' the sensor's range.
         """
         self.logs['scan'].write(','.join([str(i) for i in [
-            self.formatTimestamp(timestamp), mac, deviceclass, move]]) + '\n')
-        self.logs['scan'].flush()
+            self.formatTimestamp(timestamp), mac, deviceclass, move]]) + '\n', timestamp)
 
 class Plugin(olof.core.Plugin):
     """
@@ -186,11 +719,23 @@ class Plugin(olof.core.Plugin):
         """
         Initialisation.
         """
-        olof.core.Plugin.__init__(self, server, filename)
+        olof.core.Plugin.__init__(self, server, filename, "Logger")
 
         self.scanSetups = {}
+        self.stats = WriteStats()
+        self.writers = []
+        self.openFiles = {}
+        self.indexes = {}
+        self.compressQueue = []
+        self.compressing = False
+        self.flushSize = self.config.getValue('flush_size')
         self.updateLagConfig()
 
+        self.startWriters()
+        self.flush_loop = task.LoopingCall(self.flush)
+        self.sync_loop = task.LoopingCall(self.flush, sync=True)
+        self.restartFlushLoops()
+
     def defineConfiguration(self):
         """
         Define the configuration options for this plugin.
@@ -199,6 +744,11 @@ class Plugin(olof.core.Plugin):
             v = olof.tools.validation.parseString(value)
             return v.rstrip().rstrip('/')
 
+        def validateChoice(value, choices):
+            if value not in choices:
+                raise olof.tools.validation.ValidationError()
+            return value
+
         options = []
 
         o = olof.configuration.Option('log_directory')
@@ -208,6 +758,61 @@ class Plugin(olof.core.Plugin):
         o.addCallback(self.clearScanSetups)
         options.append(o)
 
+        o = olof.configuration.Option('writer_threads')
+        o.setDescription('Number of threads writing logfiles to disk.')
+        o.setValidation(olof.tools.validation.parseInt)
+        o.addValue(olof.configuration.OptionValue(1, default=True))
+        o.addCallback(self.restartWriters)
+        options.append(o)
+
+        o = olof.configuration.Option('writer_queue_size')
+        o.setDescription('Maximum number of flushed buffers waiting to be written, per writer thread.')
+        o.setValidation(olof.tools.validation.parseInt)
+        o.addValue(olof.configuration.OptionValue(1024, default=True))
+        o.addCallback(self.restartWriters)
+        options.append(o)
+
+        o = olof.configuration.Option('writer_queue_policy')
+        o.setDescription('What to do when data is flushed while the queue of the writer is full.')
+        o.addValue(olof.configuration.OptionValue('block', 'Wait until there is room in the queue. This ' + \
+            'holds up the server.', default=True))
+        o.addValue(olof.configuration.OptionValue('drop-oldest', 'Drop the oldest data in the queue.'))
+        o.addValue(olof.configuration.OptionValue('spill', 'Write the data to a spill file in the log ' + \
+            'directory, which is written to the logfiles when the writer has caught up.'))
+        o.setValidation(validateChoice, ['block', 'drop-oldest', 'spill'])
+        options.append(o)
+
+        o = olof.configuration.Option('max_open_files')
+        o.setDescription('Maximum number of logfiles to keep open. Other logfiles are reopened when written to.')
+        o.setValidation(olof.tools.validation.parseInt)
+        o.addValue(olof.configuration.OptionValue(128, default=True))
+        o.addCallback(self.updateMaxOpenFiles)
+        options.append(o)
+
+        o = olof.configuration.Option('log_format')
+        o.setDescription('Format of the RSSI logfiles.')
+        o.addValue(olof.configuration.OptionValue('csv', 'Comma separated text.', default=True))
+        o.addValue(olof.configuration.OptionValue('binary', 'Binary blocks of columns, see ' + \
+            'olof.tools.detectionarchive. Much smaller and faster to write and analyse.'))
+        o.setValidation(validateChoice, ['csv', 'binary'])
+        o.addCallback(self.clearScanSetups)
+        options.append(o)
+
+        o = olof.configuration.Option('log_partitioning')
+        o.setDescription('How to split logfiles over time.')
+        o.addValue(olof.configuration.OptionValue(None, 'Use a single logfile.', default=True))
+        o.addValue(olof.configuration.OptionValue('day', 'Use a logfile per day, based on the timestamp of the data.'))
+        o.setValidation(validateChoice, [None, 'day'])
+        o.addCallback(self.clearScanSetups)
+        options.append(o)
+
+        o = olof.configuration.Option('log_compression')
+        o.setDescription('How to compress logfiles of previous days, when using partitioning.')
+        o.addValue(olof.configuration.OptionValue(None, 'Do not compress logfiles.', default=True))
+        o.addValue(olof.configuration.OptionValue('gzip', 'Compress logfiles using gzip, in the background.'))
+        o.setValidation(validateChoice, [None, 'gzip'])
+        options.append(o)
+
         o = olof.configuration.Option('enable_lag_logging')
         o.setDescription('Write a separate logfile with detailed timestamps when a detection was registered and ' + \
             'received. Useful for analysing connection lag or performance.')
@@ -216,8 +821,193 @@ class Plugin(olof.core.Plugin):
         o.addCallback(self.updateLagConfig)
         options.append(o)
 
+        o = olof.configuration.Option('flush_interval')
+        o.setDescription('Interval in seconds for writing buffered data to disk.')
+        o.setValidation(olof.tools.validation.parseFloat)
+        o.addValue(olof.configuration.OptionValue(1, default=True))
+        o.addCallback(self.restartFlushLoops)
+        options.append(o)
+
+        o = olof.configuration.Option('flush_size')
+        o.setDescription('Write buffered data of a logfile to disk as soon as it exceeds this number of bytes.')
+        o.setValidation(olof.tools.validation.parseInt)
+        o.addValue(olof.configuration.OptionValue(65536, default=True))
+        o.addCallback(self.updateFlushSize)
+        options.append(o)
+
+        o = olof.configuration.Option('sync_interval')
+        o.setDescription('Interval in seconds for making sure written data is stored on disk (fsync). None to ' + \
+            'leave this to the operating system.')
+        o.setValidation(lambda v: None if v == None else olof.tools.validation.parseFloat(v))
+        o.addValue(olof.configuration.OptionValue(None, default=True))
+        o.addCallback(self.restartFlushLoops)
+        options.append(o)
+
         return options
 
+    def updateMaxOpenFiles(self, value=None):
+        """
+        Update the maximum number of open logfiles, dividing them over the writers.
+        """
+        value = value if value != None else self.config.getValue('max_open_files')
+        for w in self.writers:
+            w.handles.size = max(1, value / len(self.writers))
+
+    def startWriters(self):
+        """
+        Start the writer threads. Spill files left behind earlier are replayed by the first writer.
+        """
+        count = max(1, self.config.getValue('writer_threads'))
+        replay = sorted(glob.glob('%s/.spill-*' % self.config.getValue('log_directory')),
+            key=lambda p: int(p.split('-')[-1]))
+        for i in range(count):
+            self.writers.append(Writer(self, i, self.config.getValue('writer_queue_size'),
+                max(1, self.config.getValue('max_open_files') / count), replay if i == 0 else []))
+
+    def stopWriters(self):
+        """
+        Stop the writer threads, waiting for them to write all queued data. Keep their statistics.
+        """
+        for w in self.writers:
+            w.stop()
+            self.stats.bytes += w.stats.bytes
+            self.stats.flushes += w.stats.flushes
+            self.stats.flush_time += w.stats.flush_time
+            self.stats.max_flush_time = max(self.stats.max_flush_time, w.stats.max_flush_time)
+            self.stats.syncs += w.stats.syncs
+        self.writers = []
+
+    def restartWriters(self, value=None):
+        """
+        Restart the writer threads, f.ex. after changing their number.
+        """
+        self.flush()
+        self.stopWriters()
+        self.startWriters()
+
+    def getWriter(self, path):
+        """
+        Get the writer for the given logfile.
+
+        @param   path (str)   The path of the logfile.
+        @return  (Writer)     The writer for this logfile.
+        """
+        return self.writers[hash(path) % len(self.writers)]
+
+    def logClosed(self, path, compress):
+        """
+        Called by the writer when a logfile has been written and closed.
+
+        @param   path (str)        The path of the logfile.
+        @param   compress (bool)   Whether to compress the logfile.
+        """
+        logfile = self.openFiles.get(path)
+        if logfile != None and logfile.closed:
+            del(self.openFiles[path])
+        if compress:
+            self.compressLog(path)
+
+    def updateFlushSize(self, value=None):
+        """
+        Update the flush size used by the logfiles.
+        """
+        self.flushSize = value if value != None else self.config.getValue('flush_size')
+
+    def restartFlushLoops(self, value=None):
+        """
+        Start or restart the looping calls that flush and sync the logfiles, f.ex. after updating their interval.
+        """
+        for loop in [self.flush_loop, self.sync_loop]:
+            try:
+                loop.stop()
+            except AssertionError:
+                pass
+
+        self.flush_loop.start(self.config.getValue('flush_interval'), now=False)
+        if self.config.getValue('sync_interval') != None:
+            self.sync_loop.start(self.config.getValue('sync_interval'), now=False)
+
+    def flush(self, sync=False):
+        """
+        Write the buffered data of all logfiles to disk.
+
+        @param   sync (bool)   Make sure the data is stored on disk too. Defaults to False.
+        """
+        for ss in self.scanSetups.values():
+            ss.flush(sync)
+
+    def openLog(self, directory, name, binary=False):
+        """
+        Open the logfile with the given name, partitioned as configured.
+
+        @param   directory (str)   The directory of the logfile.
+        @param   name (str)        The name of the logfile, without extension.
+        @param   binary (bool)     Open a BinaryLogFile for detections. Defaults to False.
+        @return  (LogFile)         The logfile, a PartitionedLogFile when partitioning is enabled.
+        """
+        path = '/'.join([directory, name])
+        logClass = BinaryLogFile if binary else LogFile
+        if self.config.getValue('log_partitioning') == 'day':
+            return PartitionedLogFile(self, path, logClass)
+        return logClass(self, path + logClass.extension)
+
+    def getIndex(self, directory):
+        """
+        Get the index of the given log directory.
+
+        @param   directory (str)   The log directory.
+        @return  (LogIndex)        The index of the directory.
+        """
+        if directory not in self.indexes:
+            self.indexes[directory] = LogIndex(directory)
+        return self.indexes[directory]
+
+    def compressLog(self, path):
+        """
+        Compress the given closed logfile in the background, when compression is enabled.
+
+        @param   path (str)   The path of the logfile.
+        """
+        if self.config.getValue('log_compression') == 'gzip':
+            self.compressQueue.append(path)
+            if not self.compressing:
+                self.compressNext()
+
+    def compressNext(self):
+        """
+        Compress the next logfile in the queue. Logfiles are compressed one by one, skipping files that have been
+        reopened in the meantime.
+        """
+        def finished(result, path):
+            try:
+                self.getIndex(os.path.dirname(path)).rename(os.path.basename(path), os.path.basename(path) + '.gz')
+            except (IOError, OSError) as e:
+                self.logger.logException(e, "Failed to update the index for %s" % path)
+            self.compressNext()
+
+        def failed(failure, path):
+            self.logger.logError("Failed to compress %s: %s" % (path, failure.getErrorMessage()))
+            try:
+                if os.path.exists(path + '.compressing') and not os.path.exists(path):
+                    os.rename(path + '.compressing', path)
+            except OSError as e:
+                self.logger.logException(e, "Failed to restore %s" % path)
+            self.compressNext()
+
+        while len(self.compressQueue) > 0:
+            path = self.compressQueue.pop(0)
+            if path in self.openFiles or not os.path.isfile(path):
+                continue
+
+            # Move the logfile out of the way, in case data for this partition arrives during compression.
+            os.rename(path, path + '.compressing')
+            self.compressing = True
+            d = threads.deferToThread(compressFile, path + '.compressing', path + '.gz')
+            d.addCallbacks(finished, failed, callbackArgs=(path,), errbackArgs=(path,))
+            return
+
+        self.compressing = False
+
     def clearScanSetups(self, value=None):
         """
         Close and clear all saved scanSetups, they will be recreated when necessary.
@@ -239,11 +1029,47 @@ class Plugin(olof.core.Plugin):
 
     def unload(self, shutdown=False):
         """
-        Unload. Unload all Logger instances.
+        Unload. Stop flushing and unload all Logger instances.
         """
         olof.core.Plugin.unload(self)
+        for loop in [self.flush_loop, self.sync_loop]:
+            try:
+                loop.stop()
+            except AssertionError:
+                pass
+
         for ss in self.scanSetups.values():
             ss.unload()
+        self.stopWriters()
+
+    def getStatus(self):
+        """
+        Return the amount of data written, the state of the writers and the write latency. For use in the status
+        plugin.
+        """
+        stats = [self.stats] + [w.stats for w in self.writers]
+        flushes = sum([s.flushes for s in stats])
+        opens = sum([w.handles.opens for w in self.writers])
+        reopens = sum([w.handles.reopens for w in self.writers])
+
+        r = [{'status': 'ok'}]
+        r.append({'id': 'written', 'str': '%0.1f MiB' % (sum([s.bytes for s in stats]) / 1048576.0)})
+        r.append({'id': 'open files', 'str': '%i of %i' % (sum([len(w.handles.handles) for w in self.writers]),
+            sum([w.handles.size for w in self.writers]))})
+        if opens > 0:
+            r.append({'id': 'reopened files', 'str': '%i (%0.1f %%)' % (reopens, reopens * 100.0 / opens)})
+        r.append({'id': 'write queue', 'int': sum([len(w.tasks) for w in self.writers])})
+        dropped = sum([w.dropped for w in self.writers])
+        if dropped > 0:
+            r.append({'id': 'dropped', 'str': '%0.1f KiB' % (dropped / 1024.0)})
+        spilled = sum([w.spilled for w in self.writers])
+        if spilled > 0:
+            r.append({'id': 'spilled', 'int': spilled})
+        if flushes > 0:
+            r.append({'id': 'write latency', 'str': '%0.2f ms average, %0.2f ms max' % (
+                sum([s.flush_time for s in stats]) * 1000 / flushes,
+                max([s.max_flush_time for s in stats]) * 1000)})
+        return r
 
     def getScanSetup(self, hostname, projectname, sensorMac):
         """
@@ -13,7 +13,7 @@ ENABLED = False
 
 from twisted.internet import reactor, task
 
-import copy
+import collections
 import os
 import re
 import time
@@ -22,10 +22,13 @@ import urllib2
 import olof.configuration
 import olof.core
 import olof.plugins.alert
+import olof.plugins.move.backlog as backlog
+import olof.plugins.move.controller as controller
 import olof.storagemanager
+import olof.tools.validation
 
-from olof.tools.datetimetools import getRelativeTime
-from olof.tools.webprotocols import RESTConnection
+from olof.tools.datetimetools import formatTimestamp, getRelativeTime, getTimestampFormatter
+from olof.tools.webprotocols import RESTConnection, StreamBody
 
 class Connection(RESTConnection):
     """
@@ -38,13 +41,22 @@ class Connection(RESTConnection):
 
         Start looping calls that upload measurements and locations.
 
+        Measurements are uploaded in up to 'upload_connections' concurrent requests, each for a different set of
+        scanners so the measurements of a scanner are uploaded in order. Requests for scanner, project and location
+        data are queued and sent one at a time, independent of the measurement uploads. The lists of scanners and
+        projects are cached, and refreshed every 'metadata_refresh' seconds. The size of the uploads and the upload
+        interval are tuned by an UploadController.
+
+        Measurements are kept in a SensorBacklog for each sensor and written to disk every 'backlog_flush_interval'
+        seconds, or when more than 'backlog_memory' measurements are in memory. Uploads are read from disk.
+
         @param   plugin (Plugin)       Reference to main Move plugin instance.
         @param   url (str)             Base URL of the Move REST interface.
         @param   user (str)            Username to log in on the server.
         @param   password (str)        Password to log in on the server.
         @param   scanners (dict)       Cached scanners. Optional.
         @param   projects (dict)       Cached projects. Optional.
-        @param   measurements (dict)   Cached measurements. Optional.
+        @param   measurements (dict)   Backlogs of the sensors. Optional.
         @param   measureCount (dict)   Cache statistics. Optional.
         @param   locations (dict)      Cached location data. Optional.
         """
@@ -53,9 +65,16 @@ class Connection(RESTConnection):
         self.server = self.plugin.server
         self.scanners = scanners
         self.projects = projects
-        self.requestRunning = False
+        self.metadataQueue = collections.deque()
+        self.metadataRunning = False
+        self.metadataUpdated = {'scanner': time.time(), 'project': time.time()}
+        self.postingLocations = False
+        self.uploads = 0
         self.lastError = None
         self.measurements = measurements
+        self.pending = 0
+        self.flushFailed = False
+        self.dropped = 0
         self.getProjects(self.getScanners, self.getLocations)
 
         if len(measureCount) == 0:
@@ -67,8 +86,11 @@ class Connection(RESTConnection):
 
         self.locations = locations
 
+        self.controller = controller.UploadController(self.plugin.config.getValue('max_request_size'),
+            self.plugin.config.getValue('upload_interval'), self.timeout)
         self.task_postM = task.LoopingCall(self.postMeasurements)
         self.task_postL = task.LoopingCall(self.postLocations)
+        self.task_flush = task.LoopingCall(self.flushBacklogs)
         self.init()
 
     def init(self):
@@ -76,14 +98,22 @@ class Connection(RESTConnection):
         Start the looping calls for uploads.
         """
         self.uploadInterval = self.plugin.config.getValue('upload_interval')
-        self.task_postM.start(self.uploadInterval, now=False)
-        reactor.callLater(int(self.uploadInterval * (2.0/3.0)), self.task_postL.start,
+        self.controller.configure(self.plugin.config.getValue('max_request_size'), self.uploadInterval)
+        self.stopped = False
+        self.task_postM.start(self.controller.interval, now=False)
+        self.call_postL = reactor.callLater(int(self.uploadInterval * (2.0/3.0)), self.task_postL.start,
             self.uploadInterval, now=False)
+        self.task_flush.start(self.plugin.config.getValue('backlog_flush_interval'), now=False)
 
     def unload(self, shutdown=False):
         """
-        Unload the connection, stopping looping calls.
+        Unload the connection, stopping looping calls. Uploads that are running are finished, but do not start new
+        uploads.
         """
+        self.stopped = True
+        if self.call_postL.active():
+            self.call_postL.cancel()
+
         try:
             self.task_postM.stop()
         except AssertionError:
@@ -94,6 +124,62 @@ class Connection(RESTConnection):
         except AssertionError:
             pass
 
+        try:
+            self.task_flush.stop()
+        except AssertionError:
+            pass
+
+    def flushBacklogs(self):
+        """
+        Write the measurements in memory to the backlogs on disk.
+        """
+        failed = False
+        for b in self.measurements.values():
+            try:
+                b.flush()
+            except (IOError, OSError) as e:
+                if not failed and not self.flushFailed:
+                    self.plugin.logger.logException(e, "Could not write the backlog of %s to disk" % b.sensor)
+                failed = True
+
+        self.flushFailed = failed
+        self.pending = sum(len(b.buffer) for b in self.measurements.values())
+
+    def requestMetadata(self, method, resource, callback, body=None):
+        """
+        Queue a request for scanner, project or location data. These requests are sent one at a time, in the order
+        they were queued.
+
+        @param   method (str)        The HTTP method, 'get' or 'post'.
+        @param   resource (str)      The resource to call.
+        @param   callback (method)   Function to call with the result of the request.
+        @param   body (str)          The data to post. Optional.
+        """
+        self.metadataQueue.append((method, resource, callback, body))
+        self.nextMetadata()
+
+    def nextMetadata(self):
+        """
+        Send the next queued metadata request, unless a request is running.
+        """
+        if self.metadataRunning or len(self.metadataQueue) == 0:
+            return
+
+        method, resource, callback, body = self.metadataQueue.popleft()
+
+        def process(r):
+            self.metadataRunning = False
+            try:
+                callback(r)
+            finally:
+                self.nextMetadata()
+
+        self.metadataRunning = True
+        if method == 'get':
+            self.requestGet(resource, process)
+        else:
+            self.requestPost(resource, process, body, {'Content-Type': 'text/plain'})
+
     def getScanners(self, callback=None, *args):
         """
         Get the list of scanners from the Move database and update local scanner data.
@@ -103,7 +189,6 @@ class Connection(RESTConnection):
         @return   (str)      Result of the query.
         """
         def process(r):
-            self.requestRunning = False
             alertPlugin = self.plugin.server.pluginmgr.getPlugin('alert')
             if type(r) is IOError:
                 self.lastError = str(r)
@@ -121,6 +206,7 @@ class Connection(RESTConnection):
             else:
                 self.lastError = None
             if r != None:
+                self.metadataUpdated['scanner'] = time.time()
                 for s in r:
                     ls = s.strip().split(',')
                     self.scanners[ls[0]] = True
@@ -128,11 +214,7 @@ class Connection(RESTConnection):
                     callback(*args)
             return r
 
-        if self.requestRunning:
-            return
-
-        self.requestRunning = True
-        self.requestGet('scanner', process)
+        self.requestMetadata('get', 'scanner', process)
 
     def getProjects(self, callback=None, *args):
         """
@@ -143,7 +225,6 @@ class Connection(RESTConnection):
         @return   (str)      Result of the query.
         """
         def process(r):
-            self.requestRunning = False
             alertPlugin = self.plugin.server.pluginmgr.getPlugin('alert')
             if type(r) is IOError:
                 self.lastError = str(r)
@@ -161,6 +242,7 @@ class Connection(RESTConnection):
             else:
                 self.lastError = None
             if r != None:
+                self.metadataUpdated['project'] = time.time()
                 for s in r:
                     ls = s.strip().split(',')
                     self.projects[ls[0]] = True
@@ -168,8 +250,7 @@ class Connection(RESTConnection):
                     callback(*args)
             return r
 
-        self.requestRunning = True
-        self.requestGet('project', process)
+        self.requestMetadata('get', 'project', process)
 
     def getLocations(self, callback=None, *args):
         """
@@ -180,7 +261,6 @@ class Connection(RESTConnection):
         @return   (str)      Result of the query.
         """
         def process(r):
-            self.requestRunning = False
             alertPlugin = self.plugin.server.pluginmgr.getPlugin('alert')
             if type(r) is IOError:
                 self.lastError = str(r)
@@ -213,8 +293,7 @@ class Connection(RESTConnection):
                     callback(*args)
             return r
 
-        self.requestRunning = True
-        self.requestGet('scanner/location', process)
+        self.requestMetadata('get', 'scanner/location', process)
 
     def addScanner(self, mac, description):
         """
@@ -224,7 +303,6 @@ class Connection(RESTConnection):
         @param   description (str)   Description of the scanner.
         """
         def process(r):
-            self.requestRunning = False
             if type(r) is IOError:
                 self.lastError = str(r)
                 self.plugin.logger.logError("POST/scanner request failed: %s" % str(r))
@@ -232,9 +310,7 @@ class Connection(RESTConnection):
                 self.lastError = None
             self.getScanners()
 
-        self.requestRunning = True
-        self.requestPost('scanner', process, '%s,%s' % (mac, description.replace(',', '')),
-            {'Content-Type': 'text/plain'})
+        self.requestMetadata('post', 'scanner', process, '%s,%s' % (mac, description.replace(',', '')))
 
     def addProject(self, id, name):
         """
@@ -244,7 +320,6 @@ class Connection(RESTConnection):
         @param   name (str)         Name of the project.
         """
         def process(r):
-            self.requestRunning = False
             if type(r) is IOError:
                 self.lastError = str(r)
                 self.plugin.logger.logError("POST/project request failed: %s" % str(r))
@@ -252,9 +327,7 @@ class Connection(RESTConnection):
                 self.lastError = None
             self.getProjects()
 
-        self.requestRunning = True
-        self.requestPost('project', process, '%s,%s' % (id, name.replace(',', '')),
-            {'Content-Type': 'text/plain'})
+        self.requestMetadata('post', 'project', process, '%s,%s' % (id, name.replace(',', '')))
 
     def addLocation(self, sensor, project, timestamp, coordinates, description):
         """
@@ -289,7 +362,7 @@ class Connection(RESTConnection):
         Upload the pending location updates to the Move database.
         """
         def process(r):
-            self.requestRunning = False
+            self.postingLocations = False
             if type(r) is IOError:
                 self.lastError = str(r)
                 self.plugin.logger.logError("POST/scanner/location request failed: %s" % str(r))
@@ -301,7 +374,7 @@ class Connection(RESTConnection):
                     for l in self.locations[scanner]:
                         l[1] = True
 
-        if self.requestRunning:
+        if self.postingLocations:
             return
 
         l = ""
@@ -317,25 +390,24 @@ class Connection(RESTConnection):
             loc = []
             for location in [l[0] for l in self.locations[scanner] if l[1] == False]:
                 if location[1] != None:
-                    loc.append(','.join([time.strftime('%Y%m%d-%H%M%S.000-%Z',
-                        time.localtime(location[0])),
+                    loc.append(','.join([formatTimestamp(location[0], '%Y%m%d-%H%M%S.000-%Z'),
                         'SRID=4326;POINT(%0.6f %0.6f)' % location[1],
                         'EWKT', location[2], location[3]]))
                 else:
-                    loc.append(','.join([time.strftime('%Y%m%d-%H%M%S.000-%Z',
-                        time.localtime(location[0])), 'NULL', 'NULL', '', 'NULL']))
+                    loc.append(','.join([formatTimestamp(location[0], '%Y%m%d-%H%M%S.000-%Z'),
+                        'NULL', 'NULL', '', 'NULL']))
             l_scanner.append("\n".join(loc))
 
         l = '\n'.join(l_scanner)
         if len(l) > 0:
             self.plugin.logger.debug("move: Posting location: %s" % l)
-            self.requestRunning = True
-            self.requestPost('scanner/location', process, l,
-                {'Content-Type': 'text/plain'})
+            self.postingLocations = True
+            self.requestMetadata('post', 'scanner/location', process, l)
 
     def addMeasurement(self, sensor, project, timestamp, mac, deviceclass, rssi):
         """
-        Add a measurement to the local measurement list.
+        Add a measurement to the backlog of the sensor. When the measurements in memory exceed 'backlog_memory' and
+        cannot be written to disk, the measurement is dropped.
 
         @param   sensor (str)        MAC-address of the Bluetooth sensor that detected the device.
         @param   project (Project)   Project of the sensor that detected the device.
@@ -345,7 +417,7 @@ class Connection(RESTConnection):
         @param   rssi (int)          Value for the Received Signal Strength Indication for the detection.
         """
         if not sensor in self.measurements:
-            self.measurements[sensor] = set()
+            self.measurements[sensor] = backlog.SensorBacklog(self.plugin.backlogPath, sensor)
 
         if not sensor in self.scanners:
             self.addScanner(sensor, 'test scanner')
@@ -355,77 +427,117 @@ class Connection(RESTConnection):
             self.addProject(project.id, project.name)
             self.projects[project.id] = project.name
 
-        tm = "%0.3f" % timestamp
-        decSec = tm[tm.find('.')+1:]
-        decSec += "0" * (3-len(decSec))
-        self.measurements[sensor].add(','.join([time.strftime('%Y%m%d-%H%M%S.%%s-%Z',
-            time.localtime(timestamp)) % decSec, mac, str(deviceclass), str(rssi)]))
+        if self.pending >= self.plugin.config.getValue('backlog_memory'):
+            if not self.flushFailed:
+                self.flushBacklogs()
+            if self.pending >= self.plugin.config.getValue('backlog_memory'):
+                self.dropped += 1
+                return
+
+        if self.measurements[sensor].add(timestamp, mac, deviceclass, rssi):
+            self.pending += 1
 
     def postMeasurements(self):
         """
-        Upload pending measurements to the Move database.
+        Refresh the cached scanner and project lists when they are outdated, and start uploading pending measurements.
         """
-        def upload(*args):
-            m = ""
-            m_scanner = []
-            self.plugin.logger.debug("Posting measurements")
+        if not self.plugin.config.getValue('upload_enabled'):
+            return
+
+        now = time.time()
+        refresh = self.plugin.config.getValue('metadata_refresh')
+        if now - self.metadataUpdated['scanner'] > refresh:
+            self.metadataUpdated['scanner'] = now
+            self.getScanners()
+        if now - self.metadataUpdated['project'] > refresh:
+            self.metadataUpdated['project'] = now
+            self.getProjects()
+
+        self.startUploads()
+
+    def startUploads(self):
+        """
+        Start uploading pending measurements, as long as fewer than 'upload_connections' uploads are running. Each
+        upload takes up to the current batch size of measurements of scanners that are not in another upload. The
+        measurements in memory are written to disk first, as uploads are read from disk.
+        """
+        if self.stopped or not self.plugin.config.getValue('upload_enabled'):
+            return
+
+        self.flushBacklogs()
+
+        connections = self.plugin.config.getValue('upload_connections')
+        max_request_size = self.controller.batchSize
+        pending = [s for s in self.scanners.keys() if (self.scanners[s] == True \
+            and s in self.measurements and s in self.locations and not self.measurements[s].uploading and \
+            self.measurements[s].getStoredCount() > 0 and (False not in [i[1] for i in self.locations[s]]))]
+
+        while self.uploads < connections and len(pending) > 0:
+            batch = []
             linecount = 0
-            for scanner in [s for s in self.scanners.keys() if (self.scanners[s] == True \
-                and s in self.measurements and s in self.locations and \
-                (False not in [i[1] for i in self.locations[s]]))]:
-                if linecount < max_request_size:
-                    mc = copy.deepcopy(self.measurements[scanner])
-                    measurements_uploaded[scanner] = set()
-                    for l in mc:
-                        if linecount < max_request_size:
-                            measurements_uploaded[scanner].add(l)
-                            linecount += 1
-
-                    if len(measurements_uploaded[scanner]) > 0:
-                        self.plugin.logger.debug("Adding %i measurements for scanner %s" % (len(
-                            measurements_uploaded[scanner]), scanner))
-                        m_scanner.append("==%s" % scanner)
-                        m_scanner.append("\n".join(measurements_uploaded[scanner]))
-                        to_delete.append((scanner, len(measurements_uploaded[scanner])))
-
-            m = '\n'.join(m_scanner)
-            if len(m) > 0:
-                self.requestRunning = True
-                self.timeRequestStart = time.time()
-                self.requestSize = linecount
-                self.plugin.logger.debug("Sending request with %i lines" % linecount)
-                self.requestPost('measurement', process, m,
-                    {'Content-Type': 'text/plain'})
+            while len(pending) > 0 and linecount < max_request_size:
+                scanner = pending.pop(0)
+                count = min(self.measurements[scanner].getStoredCount(), max_request_size - linecount)
+                self.plugin.logger.debug("Adding %i measurements for scanner %s" % (count, scanner))
+                batch.append((scanner, self.measurements[scanner].committed, count))
+                linecount += count
+            self.uploadMeasurements(batch, linecount)
+
+    def uploadMeasurements(self, batch, linecount):
+        """
+        Upload the given measurements to the Move database. The measurements are committed when the upload succeeds.
+
+        @param   batch (list)      List of (scanner, start, count) tuples, the index of the first measurement and the
+                                     number of measurements to upload for each scanner.
+        @param   linecount (int)   The total number of measurements in the batch.
+        """
+        def generate():
+            separator = ''
+            for scanner, start, count in batch:
+                yield '%s==%s' % (separator, scanner)
+                separator = '\n'
+                for line in self.measurements[scanner].formatLines(start, count):
+                    yield '\n' + line
 
         def process(r):
             self.plugin.logger.debug("Request done")
-            self.timeRequestFinish = time.time()
-            self.requestRunning = False
+            timeRequestFinish = time.time()
+            self.uploads -= 1
+            for scanner, start, count in batch:
+                self.measurements[scanner].uploading = False
             if type(r) is IOError:
                 self.lastError = str(r)
             else:
                 self.lastError = None
             alertPlugin = self.plugin.server.pluginmgr.getPlugin('alert')
-            if r != None and type(r) is list and len(r) == len(to_delete):
+            rejected = False
+            if r != None and type(r) is list and len(r) == len(batch):
                 self.measureCount['uploads'] += 1
                 self.measureCount['last_upload'] = int(time.time())
                 uploadSize = 0
                 for i in range(len(r)):
-                    scanner = to_delete.pop(0)
-                    move_lines = int(r.pop(0).strip().split(',')[1])
-                    uploaded_lines = scanner[1]
+                    scanner, start, uploaded_lines = batch[i]
+                    move_lines = int(r[i].strip().split(',')[1])
 
                     if move_lines == uploaded_lines:
-                        self.plugin.logger.debug("Upload for scanner %s: OK" % scanner[0])
+                        self.plugin.logger.debug("Upload for scanner %s: OK" % scanner)
                         uploadSize += uploaded_lines
-                        for l in measurements_uploaded[scanner[0]]:
-                            self.measurements[scanner[0]].remove(l)
+                        try:
+                            self.measurements[scanner].commit(start, uploaded_lines)
+                        except (IOError, OSError) as e:
+                            self.plugin.logger.logException(e, "Could not commit the backlog of %s" % scanner)
                     else:
-                        self.plugin.logger.logError("Upload for scanner %s: FAIL" % scanner[0])
+                        self.plugin.logger.logError("Upload for scanner %s: FAIL" % scanner)
+                        rejected = True
                 if len(self.measureCount['recent_uploads']) > (self.plugin.maxRecent - 1):
                     self.measureCount['recent_uploads'].pop(0)
                 self.measureCount['recent_uploads'].append(uploadSize)
                 self.measureCount['uploaded'] += uploadSize
+                # Measurements that were not accepted are retried, so back off as for a failed upload.
+                if rejected:
+                    self.controller.failure()
+                else:
+                    self.controller.success(uploadSize, timeRequestFinish - timeRequestStart)
                 success = True
                 if alertPlugin != None:
                     a = alertPlugin.mailer.getAlerts(self.plugin.filename,
@@ -437,6 +549,7 @@ class Connection(RESTConnection):
             else:
                 self.plugin.logger.logError("Upload failed: %s" % str(r))
                 self.measureCount['failed_uploads'] += 1
+                self.controller.failure()
                 success = False
                 if alertPlugin != None:
                     a = alertPlugin.mailer.getAlerts(self.plugin.filename,
@@ -447,24 +560,27 @@ class Connection(RESTConnection):
                             info=1, warning=5, alert=10, fire=20))
 
             if self.plugin.config.getValue('performance_log'):
-                rS = time.strftime("%Y%m%d-%H%M%S-%Z", time.localtime(self.timeRequestStart))
-                rF = time.strftime("%Y%m%d-%H%M%S-%Z", time.localtime(self.timeRequestFinish))
-                rD = '%0.3f' % (self.timeRequestFinish - self.timeRequestStart)
+                rS, rF = getTimestampFormatter().formatTimestamps([timeRequestStart, timeRequestFinish])
+                rD = '%0.3f' % (timeRequestFinish - timeRequestStart)
                 rR = "finished" if success else "failed"
                 self.plugin.logger.logInfo("Upload %s: " % rR + ','.join([str(i) for i in \
-                    rS, rF, '%0.3f' % self.timeRequestStart, '%0.3f' % self.timeRequestFinish,
-                    rD, self.requestSize]))
+                    rS, rF, '%0.3f' % timeRequestStart, '%0.3f' % timeRequestFinish,
+                    rD, linecount]))
 
-        if self.requestRunning or not self.plugin.config.getValue('upload_enabled'):
-            return
+            if self.task_postM.running and self.task_postM.interval != self.controller.interval:
+                self.task_postM.interval = self.controller.interval
 
-        if sum(len(self.measurements[i]) for i in self.measurements) > 0:
-            if self.plugin.config.getValue('performance_log'):
-                self.timeRequestStart = self.timeRequestFinish = 0
-            to_delete = []
-            measurements_uploaded = {}
-            max_request_size = self.plugin.config.getValue('max_request_size')
-            self.getScanners(upload)
+            # Keep the pipeline full while there is a backlog, failed uploads are retried at the next interval.
+            if success and not rejected and not self.stopped:
+                self.startUploads()
+
+        # Uploads start at the committed index, so a backlog can only be in one upload at a time, of any Connection.
+        for scanner, start, count in batch:
+            self.measurements[scanner].uploading = True
+        self.uploads += 1
+        timeRequestStart = time.time()
+        self.plugin.logger.debug("Sending request with %i lines" % linecount)
+        self.requestPost('measurement', process, StreamBody(generate), {'Content-Type': 'text/plain'})
 
 class Plugin(olof.core.Plugin):
     """
@@ -472,7 +588,7 @@ class Plugin(olof.core.Plugin):
     """
     def __init__(self, server, filename):
         """
-        Initialisation. Read previously saved data from disk and create Connection.
+        Initialisation.
 
         @param   server (Olof)   Reference to main Olof server instance.
         """
@@ -481,6 +597,8 @@ class Plugin(olof.core.Plugin):
         self.last_session_id = None
         self.conn = None
         self.maxRecent = 60
+        self.stateImported = False
+        self.backlogPath = self.storage.getPath('backlog')
 
         measureCount = {'last_upload': -1,
                         'uploads': 0,
@@ -488,24 +606,91 @@ class Plugin(olof.core.Plugin):
                         'failed_uploads': 0,
                         'recent_uploads': []}
 
-        self.measureCount = self.storage.loadObject('measureCount', measureCount)
+        self.measureCount = measureCount
+        self.measurements = {}
+        self.locations = {}
+        self.scanners = {}
+        self.projects = {}
+
+    def exportState(self):
+        """
+        Pass the cached data on to the reloaded plugin.
+        """
+        if not self.warmedUp:
+            return None
+        if self.conn != None:
+            self.conn.flushBacklogs()
+        source = self.conn if self.conn != None else self
+        return dict((i, getattr(source, i)) for i in [
+            'measureCount', 'measurements', 'locations', 'scanners', 'projects'])
+
+    def importState(self, state):
+        """
+        Use the cached data of the previous plugin instance.
+        """
+        if state != None:
+            self.stateImported = True
+            for i in state:
+                setattr(self, i, state[i])
+            self.convertMeasurements()
+
+    def warmup(self):
+        """
+        Read previously saved data from disk, unless received from the previous plugin instance.
+        """
+        if self.stateImported:
+            return
+
+        self.measureCount = self.storage.loadObject('measureCount', self.measureCount)
         self.measurements = self.storage.loadObject('measurements', {})
         self.locations = self.storage.loadObject('locations', {})
         self.scanners = self.storage.loadObject('scanners', {})
         self.projects = self.storage.loadObject('projects', {})
+        self.convertMeasurements()
+
+        for sensor, b in backlog.openBacklogs(self.backlogPath).iteritems():
+            if not sensor in self.measurements:
+                self.measurements[sensor] = b
 
+        path = self.storage.getPath('measurements')
+        if os.path.isfile(path):
+            os.remove(path)
+
+    def convertMeasurements(self):
+        """
+        Move measurements kept in memory by previous versions, sets of CSV lines, to the backlogs on disk.
+        """
+        for sensor in self.measurements.keys():
+            m = self.measurements[sensor]
+            if not isinstance(m, backlog.SensorBacklog):
+                b = backlog.SensorBacklog(self.backlogPath, sensor)
+                for line in sorted(m):
+                    b.buffer.addLine(line)
+                b.flush()
+                self.measurements[sensor] = b
+
+    def activate(self):
+        """
+        Create the Connection.
+        """
         self.setupConnection()
 
     def setupConnection(self, value=None):
         """
         Setup the Move API REST connection.
         """
+        if not self.warmedUp:
+            return
+
         url = self.config.getValue('url')
         user = self.config.getValue('username')
         password = self.config.getValue('password')
         scanners = dict(zip(self.scanners.keys(), [False] * len(self.scanners)))
         projects = dict(zip(self.projects.keys(), [False] * len(self.projects)))
 
+        if self.conn != None:
+            self.conn.unload()
+
         if None not in [url, user, password]:
             self.conn = Connection(self, url, user, password, scanners, projects, self.measurements, self.measureCount,
                 self.locations)
@@ -543,8 +728,24 @@ class Plugin(olof.core.Plugin):
         options.append(o)
 
         o = olof.configuration.Option('max_request_size')
-        o.setDescription('The maximum number of detections that can be uploaded in one request.')
+        o.setDescription('The maximum number of detections that can be uploaded in one request. The actual number ' + \
+            'is tuned to the time the recent uploads took, up to this maximum.')
         o.addValue(olof.configuration.OptionValue(200000, default=True))
+        o.addCallback(self.restartUploads)
+        options.append(o)
+
+        o = olof.configuration.Option('upload_connections')
+        o.setDescription('The maximum number of measurement uploads running at the same time. Each upload contains ' + \
+            'the measurements of different scanners.')
+        o.setValidation(olof.tools.validation.parseInt)
+        o.addValue(olof.configuration.OptionValue(2, default=True))
+        options.append(o)
+
+        o = olof.configuration.Option('metadata_refresh')
+        o.setDescription('The amount of seconds after which the cached lists of scanners and projects are ' + \
+            'requested again from the MOVE database.')
+        o.setValidation(olof.tools.validation.parseInt)
+        o.addValue(olof.configuration.OptionValue(600, default=True))
         options.append(o)
 
         o = olof.configuration.Option('upload_interval')
@@ -554,6 +755,20 @@ class Plugin(olof.core.Plugin):
         o.addCallback(self.restartUploads)
         options.append(o)
 
+        o = olof.configuration.Option('backlog_memory')
+        o.setDescription('The maximum number of detections kept in memory. Detections are written to the backlog ' + \
+            'on disk when this is exceeded; when the backlog cannot be written, new detections are dropped.')
+        o.setValidation(olof.tools.validation.parseInt)
+        o.addValue(olof.configuration.OptionValue(100000, default=True))
+        options.append(o)
+
+        o = olof.configuration.Option('backlog_flush_interval')
+        o.setDescription('The amount of seconds between writing the detections in memory to the backlog on disk.')
+        o.setValidation(olof.tools.validation.parseInt)
+        o.addValue(olof.configuration.OptionValue(5, default=True))
+        o.addCallback(self.restartUploads)
+        options.append(o)
+
         o = olof.configuration.Option('upload_enabled')
         o.setDescription('Whether uploading detections to the MOVE database is enabled.')
         o.addValue(olof.configuration.OptionValue(True, default=True))
@@ -584,8 +799,8 @@ class Plugin(olof.core.Plugin):
         olof.core.Plugin.unload(self, shutdown)
         if self.conn != None:
             self.conn.unload()
+            self.conn.flushBacklogs()
             self.storage.storeObject(self.conn.measureCount, 'measureCount')
-            self.storage.storeObject(self.conn.measurements, 'measurements')
             self.storage.storeObject(self.conn.locations, 'locations')
             self.storage.storeObject(self.conn.scanners, 'scanners')
             self.storage.storeObject(self.conn.projects, 'projects')
@@ -614,7 +829,7 @@ class Plugin(olof.core.Plugin):
 
         elif cache > 0 and (now - m['last_upload']) > (self.conn.uploadInterval*5):
             r.append({'status': 'error'})
-        elif self.conn.lastError != None:
+        elif self.conn.lastError != None or self.conn.flushFailed:
             r.append({'status': 'error'})
         else:
             r.append({'status': 'ok'})
@@ -622,6 +837,13 @@ class Plugin(olof.core.Plugin):
         if self.conn.lastError != None:
             r.append({'id': 'error', 'str': self.conn.lastError.lower()})
 
+        if self.conn.flushFailed:
+            r.append({'id': 'backlog', 'str': 'write failed'})
+
+        if self.conn.dropped > 0:
+            r.append({'id': '<span title="Detections dropped as the backlog could not be written">dropped</span>',
+                      'int': self.conn.dropped})
+
         if m['last_upload'] > 0:
             r.append({'id': 'last upload', 'time': m['last_upload']})
         elif m['last_upload'] < 0 and self.conn.lastError == None:
@@ -633,23 +855,39 @@ class Plugin(olof.core.Plugin):
                                 m['failed_uploads'], tU),
                       'str': '%0.2f %%' % (((m['uploads'] * 1.0) / tU) * 100)})
 
-        firstData = None
-        if cache <= (self.config.getValue('max_request_size') / 4): # Too CPU intensive for big cache.
-            firstData = time.localtime()
-            for s in self.measurements.values():
-                for l in s:
-                    t = time.strptime(l[:15] + l[19:l.find(',')], "%Y%m%d-%H%M%S-%Z")
-                    firstData = min(t, firstData)
-
         if cache > 0:
-            if firstData != None:
-                r.append({'id': '<span title="Data since: %s – %s">cached</span>' % (
-                                    time.strftime("%a %Y-%m-%d %H:%M:%S", firstData),
-                                    getRelativeTime(int(time.strftime("%s", firstData)))),
-                          'int': cache})
-            else:
-                r.append({'id': 'cached', 'int': cache})
-
+            oldest = [b.getOldest() for b in self.measurements.values() if len(b) > 0]
+            newest = [b.getNewest() for b in self.measurements.values() if len(b) > 0]
+            firstData = time.localtime(min([now] + oldest))
+            lastData = time.localtime(max(newest))
+            r.append({'id': '<span title="Data since: %s – %s; up to %s">cached</span>' % (
+                                time.strftime("%a %Y-%m-%d %H:%M:%S", firstData),
+                                getRelativeTime(int(time.strftime("%s", firstData))),
+                                time.strftime("%a %Y-%m-%d %H:%M:%S", lastData)),
+                      'int': cache})
+
+            size = sum(b.getStoredSize() for b in self.measurements.values())
+            if size > 0:
+                r.append({'id': '<span title="Size of the backlog on disk">backlog</span>',
+                          'str': '%0.1f MiB' % (size / 1048576.0)})
+
+        if self.conn.uploads > 0:
+            r.append({'id': '<span title="Uploads running; %i scanners">uploading</span>' % len(
+                [b for b in self.measurements.values() if b.uploading]),
+                      'int': self.conn.uploads})
+
+        c = self.conn.controller
+        if self.config.getValue('upload_enabled') == True:
+            r.append({'id': '<span title="Number of detections per upload, tuned up to %i">upload size</span>' % (
+                                c.maxSize),
+                      'int': c.batchSize})
+            if c.latency != None:
+                r.append({'id': '<span title="Average duration of the recent uploads">upload latency</span>',
+                          'str': '%0.1f s' % c.latency})
+            if c.interval != c.baseInterval:
+                r.append({'id': '<span title="Upload interval, backing off after %i failed uploads">interval</span>' % (
+                                    c.failures),
+                          'str': '%i s' % c.interval})
 
         if self.conn.lastError == None and self.config.getValue('upload_enabled') == True:
             if m['uploads'] > 0:
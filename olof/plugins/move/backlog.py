@@ -0,0 +1,377 @@
+#-*- coding: utf-8 -*-
+#
+# This file belongs to Gyrid Server.
+#
+# Copyright (C) 2012  Roel Huybrechts
+# All rights reserved.
+
+"""
+Module providing the disk-backed backlog of measurements waiting to be uploaded to the Move database.
+"""
+
+import bisect
+import collections
+import glob
+import os
+import re
+import struct
+
+import olof.plugins.move.measurements as measurements
+
+def openBacklogs(path):
+    """
+    Open the backlogs stored in the given directory.
+
+    @param   path (str)   The directory of the backlogs.
+    @return  (dict)       Dictionary mapping the sensors to their SensorBacklog.
+    """
+    backlogs = {}
+    for f in glob.glob(os.path.join(path, '*', 'sensor')):
+        sensor = open(f, 'r').read().strip()
+        if len(sensor) > 0:
+            backlogs[sensor] = SensorBacklog(path, sensor)
+    return backlogs
+
+class SensorBacklog(object):
+    """
+    Class that holds the measurements of a single sensor on disk, in the order they were added.
+
+    New measurements are added to a MeasurementBuffer in memory, which is appended to disk when it is flushed. The
+    measurements are stored in a directory per sensor, in segment files named '<index>.seg' after the index of their
+    first measurement, in hexadecimal. Each measurement is a fixed size record with the timestamp (double), MAC-address
+    (unsigned long long), deviceclass (int) and RSSI value (signed char), little-endian. A new segment is started when
+    the last one is full.
+
+    The index of the first measurement that has not been uploaded yet is kept in the 'committed' file. Segments are
+    deleted when all of their measurements are committed. An incomplete record at the end of the last segment, f.ex.
+    after a crash, is discarded. Uploads start at the committed index, so only one upload of a backlog can run at a
+    time; this is marked by the uploading attribute.
+
+    The oldest and newest timestamp are kept for each block of measurements written, in memory and in a file for each
+    segment, '<index>.blocks'. Blocks missing from these files are determined by reading the segment when opening the
+    backlog. The blocks holding the oldest and newest timestamp are found in constant time using monotonic queues, so
+    the time range of the backlog is known without reading it.
+    """
+    record = struct.Struct('<dQib')
+    segmentRecords = 1048576
+    blockRecords = 4096
+
+    def __init__(self, path, sensor):
+        """
+        Initialisation. Open the backlog of the given sensor. The directory is created when it is first flushed.
+
+        @param   path (str)     The directory of the backlogs.
+        @param   sensor (str)   The MAC-address of the sensor.
+        """
+        self.sensor = sensor
+        self.path = os.path.join(path, re.sub(r'[^\w.-]', '_', sensor))
+        self.buffer = measurements.MeasurementBuffer()
+        self.uploading = False
+
+        self.blocks = collections.deque()
+        self.oldestBlocks = collections.deque()
+        self.newestBlocks = collections.deque()
+
+        self.segments = sorted(int(os.path.basename(p)[:-4], 16) for p in glob.glob(os.path.join(self.path,
+            '*.seg')))
+
+        self.committed = 0
+        if os.path.isfile(os.path.join(self.path, 'committed')):
+            try:
+                self.committed = int(open(os.path.join(self.path, 'committed'), 'r').read().strip())
+            except ValueError:
+                pass
+
+        if len(self.segments) > 0:
+            path = self.getSegmentPath(self.segments[-1])
+            size = os.path.getsize(path)
+            if size % SensorBacklog.record.size != 0:
+                f = open(path, 'r+b')
+                f.truncate(size - size % SensorBacklog.record.size)
+                f.close()
+            self.written = self.segments[-1] + size // SensorBacklog.record.size
+            self.committed = min(max(self.committed, self.segments[0]), self.written)
+        else:
+            self.written = self.committed
+
+        self.loadBlocks()
+
+    def __len__(self):
+        return self.written - self.committed + len(self.buffer)
+
+    def getSegmentPath(self, index):
+        """
+        Get the path of the segment starting at the given index.
+
+        @param   index (int)   The index of the first measurement in the segment.
+        @return  (str)         The path of the segment file.
+        """
+        return os.path.join(self.path, '%016x.seg' % index)
+
+    def getBlocksPath(self, index):
+        """
+        Get the path of the file with the time ranges of the blocks in the segment starting at the given index.
+
+        @param   index (int)   The index of the first measurement in the segment.
+        @return  (str)         The path of the blocks file.
+        """
+        return os.path.join(self.path, '%016x.blocks' % index)
+
+    def loadBlocks(self):
+        """
+        Read the time ranges of the blocks of uncommitted measurements. Measurements that are not covered by the blocks
+        files, f.ex. after a crash, are read from the segments.
+        """
+        for i in range(len(self.segments)):
+            segment = self.segments[i]
+            end = self.segments[i+1] if i + 1 < len(self.segments) else self.written
+            position = segment
+
+            if os.path.isfile(self.getBlocksPath(segment)):
+                f = open(self.getBlocksPath(segment), 'r')
+                for line in f:
+                    try:
+                        start, count, oldest, newest = line.split()
+                        start, count, oldest, newest = int(start), int(count), float(oldest), float(newest)
+                    except ValueError:
+                        break
+                    if start != position or count <= 0 or start + count > end:
+                        break
+                    position += count
+                    if position > self.committed:
+                        self.addBlock(start, count, oldest, newest)
+                f.close()
+
+            position = max(position, self.committed)
+            while position < end:
+                count = min(end - position, SensorBacklog.blockRecords)
+                t = [r[0] for r in self.readRecords(position, position + count)]
+                self.addBlock(position, count, min(t), max(t))
+                position += count
+
+        self.trimBlocks()
+
+    def addBlock(self, start, count, oldest, newest):
+        """
+        Add the time range of a block of measurements.
+
+        @param   start (int)      The index of the first measurement in the block.
+        @param   count (int)      The number of measurements in the block.
+        @param   oldest (float)   The oldest timestamp in the block.
+        @param   newest (float)   The newest timestamp in the block.
+        """
+        block = [start, count, oldest, newest]
+        self.blocks.append(block)
+
+        # Blocks that are older and have a newer timestamp can never hold the oldest one, and vice versa.
+        while len(self.oldestBlocks) > 0 and self.oldestBlocks[-1][2] >= oldest:
+            self.oldestBlocks.pop()
+        self.oldestBlocks.append(block)
+        while len(self.newestBlocks) > 0 and self.newestBlocks[-1][3] <= newest:
+            self.newestBlocks.pop()
+        self.newestBlocks.append(block)
+
+    def trimBlocks(self):
+        """
+        Remove the blocks that are committed. The time range of a block that is partly committed is determined again.
+        """
+        while len(self.blocks) > 0 and self.blocks[0][0] + self.blocks[0][1] <= self.committed:
+            block = self.blocks.popleft()
+            if len(self.oldestBlocks) > 0 and self.oldestBlocks[0] is block:
+                self.oldestBlocks.popleft()
+            if len(self.newestBlocks) > 0 and self.newestBlocks[0] is block:
+                self.newestBlocks.popleft()
+
+        if len(self.blocks) > 0 and self.blocks[0][0] < self.committed:
+            block = self.blocks[0]
+            end = block[0] + block[1]
+            t = [r[0] for r in self.readRecords(self.committed, end)]
+            block[:] = [self.committed, end - self.committed, min(t), max(t)]
+            if len(self.oldestBlocks) > 1 and self.oldestBlocks[0] is block and self.oldestBlocks[1][2] <= block[2]:
+                self.oldestBlocks.popleft()
+            if len(self.newestBlocks) > 1 and self.newestBlocks[0] is block and self.newestBlocks[1][3] >= block[3]:
+                self.newestBlocks.popleft()
+
+    def getStoredCount(self):
+        """
+        Get the number of measurements on disk that have not been committed, i.e. that can be uploaded.
+
+        @return  (int)   The number of measurements.
+        """
+        return self.written - self.committed
+
+    def add(self, timestamp, mac, deviceclass, rssi):
+        """
+        Add a measurement, unless an identical one has been added recently.
+
+        @param   timestamp (float)   Timestamp of the detection. In UNIX time.
+        @param   mac (str)           MAC-address of the detected device, without colons.
+        @param   deviceclass (int)   Deviceclass of the detected device.
+        @param   rssi (int)          RSSI value of the detection.
+        @return  (bool)              True when added, False when it was a duplicate.
+        """
+        return self.buffer.add(timestamp, mac, deviceclass, rssi)
+
+    def flush(self):
+        """
+        Append the measurements in memory to disk.
+
+        @return  (int)   The number of measurements written.
+        """
+        count = len(self.buffer)
+        if count == 0:
+            return 0
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+            f = open(os.path.join(self.path, 'sensor'), 'w')
+            f.write(self.sensor + '\n')
+            f.close()
+
+        pack = SensorBacklog.record.pack
+        done = 0
+        while done < count:
+            if len(self.segments) == 0 or self.written - self.segments[-1] >= SensorBacklog.segmentRecords:
+                self.segments.append(self.written)
+            segment = self.segments[-1]
+            n = min(count - done, segment + SensorBacklog.segmentRecords - self.written)
+            data = ''.join([pack(*r) for r in self.buffer.getRecords(n)])
+
+            blocks = []
+            for i in xrange(0, n, SensorBacklog.blockRecords):
+                t = self.buffer.timestamps[self.buffer.start + i:self.buffer.start + min(n, i +
+                    SensorBacklog.blockRecords)]
+                blocks.append((self.written + i, len(t), min(t), max(t)))
+
+            # Write at the position of the next record, overwriting what is left of a failed write.
+            path = self.getSegmentPath(segment)
+            f = open(path, 'r+b' if os.path.isfile(path) else 'wb')
+            try:
+                f.seek((self.written - segment) * SensorBacklog.record.size)
+                f.write(data)
+                f.truncate()
+            finally:
+                f.close()
+
+            self.written += n
+            self.buffer.commit(n)
+            done += n
+
+            for block in blocks:
+                self.addBlock(*block)
+            try:
+                f = open(self.getBlocksPath(segment), 'a')
+                f.write(''.join('%i %i %r %r\n' % block for block in blocks))
+                f.close()
+            except (IOError, OSError):
+                # Missing blocks are read from the segment when opening the backlog.
+                pass
+        return count
+
+    def getRecords(self, start, count):
+        """
+        Read the given measurements from disk. The measurements should not be committed while the generator is in use,
+        it can be used in a different thread.
+
+        @param   start (int)   The index of the first measurement to read, f.ex. the committed index.
+        @param   count (int)   The maximum number of measurements to read.
+        @return  (generator)   Yields (timestamp, mac, deviceclass, rssi) tuples, the MAC-address as an integer.
+        """
+        return self.readRecords(start, min(start + count, self.written))
+
+    def readRecords(self, index, end):
+        """
+        Read the given range of measurements from disk.
+
+        @param   index (int)   The index of the first measurement to read.
+        @param   end (int)     The index after the last measurement to read.
+        @return  (generator)   Yields (timestamp, mac, deviceclass, rssi) tuples, the MAC-address as an integer.
+        """
+        segments = list(self.segments)
+        size = SensorBacklog.record.size
+        unpack = SensorBacklog.record.unpack_from
+
+        while index < end:
+            segment = segments[bisect.bisect_right(segments, index) - 1]
+            f = open(self.getSegmentPath(segment), 'rb')
+            try:
+                f.seek((index - segment) * size)
+                last = min(end, segment + SensorBacklog.segmentRecords)
+                while index < last:
+                    n = min(last - index, SensorBacklog.blockRecords)
+                    data = f.read(n * size)
+                    if len(data) < n * size:
+                        raise IOError("Segment %s of the backlog of %s is truncated" % (segment, self.sensor))
+                    for i in xrange(n):
+                        yield unpack(data, i * size)
+                    index += n
+            finally:
+                f.close()
+
+    def formatLines(self, start, count):
+        """
+        Read the given measurements from disk as CSV lines for the Move database.
+
+        @param   start (int)   The index of the first measurement to read, f.ex. the committed index.
+        @param   count (int)   The maximum number of measurements to read.
+        @return  (generator)   Yields the lines, without line endings.
+        """
+        return measurements.formatLines(self.getRecords(start, count))
+
+    def getOldest(self):
+        """
+        Get the timestamp of the oldest measurement that has not been committed.
+
+        @return  (float)   The timestamp, None when the backlog is empty.
+        """
+        t = [b for b in [self.oldestBlocks[0][2] if len(self.oldestBlocks) > 0 else None, self.buffer.oldest] \
+            if b != None]
+        return min(t) if len(t) > 0 else None
+
+    def getNewest(self):
+        """
+        Get the timestamp of the newest measurement that has not been committed.
+
+        @return  (float)   The timestamp, None when the backlog is empty.
+        """
+        t = [b for b in [self.newestBlocks[0][3] if len(self.newestBlocks) > 0 else None, self.buffer.newest] \
+            if b != None]
+        return max(t) if len(t) > 0 else None
+
+    def getStoredSize(self):
+        """
+        Get the size of the uncommitted measurements on disk.
+
+        @return  (int)   The size in bytes.
+        """
+        return self.getStoredCount() * SensorBacklog.record.size
+
+    def commit(self, start, count):
+        """
+        Mark the given measurements on disk as done, f.ex. after uploading them, and delete the segments that are no
+        longer needed. The committed index only moves forward, so committing the same measurements again has no effect.
+
+        @param   start (int)   The index of the first measurement, as read when the measurements were taken.
+        @param   count (int)   The number of measurements to commit.
+        """
+        end = min(start + count, self.written)
+        if end <= self.committed:
+            return
+        self.committed = end
+
+        path = os.path.join(self.path, 'committed')
+        f = open(path + '.tmp', 'w')
+        f.write('%i\n' % self.committed)
+        f.close()
+        os.rename(path + '.tmp', path)
+
+        while len(self.segments) > 0:
+            end = self.segments[1] if len(self.segments) > 1 else self.written
+            if end > self.committed:
+                break
+            segment = self.segments.pop(0)
+            for path in [self.getSegmentPath(segment), self.getBlocksPath(segment)]:
+                if os.path.isfile(path):
+                    os.remove(path)
+
+        self.trimBlocks()
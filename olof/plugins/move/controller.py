@@ -0,0 +1,95 @@
+#-*- coding: utf-8 -*-
+#
+# This file belongs to Gyrid Server.
+#
+# Copyright (C) 2012  Roel Huybrechts
+# All rights reserved.
+
+"""
+Module providing an adaptive controller for the size and interval of the uploads to the Move database.
+"""
+
+class UploadController(object):
+    """
+    Class that tunes the upload batch size and interval using AIMD (additive increase, multiplicative decrease).
+
+    The batch size grows by a fixed step after each upload that was full and finished well within the target latency,
+    i.e. when there is a backlog and the server keeps up. It is halved when an upload fails or takes longer than the
+    target latency, and is also limited to the number of measurements that is expected to fit in the target latency,
+    based on the recent upload time per measurement of uploads of at least the minimum size. The batch size stays
+    between the minimum and the configured maximum.
+
+    The interval is doubled after each failed upload, up to a maximum, and is reset to the configured interval after
+    a successful upload.
+    """
+    minSize = 1000
+    targetFraction = 0.25
+    smoothing = 0.3
+    maxBackoff = 16
+
+    def __init__(self, maxSize, interval, timeout):
+        """
+        Initialisation.
+
+        @param   maxSize (int)     The maximum number of measurements in one upload.
+        @param   interval (int)    The configured upload interval, in seconds.
+        @param   timeout (float)   The timeout of an upload request, in seconds.
+        """
+        self.maxSize = max(UploadController.minSize, maxSize)
+        self.baseInterval = interval
+        self.interval = interval
+        self.targetLatency = timeout * UploadController.targetFraction
+        self.step = max(UploadController.minSize, self.maxSize // 20)
+        self.batchSize = min(self.maxSize, 10 * self.step)
+
+        self.latency = None
+        self.perLine = None
+        self.failures = 0
+
+    def configure(self, maxSize=None, interval=None):
+        """
+        Update the configured limits.
+
+        @param   maxSize (int)    The maximum number of measurements in one upload. Optional.
+        @param   interval (int)   The configured upload interval, in seconds. Optional.
+        """
+        if maxSize != None:
+            self.maxSize = max(UploadController.minSize, maxSize)
+            self.step = max(UploadController.minSize, self.maxSize // 20)
+            self.batchSize = min(self.batchSize, self.maxSize)
+        if interval != None:
+            self.baseInterval = interval
+            self.interval = interval * min(2 ** self.failures, UploadController.maxBackoff)
+
+    def success(self, lines, duration):
+        """
+        Update the controller after a successful upload.
+
+        @param   lines (int)        The number of measurements in the upload.
+        @param   duration (float)   The time the upload took, in seconds.
+        """
+        a = UploadController.smoothing
+        self.latency = duration if self.latency == None else a * duration + (1 - a) * self.latency
+        if lines >= UploadController.minSize:
+            perLine = float(duration) / lines
+            self.perLine = perLine if self.perLine == None else a * perLine + (1 - a) * self.perLine
+
+        self.failures = 0
+        self.interval = self.baseInterval
+
+        if duration > self.targetLatency:
+            self.batchSize //= 2
+        elif lines >= self.batchSize and duration < self.targetLatency / 2:
+            self.batchSize += self.step
+
+        if self.perLine != None and self.perLine > 0:
+            self.batchSize = min(self.batchSize, int(self.targetLatency / self.perLine))
+        self.batchSize = max(UploadController.minSize, min(self.maxSize, self.batchSize))
+
+    def failure(self):
+        """
+        Update the controller after a failed upload.
+        """
+        self.failures += 1
+        self.batchSize = max(UploadController.minSize, self.batchSize // 2)
+        self.interval = self.baseInterval * min(2 ** self.failures, UploadController.maxBackoff)
@@ -0,0 +1,231 @@
+#-*- coding: utf-8 -*-
+#
+# This file belongs to Gyrid Server.
+#
+# Copyright (C) 2012  Roel Huybrechts
+# All rights reserved.
+
+"""
+Module providing a compact buffer for the measurements waiting to be uploaded to the Move database.
+"""
+
+import array
+import itertools
+
+from olof.tools.datetimetools import getTimestampFormatter, getUnixtime
+from olof.tools.detectionarchive import formatMac, parseMac
+
+FORMAT = '%Y%m%d-%H%M%S.%%s-%Z'
+
+def formatLines(records):
+    """
+    Format the given measurements as CSV lines for the Move database.
+
+    @param   records (iterable)   The measurements, as (timestamp, mac, deviceclass, rssi) tuples. The MAC-address is
+                                    an integer.
+    @return  (generator)          Yields the lines, without line endings.
+    """
+    formatter = getTimestampFormatter(FORMAT)
+    for timestamp, mac, deviceclass, rssi in records:
+        yield '%s,%s,%i,%i' % (formatter.formatTimestamp(timestamp) % ('%0.3f' % timestamp)[-3:],
+            formatMac(int(mac)), deviceclass, rssi)
+
+class HashSet(object):
+    """
+    Class that implements an open addressing hash set of integers, stored in a flat array. Keys are truncated to 53
+    bits, so they can be stored exactly in doubles when longs cannot hold them.
+    """
+    keyType = 'L' if array.array('L').itemsize >= 8 else 'd'
+    mask = (1 << 53) - 1
+
+    def __init__(self, capacity=1024):
+        """
+        Initialisation.
+
+        @param   capacity (int)   The initial number of slots, should be a power of two. Defaults to 1024.
+        """
+        self.capacity = capacity
+        self.size = 0
+        self.keys = array.array(HashSet.keyType, [0]) * capacity
+
+    def __len__(self):
+        return self.size
+
+    def __slot(self, k):
+        """
+        Find the slot for the given key using linear probing.
+
+        @param    k (int)   The truncated key to look for.
+        @return   (int)     The slot holding the key, or the empty slot where it should be inserted.
+        """
+        keys = self.keys
+        mask = self.capacity - 1
+        i = (k ^ (k >> 29)) & mask
+        while keys[i] != 0 and keys[i] != k:
+            i = (i + 1) & mask
+        return i
+
+    def __contains__(self, key):
+        return self.keys[self.__slot((key & HashSet.mask) or 1)] != 0
+
+    def add(self, key):
+        """
+        Add the given key. Grows the set when it is half full.
+
+        @param   key (int)   The key to add.
+        @return  (bool)      True when the key was added, False when it was already present.
+        """
+        k = (key & HashSet.mask) or 1
+        i = self.__slot(k)
+        if self.keys[i] != 0:
+            return False
+
+        self.keys[i] = k
+        self.size += 1
+        if self.size * 2 > self.capacity:
+            old = self.keys
+            self.__init__(self.capacity * 2)
+            for k in old:
+                if k != 0:
+                    self.add(int(k))
+        return True
+
+class MeasurementBuffer(object):
+    """
+    Class that holds the measurements of a single sensor, in the order they were added.
+
+    The measurements are stored in columns: timestamps (double), MAC-addresses (as integers), deviceclasses (int) and
+    RSSI values (signed char), about 21 bytes per measurement. The CSV lines for the Move database are only formatted
+    when uploading.
+
+    Uploaded measurements are not removed one by one: a cursor points to the first pending measurement and is advanced
+    when an upload is committed. The columns are compacted once more than half of them has been committed. The oldest
+    and newest timestamp of the pending measurements are kept up to date when adding measurements.
+
+    Identical measurements are only added once, f.ex. when a detection is added for each project of the sensor. To
+    bound memory use, only the most recent measurements are remembered for this, in two generations of hash sets of
+    the given window size. Duplicates that are further apart are caught by the server's duplicate filter.
+    """
+    window = 4096
+
+    def __init__(self):
+        """
+        Initialisation.
+        """
+        self.timestamps = array.array('d')
+        self.macs = array.array(HashSet.keyType)
+        self.deviceclasses = array.array('i')
+        self.rssis = array.array('b')
+        self.start = 0
+        self.oldest = None
+        self.newest = None
+        self.recent = HashSet()
+        self.previous = HashSet(1)
+
+    def __len__(self):
+        return len(self.timestamps) - self.start
+
+    @staticmethod
+    def key(timestamp, mac, deviceclass, rssi):
+        """
+        Get the hash of the given measurement, at millisecond precision.
+
+        @return  (int)   The hash.
+        """
+        return hash((int(round(timestamp * 1000)), mac, deviceclass, rssi))
+
+    def add(self, timestamp, mac, deviceclass, rssi):
+        """
+        Add a measurement, unless an identical one is in the buffer.
+
+        @param   timestamp (float)   Timestamp of the detection. In UNIX time.
+        @param   mac (str)           MAC-address of the detected device, without colons.
+        @param   deviceclass (int)   Deviceclass of the detected device.
+        @param   rssi (int)          RSSI value of the detection.
+        @return  (bool)              True when added, False when it was a duplicate.
+        """
+        mac = parseMac(mac)
+        rssi = max(-128, min(127, int(rssi)))
+        key = MeasurementBuffer.key(timestamp, mac, deviceclass, rssi)
+        if key in self.previous or not self.recent.add(key):
+            return False
+        if len(self.recent) >= MeasurementBuffer.window:
+            self.previous = self.recent
+            self.recent = HashSet()
+
+        if self.oldest == None or timestamp < self.oldest:
+            self.oldest = timestamp
+        if self.newest == None or timestamp > self.newest:
+            self.newest = timestamp
+
+        self.timestamps.append(timestamp)
+        self.macs.append(mac)
+        self.deviceclasses.append(deviceclass)
+        self.rssis.append(rssi)
+        return True
+
+    def addLine(self, line):
+        """
+        Add a measurement given as a CSV line, as formatted by formatLines.
+
+        @param   line (str)   The line to add.
+        @return  (bool)       True when added, False when it was a duplicate or invalid.
+        """
+        try:
+            t, mac, deviceclass, rssi = line.split(',')
+            timestamp = getUnixtime(t[:15], '%Y%m%d-%H%M%S') + float('0.' + t[16:19])
+            return self.add(timestamp, mac, int(deviceclass), int(rssi))
+        except ValueError:
+            return False
+
+    def updateRange(self):
+        """
+        Determine the oldest and newest timestamp of the pending measurements again.
+        """
+        if len(self) == 0:
+            self.oldest = self.newest = None
+        else:
+            self.oldest = min(itertools.islice(self.timestamps, self.start, None))
+            self.newest = max(itertools.islice(self.timestamps, self.start, None))
+
+    def formatLines(self, count=None):
+        """
+        Format the first pending measurements as CSV lines for the Move database. The columns are read in place, so the
+        buffer should not be committed while the generator is in use.
+
+        @param   count (int)   The maximum number of measurements to format. Optional, defaults to all.
+        @return  (generator)   Yields the lines, without line endings.
+        """
+        return formatLines(self.getRecords(count))
+
+    def getRecords(self, count=None):
+        """
+        Get the first pending measurements. The columns are read in place, so the buffer should not be committed while
+        the generator is in use.
+
+        @param   count (int)   The maximum number of measurements. Optional, defaults to all.
+        @return  (generator)   Yields (timestamp, mac, deviceclass, rssi) tuples, the MAC-address as an integer.
+        """
+        end = len(self.timestamps) if count == None else min(self.start + count, len(self.timestamps))
+        return itertools.izip(*[itertools.islice(c, self.start, end) for c in [self.timestamps, self.macs,
+            self.deviceclasses, self.rssis]])
+
+    def commit(self, count):
+        """
+        Mark the first pending measurements as done, f.ex. after uploading them, by advancing the cursor.
+
+        @param   count (int)   The number of measurements to commit.
+        """
+        self.start = min(self.start + count, len(self.timestamps))
+        if self.start * 2 > len(self.timestamps):
+            self.compact()
+        self.updateRange()
+
+    def compact(self):
+        """
+        Remove the committed measurements from the columns.
+        """
+        if self.start > 0:
+            for c in [self.timestamps, self.macs, self.deviceclasses, self.rssis]:
+                del c[:self.start]
+            self.start = 0
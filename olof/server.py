@@ -21,7 +21,9 @@ import zlib
 import olof.configuration
 import olof.dataprovider
 import olof.datatypes
+import olof.duplicatefilter
 import olof.logger
+import olof.macstore
 import olof.pluginmanager
 import olof.storagemanager
 import olof.tools.validation
@@ -268,6 +270,10 @@ class GyridServerProtocol(Int16StringReceiver):
             mr.ack = binascii.a2b_hex(self.checksum(m.SerializeToString()))
             self.sendMsg(mr)
 
+            dedup = self.factory.server.dedup
+            if dedup != None and self.hostname != None and dedup.isDuplicate(self.hostname, m):
+                return
+
             if m.type == m.Type_BLUETOOTH_STATE_INQUIRY:
                 if self.hostname != None:
                     m.hostname = self.hostname
@@ -601,7 +607,7 @@ class Olof(object):
         """
         Initialisation.
 
-        Read the MAC-adress:deviceclass dictionary from disk, load the pluginmanager and the dataprovider.
+        Open the MAC-adress:deviceclass store, load the pluginmanager and the dataprovider.
 
         @param   paths (dict)   Dictionary setting the filepaths to use.
         """
@@ -625,14 +631,38 @@ class Olof(object):
         self.storagemgr = olof.storagemanager.StorageManager(self, 'server')
         self.dataprovider = olof.dataprovider.DataProvider(self)
 
-        self.mac_dc = self.storagemgr.loadObject('mac_dc', {})
-        self.storagemgr.repeatedStoreObject(self.mac_dc, 'mac_dc')
+        max_age = self.configmgr.getValue('mac_dc_max_age')
+        self.mac_dc = olof.macstore.MacStore(self, self.storagemgr,
+            maxAge=(max_age * 86400) if max_age != None else None,
+            maxEntries=self.configmgr.getValue('mac_dc_max_entries'))
         self.port = self.configmgr.getValue('tcp_listening_port')
 
+        self.dedup = None
+        if self.configmgr.getValue('dedup_window') != None:
+            self.dedup = olof.duplicatefilter.DuplicateFilter(self.configmgr.getValue('dedup_window'),
+                self.configmgr.getValue('dedup_capacity'), self.configmgr.getValue('dedup_error_rate'))
+
     def __defineConfiguration(self):
         """
         Define the configuration options for the server.
         """
+        def validateOptionalInt(value):
+            if value == None:
+                return None
+            return olof.tools.validation.parseInt(value)
+
+        def validatePositiveInt(value):
+            v = olof.tools.validation.parseInt(value)
+            if v < 1:
+                raise olof.tools.validation.ValidationError()
+            return v
+
+        def validateFraction(value):
+            v = olof.tools.validation.parseFloat(value)
+            if not 0 < v < 1:
+                raise olof.tools.validation.ValidationError()
+            return v
+
         options = set()
 
         o = olof.configuration.Option('tcp_listening_port')
@@ -656,18 +686,53 @@ class Olof(object):
         o.addValue(olof.configuration.OptionValue('keys/ca.pem', default=True))
         options.add(o)
 
+        o = olof.configuration.Option('mac_dc_max_age')
+        o.setDescription('Number of days after which MAC-addresses that have not been seen are removed from the ' + \
+            'MAC-address:deviceclass store. None to keep them forever.')
+        o.setValidation(validateOptionalInt)
+        o.addValue(olof.configuration.OptionValue(365, default=True))
+        options.add(o)
+
+        o = olof.configuration.Option('mac_dc_max_entries')
+        o.setDescription('Maximum number of MAC-addresses to keep in the MAC-address:deviceclass store. The least ' + \
+            'recently seen are removed first. None for no limit.')
+        o.setValidation(validateOptionalInt)
+        o.addValue(olof.configuration.OptionValue(None, default=True))
+        options.add(o)
+
+        o = olof.configuration.Option('dedup_window')
+        o.setDescription('Time in seconds to remember the messages received from the scanners, to prevent ' + \
+            'passing the same message to the plugins more than once. None to disable.')
+        o.setValidation(validateOptionalInt)
+        o.addValue(olof.configuration.OptionValue(3600, default=True))
+        options.add(o)
+
+        o = olof.configuration.Option('dedup_capacity')
+        o.setDescription('Expected number of messages received within the time window set above. Memory use is ' + \
+            'about 2.8 bytes per message at the default error rate.')
+        o.setValidation(validatePositiveInt)
+        o.addValue(olof.configuration.OptionValue(2000000, default=True))
+        options.add(o)
+
+        o = olof.configuration.Option('dedup_error_rate')
+        o.setDescription('Maximum fraction of messages wrongly considered a duplicate, when receiving the ' + \
+            'expected number of messages. Between 0 and 1, exclusive.')
+        o.setValidation(validateFraction)
+        o.addValue(olof.configuration.OptionValue(0.0001, default=True))
+        options.add(o)
+
         self.configmgr.addOptions(options)
         self.configmgr.readConfig()
 
     def unload(self):
         """
-        Unload the dataprovider and the pluginmanager. Save the MAC-address:deviceclass dictionary to disk.
+        Unload the dataprovider and the pluginmanager. Unload the MAC-address:deviceclass store.
         """
         self.dataprovider.unload()
         self.configmgr.unload()
         self.pluginmgr.unload(shutdown=True)
         self.storagemgr.unload()
-        self.storagemgr.storeObject(self.mac_dc, 'mac_dc')
+        self.mac_dc.unload()
         self.logger.logInfo("Stopping Gyrid Server")
 
     def getDeviceclass(self, mac):
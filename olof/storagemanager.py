@@ -9,11 +9,167 @@
 Module that handles disk storage.
 """
 
+import contextlib
 import cPickle as pickle
 import os
+import sqlite3
+import threading
 
 from twisted.internet import task
 
+class SQLiteBackend(object):
+    """
+    Key-value storage backend using an embedded SQLite database. Keys are strings and are kept in sorted order, values
+    can be any object that can be pickled. Can be used from multiple threads.
+
+    This allows to keep data on disk and read it incrementally, instead of keeping it in memory and saving it as a
+    whole. The same restrictions apply as for StorageManager.storeObject: objects of classes defined in plugin modules
+    cannot be stored.
+    """
+    # Number of rows read at once in a scan.
+    page_size = 1000
+
+    def __init__(self, path):
+        """
+        Initialisation. Open or create the database.
+
+        @param   path (str)   Path of the database file.
+        """
+        self.path = path
+        self.lock = threading.RLock()
+        self.depth = 0
+
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS store (key TEXT PRIMARY KEY, value BLOB)')
+
+    def __range(self, start, end):
+        """
+        Build the WHERE clause and arguments for the given range.
+        """
+        clauses = []
+        args = []
+        if start != None:
+            clauses.append('key >= ?')
+            args.append(start)
+        if end != None:
+            clauses.append('key < ?')
+            args.append(end)
+        return (' WHERE ' + ' AND '.join(clauses)) if len(clauses) > 0 else '', args
+
+    def get(self, key, default=None):
+        """
+        Get the value for the given key.
+
+        @param    key (str)   The key to look up.
+        @param    default     The value to return when the key does not exist. Defaults to None.
+        @return               The stored value, or the default value.
+        """
+        with self.lock:
+            row = self.db.execute('SELECT value FROM store WHERE key = ?', (key,)).fetchone()
+        return pickle.loads(str(row[0])) if row != None else default
+
+    def put(self, key, value):
+        """
+        Store the value for the given key, replacing any existing value.
+
+        @param   key (str)   The key.
+        @param   value       The value to store.
+        """
+        data = sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO store (key, value) VALUES (?, ?)', (key, data))
+
+    def delete(self, key):
+        """
+        Delete the given key, if it exists.
+
+        @param   key (str)   The key to delete.
+        """
+        with self.lock:
+            self.db.execute('DELETE FROM store WHERE key = ?', (key,))
+
+    def scan(self, start=None, end=None, limit=None):
+        """
+        Iterate over a range of keys, in sorted order. Rows are read page by page, the database is not locked in
+        between.
+
+        @param    start (str)   The first key of the range, inclusive. None to start at the first key.
+        @param    end (str)     The last key of the range, exclusive. None to end at the last key.
+        @param    limit (int)   The maximum number of items to return. None for no limit.
+        @return   (generator)   Yields (key, value) tuples.
+        """
+        returned = 0
+        first = True
+        while limit == None or returned < limit:
+            where, args = self.__range(start, end)
+            if not first:
+                where = (where + ' AND key > ?') if where else ' WHERE key > ?'
+                args.append(last)
+            amount = self.page_size if limit == None else min(self.page_size, limit - returned)
+            with self.lock:
+                rows = self.db.execute('SELECT key, value FROM store%s ORDER BY key LIMIT ?' % where,
+                    args + [amount]).fetchall()
+            for key, value in rows:
+                yield (key, pickle.loads(str(value)))
+            returned += len(rows)
+            if len(rows) < amount:
+                break
+            last = rows[-1][0]
+            first = False
+
+    def count(self, start=None, end=None):
+        """
+        Count the keys in the given range.
+
+        @param    start (str)   The first key of the range, inclusive. None to start at the first key.
+        @param    end (str)     The last key of the range, exclusive. None to end at the last key.
+        @return   (int)         The number of keys.
+        """
+        where, args = self.__range(start, end)
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM store%s' % where, args).fetchone()[0]
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Get a context manager that groups all modifications made in its block in one transaction. Modifications are
+        committed when the block finishes and rolled back when it raises an exception. Transactions can be nested, only
+        the outermost one commits. A nested block uses a savepoint, so when it raises only its own modifications are
+        rolled back, even when the exception is caught by the outer block.
+
+        Use like:
+            with backend.transaction():
+                backend.put('a', 1)
+                backend.delete('b')
+        """
+        with self.lock:
+            savepoint = 'level%i' % self.depth
+            self.db.execute('BEGIN' if self.depth == 0 else 'SAVEPOINT ' + savepoint)
+            self.depth += 1
+            try:
+                yield self
+            except:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.db.execute('ROLLBACK')
+                else:
+                    self.db.execute('ROLLBACK TO ' + savepoint)
+                    self.db.execute('RELEASE ' + savepoint)
+                raise
+            else:
+                self.depth -= 1
+                self.db.execute('COMMIT' if self.depth == 0 else 'RELEASE ' + savepoint)
+
+    def close(self):
+        """
+        Close the database.
+        """
+        with self.lock:
+            self.db.close()
+
 class StorageManager(object):
     """
     Class that manages saving and loading objects to and from disk.
@@ -28,6 +184,7 @@ class StorageManager(object):
         self.server = server
         self.base_path = self.server.paths['storage'] + '/%s/' % directoryName
         self.repeated_tasks = set()
+        self.backends = {}
 
     def unload(self, shutdown=False):
         for task in self.repeated_tasks:
@@ -36,6 +193,10 @@ class StorageManager(object):
             except AssertionError:
                 continue
 
+        for backend in self.backends.values():
+            backend.close()
+        self.backends = {}
+
     def __createDir(self):
         """
         Create the base directory if is does not exists already.
@@ -43,6 +204,29 @@ class StorageManager(object):
         if not os.path.exists(self.base_path):
             os.makedirs(self.base_path)
 
+    def getPath(self, name):
+        """
+        Get the full path of a file in the storage directory. Useful for storage that cannot be pickled as a whole,
+        f.ex. journals or memory mapped files.
+
+        @param    name (str)   Unique name of the file.
+        @return   (str)        The full path of the file. The directory is created when it does not exist yet.
+        """
+        self.__createDir()
+        return self.base_path + name
+
+    def getBackend(self, name):
+        """
+        Get a key-value storage backend, opening it when necessary. Only SQLite is supported. Backends are closed when
+        the storage manager is unloaded.
+
+        @param    name (str)         Unique name to identify this backend.
+        @return   (SQLiteBackend)    The backend.
+        """
+        if not name in self.backends:
+            self.backends[name] = SQLiteBackend(self.getPath(name + '.db'))
+        return self.backends[name]
+
     def repeatedStoreObject(self, object, name, interval=300):
         """
         Repeatedly store the given object to disk.
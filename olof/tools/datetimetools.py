@@ -12,6 +12,103 @@ Module providing useful tools regarding dates and times.
 import datetime
 import time
 
+class TimestampFormatter(object):
+    """
+    Class that formats UNIX timestamps in local time, caching the result per second. Timestamps mostly arrive in bursts
+    within the same second, so only a fraction of them need a call to time.localtime and time.strftime.
+
+    Daylight saving time is handled as each second is converted separately. The cache is cleared when the timezone of
+    the process changes.
+    """
+    def __init__(self, format='%Y%m%d-%H%M%S-%Z', size=4096):
+        """
+        Initialisation.
+
+        @param   format (str)   The format to use, see time.strftime. Should not contain fractions of seconds.
+        @param   size (int)     The maximum number of seconds to cache. Defaults to 4096.
+        """
+        self.format = format
+        self.size = size
+        self.cache = {}
+        self.timezone = self.__getTimezone()
+
+    def __getTimezone(self):
+        """
+        Get the current timezone settings of the process.
+        """
+        return (time.timezone, time.altzone, time.tzname)
+
+    def __format(self, second):
+        """
+        Format the given second and add it to the cache.
+
+        @param   second (int)   The UNIX timestamp to format.
+        @return  (str)          The formatted timestamp.
+        """
+        timezone = self.__getTimezone()
+        if len(self.cache) >= self.size or timezone != self.timezone:
+            self.cache.clear()
+            self.timezone = timezone
+
+        formatted = time.strftime(self.format, time.localtime(second))
+        self.cache[second] = formatted
+        return formatted
+
+    def formatTimestamp(self, timestamp):
+        """
+        Format the given timestamp.
+
+        @param   timestamp (float)   The UNIX timestamp to format.
+        @return  (str)               The formatted timestamp.
+        """
+        second = int(timestamp)
+        try:
+            return self.cache[second]
+        except KeyError:
+            return self.__format(second)
+
+    def formatTimestamps(self, timestamps):
+        """
+        Format the given list of timestamps at once.
+
+        @param   timestamps (list)   The UNIX timestamps to format.
+        @return  (list)              The formatted timestamps, in the same order.
+        """
+        cache = self.cache
+        r = []
+        for timestamp in timestamps:
+            second = int(timestamp)
+            formatted = cache.get(second)
+            if formatted == None:
+                formatted = self.__format(second)
+                cache = self.cache
+            r.append(formatted)
+        return r
+
+_formatters = {}
+
+def getTimestampFormatter(format='%Y%m%d-%H%M%S-%Z'):
+    """
+    Get the shared TimestampFormatter for the given format.
+
+    @param   format (str)           The format to use, see time.strftime.
+    @return  (TimestampFormatter)   The formatter for this format.
+    """
+    formatter = _formatters.get(format)
+    if formatter == None:
+        formatter = _formatters.setdefault(format, TimestampFormatter(format))
+    return formatter
+
+def formatTimestamp(timestamp, format='%Y%m%d-%H%M%S-%Z'):
+    """
+    Format the given UNIX timestamp in local time, using the shared formatter for the given format.
+
+    @param   timestamp (float)   The UNIX timestamp to format.
+    @param   format (str)        The format to use, see time.strftime. Defaults to '%Y%m%d-%H%M%S-%Z'.
+    @return  (str)               The formatted timestamp.
+    """
+    return getTimestampFormatter(format).formatTimestamp(timestamp)
+
 def getUnixtime(timestamp, format='%Y%m%d-%H%M%S-%Z'):
     """
     Convert the given timestamp to UNIX time.
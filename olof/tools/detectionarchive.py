@@ -0,0 +1,148 @@
+#-*- coding: utf-8 -*-
+#
+# This file belongs to Gyrid Server.
+#
+# Copyright (C) 2012  Roel Huybrechts
+# All rights reserved.
+
+"""
+Module providing the binary format for archiving detections, as written by the logger plugin, and a reader for offline
+analysis.
+
+A file consists of consecutive blocks. Each block starts with a header containing a magic string, the format version,
+the number of records, the size of the data in bytes and the first and last timestamp in the block. The header is
+followed by the data in columns, all little-endian: the timestamps (float64), MAC-addresses (uint64), angles (float32,
+NaN when unknown) and RSSI values (int8). The data is padded to a multiple of 8 bytes.
+
+Blocks can be skipped using the size in the header, and blocks outside of a time window using their time range. The
+reader needs NumPy, which is only imported when reading.
+"""
+
+import gzip
+import mmap
+import os
+import struct
+
+MAGIC = 'GRSB'
+VERSION = 1
+
+# magic, version, flags, number of records, size of the data, first timestamp, last timestamp
+HEADER = struct.Struct('<4sHHIIdd')
+
+COLUMNS = [('timestamp', '<f8'), ('mac', '<u8'), ('angle', '<f4'), ('rssi', '<i1')]
+RECORD_SIZE = 21
+
+def parseMac(mac):
+    """
+    Convert the given MAC-address to an integer.
+
+    @param   mac (str)   The MAC-address, with or without colons.
+    @return  (int)       The MAC-address as an integer, 0 when invalid.
+    """
+    try:
+        return int(mac.replace(':', ''), 16) & 0xFFFFFFFFFFFFFFFF
+    except (AttributeError, ValueError):
+        return 0
+
+def formatMac(mac):
+    """
+    Convert the given integer to a MAC-address.
+
+    @param   mac (int)   The MAC-address as an integer.
+    @return  (str)       The MAC-address as 12 hexadecimal digits.
+    """
+    return '%012x' % mac
+
+def encodeBlock(records):
+    """
+    Encode the given detections as a block.
+
+    @param   records (list)   List of (timestamp, mac, rssi, angle) tuples. The MAC-address is a string, the angle can
+                                be None.
+    @return  (str)            The encoded block.
+    """
+    n = len(records)
+    timestamps = [float(r[0]) for r in records]
+    data = ''.join([
+        struct.pack('<%id' % n, *timestamps),
+        struct.pack('<%iQ' % n, *[parseMac(r[1]) for r in records]),
+        struct.pack('<%if' % n, *[float(r[3]) if r[3] != None else float('nan') for r in records]),
+        struct.pack('<%ib' % n, *[max(-128, min(127, int(r[2]))) for r in records])])
+    data += '\x00' * (-len(data) % 8)
+    return HEADER.pack(MAGIC, VERSION, 0, n, len(data), min(timestamps), max(timestamps)) + data
+
+def readBlocks(path, start=None, end=None):
+    """
+    Read the blocks of the given file, skipping blocks outside of the given time window. Uncompressed files are memory
+    mapped, gzip-compressed files (ending in '.gz') are decompressed in memory. A truncated last block is ignored.
+
+    Needs NumPy.
+
+    @param   path (str)      Path of the file to read.
+    @param   start (float)   Skip blocks with detections before this UNIX timestamp only. Optional.
+    @param   end (float)     Skip blocks with detections after this UNIX timestamp only. Optional.
+    @return  (generator)     Yields a dictionary for each block, mapping the column names ('timestamp', 'mac', 'angle'
+                               and 'rssi') to NumPy arrays.
+    """
+    import numpy
+
+    if path.endswith('.gz'):
+        f = gzip.open(path, 'rb')
+        buffer = f.read()
+        f.close()
+    else:
+        f = open(path, 'rb')
+        if os.fstat(f.fileno()).st_size == 0:
+            f.close()
+            return
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+
+    size = len(buffer)
+    offset = 0
+    while offset + HEADER.size <= size:
+        magic, version, flags, count, length, first, last = HEADER.unpack_from(buffer, offset)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Invalid block in %s at offset %i" % (path, offset))
+
+        data = offset + HEADER.size
+        if data + length > size:
+            break
+
+        if (start == None or last >= start) and (end == None or first <= end):
+            block = {}
+            for name, dtype in COLUMNS:
+                block[name] = numpy.frombuffer(buffer, dtype, count, data)
+                data += count * numpy.dtype(dtype).itemsize
+            yield block
+
+        offset = offset + HEADER.size + length
+
+def read(path, start=None, end=None):
+    """
+    Read all detections of the given file within the given time window.
+
+    Needs NumPy.
+
+    @param   path (str)      Path of the file to read.
+    @param   start (float)   Only read detections from this UNIX timestamp. Optional.
+    @param   end (float)     Only read detections up to this UNIX timestamp. Optional.
+    @return  (dict)          Dictionary mapping the column names ('timestamp', 'mac', 'angle' and 'rssi') to NumPy
+                               arrays.
+    """
+    import numpy
+
+    blocks = list(readBlocks(path, start, end))
+    columns = {}
+    for name, dtype in COLUMNS:
+        columns[name] = numpy.concatenate([b[name] for b in blocks]) if len(blocks) > 0 else \
+            numpy.zeros(0, dtype)
+
+    mask = numpy.ones(len(columns['timestamp']), bool)
+    if start != None:
+        mask &= columns['timestamp'] >= start
+    if end != None:
+        mask &= columns['timestamp'] <= end
+    for name in columns:
+        columns[name] = columns[name][mask]
+    return columns
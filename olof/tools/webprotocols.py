@@ -32,6 +32,62 @@ class ExtRequest(urllib2.Request):
         else:
             return self.method
 
+class StreamBody(object):
+    """
+    Class that provides a request body generated on the fly, as a file-like object, so it does not have to be built
+    in memory. httplib reads the body in blocks and sends them as they are read.
+
+    The body is generated by calling the given function, which should return an iterable of strings. It is called
+    once to count the length of the body, as the Content-Length header is sent first, and again each time the body is
+    sent: the body is rewound when it has been read completely, f.ex. when the request is repeated after a digest
+    authentication challenge. The function should return the same data each time.
+    """
+    def __init__(self, generate):
+        """
+        Initialisation.
+
+        @param   generate (method)   Function that returns an iterable of strings making up the body.
+        """
+        self.generate = generate
+        self.length = None
+        self.iterator = None
+        self.pending = ''
+
+    def __len__(self):
+        if self.length == None:
+            self.length = sum(len(i) for i in self.generate())
+        return self.length
+
+    def read(self, size=-1):
+        """
+        Read the next part of the body.
+
+        @param   size (int)   The maximum number of bytes to read. Optional, defaults to the remainder of the body.
+        @return  (str)        The data, an empty string at the end of the body.
+        """
+        if self.iterator == None:
+            self.iterator = iter(self.generate())
+
+        chunks = [self.pending]
+        length = len(self.pending)
+        while size < 0 or length < size:
+            try:
+                chunk = self.iterator.next()
+            except StopIteration:
+                break
+            chunks.append(chunk)
+            length += len(chunk)
+
+        data = ''.join(chunks)
+        if size < 0 or len(data) <= size:
+            self.pending = ''
+        else:
+            data, self.pending = data[:size], data[size:]
+
+        if len(data) == 0:
+            self.iterator = None
+        return data
+
 class RESTConnection(object):
     """
     Class that defines a REST connection.
@@ -102,7 +158,7 @@ class RESTConnection(object):
         @param   resource (str)   The resource to call.
         @param   cb (method)      A callback method to call when to request is done. Optional.
                                     This method should take one argument which will be the result of the request.
-        @param   body (str)       The data to send with the request. Optional.
+        @param   body (str)       The data to send with the request, a string or StreamBody. Optional.
         @param   headers (dict)   Additional header to send with the request. Optional.
         """
         self.request(cb, resource, "post", body=body, headers=headers)